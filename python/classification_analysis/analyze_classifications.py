@@ -7,6 +7,7 @@ from python.classification_analysis.promote_subjects import PromoteSubjects
 from python.classification_analysis.consensus_analysis import ConsensusAnalysis
 
 from python.utils.file_utils import remove_file
+from python.utils.manifest_store import ManifestStore
 from python.utils.git_utils import push_files_to_GitHub
 from python.google_drive_folder.google_drive import GoogleDriveUtils
 
@@ -22,6 +23,7 @@ from python.vars.paths_and_ids import offline_swap_db_path, \
     consensus_subjects_manifest_csv_path, consensus_users_manifest_csv_path, \
     consensus_subjects_manifest_path, consensus_users_manifest_path, \
     cleaned_classifications_manifest_path, cleaned_classifications_manifest_csv_path, \
+    first_unprocessed_row_manifest_path, first_unprocessed_row_manifest_csv_path, manifest_db_path, \
     databases_folder_drive_id, manifests_csv_folder_drive_id, manifests_folder_drive_id
 
 # Ensuring that the current working directory is "CountertopDarkMatter"
@@ -50,7 +52,8 @@ while os.getcwd()[-20:] != "CountertopDarkMatter":
                       'Zooniverse subject ID': gold label (0 or 1)
             3. Writes (appends) to running manifests corresponding to the above CSVs
         II. `run_kSWAP'
-            1. 2-class kSWAP is ran on `swap_classifications' and  `gold_classifications'
+            1. 2-class kSWAP is ran on the classifications of the event log it has not yet seen (including those
+               of `swap_classifications') and `gold_classifications'
                with the following effects:
                 a. `offline_swap.db' is updated with user scores and subject probabilities
                 b. Subjects whose null (0) probabilities pass the lower threshold are retired on Zooniverse
@@ -73,7 +76,8 @@ def main():
         golds_csv_path=golds_csv_path,
         workflow_id=first_workflow_id,
         retirement_lower_threshold=retirement_lower_threshold,
-        retirement_classification_limit=first_workflow_classification_limit)
+        retirement_classification_limit=first_workflow_classification_limit,
+        event_log=pcc.classification_event_log)
 
     cn = CreateNegatives(swap=swap)
     cn.run()
@@ -98,8 +102,15 @@ def main():
 
 
 def upload():
+    # Bringing every manifest's excel file and CSV up to date with the manifest store (and its database file up to
+    # date, to be backed up)
+    ManifestStore().export()
     # GOOGLE DRIVE
     gd = GoogleDriveUtils()
+    # MANIFEST STORE, PROCESSED ROWS
+    gd.upload_file(manifest_db_path, databases_folder_drive_id)
+    gd.upload_file(first_unprocessed_row_manifest_path, manifests_folder_drive_id)
+    gd.upload_file(first_unprocessed_row_manifest_csv_path, manifests_csv_folder_drive_id)
     # CLEANED CLASSIFICATIONS
     gd.upload_file(cleaned_classifications_manifest_path, manifests_folder_drive_id)
     gd.upload_file(cleaned_classifications_manifest_csv_path, manifests_csv_folder_drive_id)
@@ -117,8 +128,10 @@ def upload():
     gd.upload_file(consensus_subjects_manifest_csv_path, manifests_csv_folder_drive_id)
     gd.upload_file(consensus_users_manifest_csv_path, manifests_csv_folder_drive_id)
     # GITHUB
-    push_files_to_GitHub([cleaned_classifications_manifest_path, cleaned_classifications_manifest_csv_path,
-                          offline_swap_db_path, swap_classifications_manifest_path, golds_manifest_path,
+    push_files_to_GitHub([manifest_db_path, offline_swap_db_path,
+                          first_unprocessed_row_manifest_path, first_unprocessed_row_manifest_csv_path,
+                          cleaned_classifications_manifest_path, cleaned_classifications_manifest_csv_path,
+                          swap_classifications_manifest_path, golds_manifest_path,
                           swap_classifications_manifest_csv_path, golds_manifest_csv_path,
                           consensus_classifications_manifest_path, consensus_subjects_manifest_path,
                           consensus_users_manifest_path, consensus_classifications_manifest_csv_path,
@@ -1,14 +1,23 @@
 import os
+import io
 import sys
 import csv
 import json
+import sqlite3
+import numpy as np
+from array import array
+from scipy import sparse
+from scipy.sparse import csgraph
+from concurrent.futures import ProcessPoolExecutor
 
 from python.utils.csv_excel_utils import CsvUtils, ExcelUtils
 from python.vars.paths_and_ids import consensus_classifications_csv_path, \
     consensus_subjects_manifest_path, consensus_subjects_manifest_csv_path, \
-    consensus_users_manifest_path, consensus_users_manifest_csv_path
+    consensus_users_manifest_path, consensus_users_manifest_csv_path, \
+    consensus_subject_history_csv_path, consensus_user_history_csv_path, consensus_db_path
 from python.vars.fieldnames import consensus_classification_fieldnames, \
-    consensus_subjects_fieldnames, consensus_users_fieldnames
+    consensus_subjects_fieldnames, consensus_users_fieldnames, \
+    consensus_subject_history_fieldnames, consensus_user_history_fieldnames
 
 # Ensuring that the current working directory is "CountertopDarkMatter"
 while os.getcwd()[-20:] != "CountertopDarkMatter":
@@ -17,37 +26,106 @@ while os.getcwd()[-20:] != "CountertopDarkMatter":
 
 """
 Note: 'classification' is in sometimes abbreviated as 'cl'.
+
+Each iteration of consensus analysis:
+    1. sets every subject's score for each label to the weighted fraction of its classifications with that label,
+       S[s][l] = (sum of the weights of the users who submitted l on s) / (sum of the weights of the users who
+       classified s)
+    2. sets every user's weight to the mean score, of the subjects they classified, of the labels they submitted
+    3. scales user weights such that their mean equals 1
+These are computed as sparse matrix-vector products over the subject x user matrices A[l], where A[l][s][u] is
+the number of times user u submitted label l on subject s.
 """
 
 
+def parse_user_id(user_id):
+    """
+    Returns the user ID as an int; non-logged in users are identified by their IP (a string).
+    """
+    try:
+        return int(user_id)
+    except ValueError:
+        return user_id
+
+
+class History:
+    def __init__(self, fields, limit=None):
+        """
+        Compact record of snapshots of numeric attributes, held as one array of values per field. If 'limit' is
+        given, only the 'limit' most recent snapshots are kept (the arrays are used as a ring buffer).
+            fields = names of the recorded attributes (list of str)
+        """
+        self.fields = list(fields)
+        self.limit = limit
+        self.columns = dict((field, array('d')) for field in self.fields)
+        self.start = 0  # index of the oldest snapshot in the arrays, once they are full
+        self.n_appended = 0  # number of snapshots ever recorded, including those dropped
+
+    def __len__(self):
+        return len(self.columns[self.fields[0]])
+
+    def append(self, values):
+        """
+        Records a snapshot.
+            values = the values of the fields, in the order of 'fields'
+        """
+        if self.limit is None or len(self) < self.limit:
+            for field, value in zip(self.fields, values):
+                self.columns[field].append(value)
+        else:
+            for field, value in zip(self.fields, values):
+                self.columns[field][self.start] = value
+            self.start = (self.start + 1) % self.limit
+        self.n_appended += 1
+
+    def rows(self):
+        """
+        Returns the kept snapshots, oldest first, as lists like [(position), (value of each field)], where a
+        snapshot's position is the number of snapshots recorded before it.
+        """
+        n = len(self)
+        first_position = self.n_appended - n
+        return [[first_position + i] + [self.columns[field][(self.start + i) % n] for field in self.fields]
+                for i in range(n)]
+
+    @classmethod
+    def from_rows(cls, fields, rows, limit=None):
+        """
+        Rebuilds a history from rows like the ones returned by 'rows'.
+        """
+        history = cls(fields, limit)
+        for row in sorted(rows, key=lambda r: r[0]):
+            history.append(row[1:])
+        if rows:
+            history.n_appended = max(row[0] for row in rows) + 1
+        return history
+
+
 class User:
-    def __init__(self, user_id, weight=None, n_subjects=None, classifications=None, weight_history=None):
+    history_fields = consensus_user_history_fieldnames[2:]
+
+    def __init__(self, user_id, weight=None, n_subjects=None, classifications=None, weight_history=None,
+                 history_limit=None):
         """
         user_id = user's unique Zooniverse identification number (int)
         weight = the user's weight (int/float)
         n_subjects = the number of subjects that the user has classified (int)
         classifications = list of dictionaries with keys: 'classification_id', 'subject_id', 'user_id', 'label'
-        weight_history = list of dictionaries, tracking the progression of user's attributes, with keys:
-                         'weight', 'n_subjects', 'subject_id', 'score', 'user_weight_sum', 'n_users'
+        weight_history = History of the user's attributes ('history_fields') after each run of consensus analysis
+        history_limit = maximum number of snapshots kept in a new 'weight_history' (None for no limit)
         """
         self.user_id = user_id
         self.weight = y if (y := weight) else 1  # initial user weight
         self.n_subjects = y if (y := n_subjects) else 0
         self.classifications = y if (y := classifications) else []
-        self.weight_history = y if (y := weight_history) else []
+        self.weight_history = y if (y := weight_history) is not None else History(self.history_fields, history_limit)
 
-    def update_weight(self, subject, label):
+    def update_weight(self, weight):
         """
-        Updates the user's weight with the score of the subject they classified corresponding to the label they submitted.
-            subject = Subject object corresponding to the subject the user classified
-            label = the label that the user submitted
+        Sets the user's weight (computed by 'ConsensusAnalysis'), recording it in the user's 'weight_history'.
         """
-        # Updating the user's weight
-        self.weight = ((self.weight * self.n_subjects) + subject.score[label]) / self.n_subjects
-        # Appending the current user and subject attributes to the user's 'weight_history'
-        self.weight_history.append(
-            {'weight': self.weight, 'n_subjects': self.n_subjects, 'subject_id': subject.subject_id,
-             'score': subject.score, 'user_weight_sum': subject.user_weight_sum, 'n_users': subject.n_users})
+        self.weight = weight
+        self.weight_history.append([self.weight, self.n_subjects])
 
     def dump(self):
         """
@@ -56,43 +134,47 @@ class User:
         return [self.user_id,
                 self.weight,
                 self.n_subjects,
-                json.dumps(self.classifications),
-                json.dumps(self.weight_history)]
+                json.dumps(self.classifications)]
+
+    def dump_history(self):
+        """
+        Returns the rows of the user's history side table (fieldnames: 'consensus_user_history_fieldnames').
+        """
+        return [[self.user_id] + row for row in self.weight_history.rows()]
 
 
 class Subject:
-    def __init__(self, subject_id, score=None, user_weight_sum=None, n_users=None, classifications=None, score_history=None):
+    history_fields = consensus_subject_history_fieldnames[2:]
+
+    def __init__(self, subject_id, score=None, user_weight_sum=None, n_users=None, classifications=None,
+                 score_history=None, history_limit=None):
         """
         subject_id = subject's unique Zooniverse identification number (int)
         score = the subject's score (float)
         user_weight_sum = the sum of the weights of the users who classified this subject (float)
         n_users = the number of users who classified this subject (int)
         classifications = list of dictionaries with keys: 'classification_id', 'subject_id', 'user_id', 'label'
-        score_history = list of dictionaries, tracking the progression of subject's attributes, with keys:
-                        'score', 'user_weight_sum', 'n_users', 'user_id', 'weight', 'n_subjects'
+        score_history = History of the subject's attributes ('history_fields') after each run of consensus
+                        analysis
+        history_limit = maximum number of snapshots kept in a new 'score_history' (None for no limit)
         """
         self.subject_id = subject_id
         self.score = y if (y := score) else {'negative': 0, 'tenebrite': 0}
         self.user_weight_sum = y if (y := user_weight_sum) else 0
         self.n_users = y if (y := n_users) else {'negative': 0, 'tenebrite': 0}
         self.classifications = y if (y := classifications) else []
-        self.score_history = y if (y := score_history) else []
+        self.score_history = y if (y := score_history) is not None else History(self.history_fields, history_limit)
 
-    def update_score(self, user, label):
+    def update_score(self, score, user_weight_sum):
         """
-        Updates the subject's score corresponding with the label submitted with the user's weight.
-            user = User object corresponding to the user that classified the subject
-            label = the label that the user submitted
+        Sets the subject's score and user weight sum (computed by 'ConsensusAnalysis'), recording them in the
+        subject's 'score_history'.
+            score = dictionary with key-value pairs, '(label)': score
         """
-        # Updating the subject's relevant label score
-        new_user_weight_sum = self.user_weight_sum + user.weight
-        self.score[label] = \
-            ((self.score[label] * self.user_weight_sum) + user.weight) / new_user_weight_sum
-        self.user_weight_sum = new_user_weight_sum
-        # Appending the current subject and user attributes to the subjects's 'score_history'
-        self.score_history.append(
-            {'score': self.score, 'user_weight_sum': self.user_weight_sum, 'n_users': self.n_users,
-             'user_id': user.user_id, 'weight': user.weight, 'n_subjects': user.n_subjects})
+        self.score = score
+        self.user_weight_sum = user_weight_sum
+        self.score_history.append([self.score['negative'], self.score['tenebrite'], self.user_weight_sum,
+                                   self.n_users['negative'], self.n_users['tenebrite']])
 
     def dump(self):
         """
@@ -102,41 +184,344 @@ class Subject:
                 json.dumps(self.score),
                 self.user_weight_sum,
                 json.dumps(self.n_users),
-                json.dumps(self.classifications),
-                json.dumps(self.score_history)]
+                json.dumps(self.classifications)]
+
+    def dump_history(self):
+        """
+        Returns the rows of the subject's history side table (fieldnames: 'consensus_subject_history_fieldnames').
+        """
+        return [[self.subject_id] + row for row in self.score_history.rows()]
+
+
+class ConsensusStore:
+    """
+    Consensus state kept in an SQLite database, such that new classifications are applied (see
+    'ConsensusAnalysis.run_incremental') without reading or rewriting every subject and user:
+        classifications: every applied classification, indexed by subject and by user
+        subjects / users: the attributes of each subject / user, and the number of runs in its history ('n_runs')
+    User IDs keep their type (int for logged-in users, str for IPs).
+    """
+    def __init__(self, db_file, labels, timeout=10):
+        self.db_file = db_file
+        self.labels = list(labels)
+        self.timeout = timeout
+        self.subject_columns = ['subject_id'] + ['score_' + label for label in self.labels] + ['user_weight_sum'] \
+            + ['n_users_' + label for label in self.labels] + ['n_runs']
+        self.user_columns = ['user_id', 'weight', 'n_subjects', 'n_runs']
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout)
+        self.create(conn)
+        return conn
+
+    def create(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS classifications '
+                     '(classification_id TEXT PRIMARY KEY, subject_id INTEGER, user_id, label TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS classifications_subject_id ON classifications (subject_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS classifications_user_id ON classifications (user_id)')
+        conn.execute('CREATE TABLE IF NOT EXISTS subjects ({} INTEGER PRIMARY KEY, {})'.format(
+            self.subject_columns[0], ', '.join(self.subject_columns[1:])))
+        conn.execute('CREATE TABLE IF NOT EXISTS users (user_id PRIMARY KEY, weight REAL, n_subjects INTEGER, '
+                     'n_runs INTEGER)')
+
+    @staticmethod
+    def is_empty(conn):
+        return conn.execute('SELECT 1 FROM users LIMIT 1').fetchone() is None
+
+    def subject_row(self, subject):
+        return (subject.subject_id, *[subject.score[label] for label in self.labels], subject.user_weight_sum,
+                *[subject.n_users[label] for label in self.labels], subject.score_history.n_appended)
+
+    @staticmethod
+    def user_row(user):
+        return user.user_id, user.weight, user.n_subjects, user.weight_history.n_appended
+
+    def save_subjects(self, conn, subjects):
+        conn.executemany('INSERT OR REPLACE INTO subjects VALUES ({})'.format(','.join('?' * len(self.subject_columns))),
+                         (self.subject_row(subject) for subject in subjects))
+
+    def save_users(self, conn, users):
+        conn.executemany('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)', (self.user_row(user) for user in users))
+
+    @staticmethod
+    def add_classification(conn, cl):
+        """
+        Adds a classification; returns whether it was new.
+        """
+        return conn.execute('INSERT OR IGNORE INTO classifications VALUES (?, ?, ?, ?)',
+                            (cl['classification_id'], cl['subject_id'], cl['user_id'], cl['label'])).rowcount == 1
+
+    def replace_all(self, conn, subjects, users):
+        """
+        Replaces the whole saved state with the given subjects and users (and their classifications).
+        """
+        for table in ['classifications', 'subjects', 'users']:
+            conn.execute(f'DELETE FROM {table}')
+        for subject in subjects:
+            for cl in subject.classifications:
+                self.add_classification(conn, cl)
+        self.save_subjects(conn, subjects)
+        self.save_users(conn, users)
+
+    @staticmethod
+    def to_classification(row):
+        return {'classification_id': row[0], 'subject_id': row[1], 'user_id': row[2], 'label': row[3]}
+
+    def select_classifications(self, conn, column, values=None):
+        """
+        Returns the classifications whose 'column' (subject_id or user_id) is one of 'values' (default: all).
+        """
+        return [self.to_classification(row) for row in self.select_rows(conn, 'classifications', column, values)]
+
+    def load_subjects(self, conn, subject_ids=None, history_limit=None):
+        """
+        Returns a dictionary like 'subject_id': Subject (without classifications) of the given subjects (default:
+        every subject). Their histories hold no snapshots but count the saved ones.
+        """
+        subjects = {}
+        n = len(self.labels)
+        for row in self.select_rows(conn, 'subjects', 'subject_id', subject_ids):
+            score_history = History(Subject.history_fields, history_limit)
+            score_history.n_appended = row[-1]
+            subjects[row[0]] = Subject(row[0], dict(zip(self.labels, row[1:1 + n])), row[1 + n],
+                                       dict(zip(self.labels, row[2 + n:2 + 2 * n])), [], score_history, history_limit)
+        return subjects
+
+    def load_users(self, conn, user_ids=None, history_limit=None):
+        """
+        Returns a dictionary like 'user_id': User (without classifications) of the given users (default: every user).
+        """
+        users = {}
+        for row in self.select_rows(conn, 'users', 'user_id', user_ids):
+            weight_history = History(User.history_fields, history_limit)
+            weight_history.n_appended = row[3]
+            users[row[0]] = User(row[0], row[1], row[2], [], weight_history, history_limit)
+        return users
+
+    @staticmethod
+    def select_rows(conn, table, column, values=None):
+        if values is None:
+            return conn.execute(f'SELECT * FROM {table} ORDER BY rowid').fetchall()
+        values, rows = list(values), []
+        # (SQLite limits the number of parameters per statement)
+        for i in range(0, len(values), 500):
+            chunk = values[i:i + 500]
+            rows.extend(conn.execute(f'SELECT * FROM {table} WHERE {column} IN ({",".join("?" * len(chunk))})',
+                                     chunk))
+        return rows
+
+
+class ConsensusMatrices:
+    def __init__(self, label_matrices, weights, boundary=None, boundary_scores=None):
+        """
+        The sparse matrices of a set of subjects and users, and the subject scores and user weights iterated on them.
+            label_matrices = list of (subject x user) CSR matrices, one per label, counting the times each user
+                             submitted the label on each subject
+            weights = vector of user weights
+            boundary = boolean vector of the subjects whose scores are held fixed (default: none)
+            boundary_scores = (label x subject) array of the fixed scores of boundary subjects
+        """
+        self.label_matrices = label_matrices
+        self.label_matrices_t = [matrix.T.tocsr() for matrix in label_matrices]
+        self.n_subjects, self.n_users = label_matrices[0].shape
+        self.weights = np.array(weights, dtype=float)
+        self.boundary = boundary if boundary is not None else np.zeros(self.n_subjects, dtype=bool)
+        self.boundary_scores = boundary_scores if boundary_scores is not None \
+            else np.zeros((len(label_matrices), self.n_subjects))
+        self.scores = np.zeros((len(label_matrices), self.n_subjects))
+        self.user_weight_sums = np.zeros(self.n_subjects)
+
+    def iterate(self, n_iterations, tolerance=None, max_iterations=100, damping=0.0, weight_sum_target=None,
+                scale=True):
+        """
+        Performs n_iterations of consensus analysis, or iterates until convergence if a tolerance is given; returns
+        the largest change in a user weight or subject score at each iteration.
+            scale = whether user weights are scaled at every iteration (see 'scale_user_weights')
+        """
+        residuals = []
+        for n in range(n_iterations if tolerance is None else max_iterations):
+            previous_weights, previous_scores = self.weights.copy(), self.scores
+            self.update_subject_scores()
+            self.update_user_weights(damping)
+            if scale:
+                self.scale_user_weights(weight_sum_target)
+            residuals.append(float(max(np.abs(self.weights - previous_weights).max(initial=0),
+                                       np.abs(self.scores - previous_scores).max(initial=0))))
+            if tolerance is not None and residuals[-1] < tolerance:
+                break
+        return residuals
+
+    def update_subject_scores(self):
+        """
+        Updates the scores of all subjects using the weights of all users.
+        """
+        label_weight_sums = np.array([matrix @ self.weights for matrix in self.label_matrices])
+        self.user_weight_sums = label_weight_sums.sum(axis=0)
+        classified = self.user_weight_sums > 0
+        self.scores = np.zeros_like(label_weight_sums)
+        self.scores[:, classified] = label_weight_sums[:, classified] / self.user_weight_sums[classified]
+        # (Subjects outside the neighborhood refined by 'run_incremental' keep their scores)
+        self.scores[:, self.boundary] = self.boundary_scores[:, self.boundary]
+
+    def update_user_weights(self, damping=0.0):
+        """
+        Updates the weights of all users to the mean score of the labels they submitted on the subjects they
+        classified (keeping the fraction 'damping' of their previous weights).
+        """
+        score_sums = sum(matrix_t @ scores for matrix_t, scores in zip(self.label_matrices_t, self.scores))
+        n_classifications = sum(matrix_t @ np.ones(self.n_subjects) for matrix_t in self.label_matrices_t)
+        classified = n_classifications > 0
+        self.weights[classified] = (1 - damping) * score_sums[classified] / n_classifications[classified] \
+            + damping * self.weights[classified]
+
+    def scale_user_weights(self, weight_sum_target=None):
+        """
+        Scales all user weights, such that the mean equals 1 (or the sum equals 'weight_sum_target').
+        """
+        weight_sum = self.weights.sum()
+        if weight_sum_target is None:
+            weight_sum_target = self.n_users
+        if weight_sum > 0 and weight_sum_target > 0:
+            self.weights *= weight_sum_target / weight_sum
+
+    def components(self):
+        """
+        Returns the connected components of the user-subject graph, as a list of tuples of the indices of their
+        subjects and of their users.
+        """
+        adjacency = sum(self.label_matrices)
+        graph = sparse.bmat([[None, adjacency], [adjacency.T, None]])
+        n_components, component = csgraph.connected_components(graph, directed=False)
+        order = np.argsort(component, kind='stable')
+        starts = np.searchsorted(component[order], np.arange(n_components + 1))
+        return [(members[members < self.n_subjects], members[members >= self.n_subjects] - self.n_subjects)
+                for members in (order[starts[i]:starts[i + 1]] for i in range(n_components))]
+
+    def submatrices(self, subject_index, user_index):
+        """
+        Returns the ConsensusMatrices of the given subjects and users.
+        """
+        return ConsensusMatrices([matrix[subject_index][:, user_index] for matrix in self.label_matrices],
+                                 self.weights[user_index], self.boundary[subject_index],
+                                 self.boundary_scores[:, subject_index])
+
+    def iterate_components(self, n_iterations, tolerance=None, max_iterations=100, damping=0.0,
+                           weight_sum_target=None, n_workers=None, batch_size=10000):
+        """
+        Like 'iterate', but each connected component of the user-subject graph (which share no users or subjects,
+        so do not affect each other) is iterated on separately, on a pool of 'n_workers' processes (default:
+        number of CPUs). Components with fewer than 'batch_size' classifications are batched together.
+        Subject scores do not depend on the scale of the weights, so batches iterate on unscaled weights and the
+        weights are only scaled once all batches are done, which gives the result of 'iterate' (except for users
+        who classified nothing, whose weights 'iterate' keeps rescaling, and with damping, where the previous weights
+        kept are unscaled). The residual of each iteration is the largest among the batches that performed it.
+        """
+        batches, batch_subjects, batch_users, size = [], [], [], 0
+        for subject_index, user_index in self.components():
+            batch_subjects.append(subject_index)
+            batch_users.append(user_index)
+            size += sum(matrix[subject_index].nnz for matrix in self.label_matrices)
+            if size >= batch_size:
+                batches.append((np.concatenate(batch_subjects), np.concatenate(batch_users)))
+                batch_subjects, batch_users, size = [], [], 0
+        if batch_subjects:
+            batches.append((np.concatenate(batch_subjects), np.concatenate(batch_users)))
+        args = (n_iterations, tolerance, max_iterations, damping)
+        if len(batches) == 1:
+            results = [iterate_batch(self.submatrices(*batches[0]), *args)]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = [executor.submit(iterate_batch, self.submatrices(*batch), *args) for batch in batches]
+                results = [future.result() for future in futures]
+        residuals = []
+        for (subject_index, user_index), (scores, user_weight_sums, weights, batch_residuals) in zip(batches, results):
+            self.scores[:, subject_index] = scores
+            self.user_weight_sums[subject_index] = user_weight_sums
+            self.weights[user_index] = weights
+            for n, residual in enumerate(batch_residuals):
+                if n < len(residuals):
+                    residuals[n] = max(residuals[n], residual)
+                else:
+                    residuals.append(residual)
+        # Global post-step
+        self.scale_user_weights(weight_sum_target)
+        return residuals
+
+
+def iterate_batch(matrices, n_iterations, tolerance, max_iterations, damping):
+    """
+    Iterates on a batch of connected components (see 'ConsensusMatrices.iterate_components'); returns its scores,
+    user weight sums, weights and residuals.
+    """
+    residuals = matrices.iterate(n_iterations, tolerance, max_iterations, damping, scale=False)
+    return matrices.scores, matrices.user_weight_sums, matrices.weights, residuals
 
 
 class ConsensusAnalysis:
     cl_fieldnames = consensus_classification_fieldnames
     subject_fieldnames = consensus_subjects_fieldnames
     user_fieldnames = consensus_users_fieldnames
+    subject_history_fieldnames = consensus_subject_history_fieldnames
+    user_history_fieldnames = consensus_user_history_fieldnames
+    labels = ['negative', 'tenebrite']
 
-    def __init__(self, cl_csv_path, subjects_csv_path, users_csv_path, subjects_manifest_path, users_manifest_path):
+    def __init__(self, cl_csv_path, subjects_csv_path, users_csv_path, subjects_manifest_path, users_manifest_path,
+                 subject_history_csv_path=consensus_subject_history_csv_path,
+                 user_history_csv_path=consensus_user_history_csv_path, history_limit=None, db_path=consensus_db_path):
         """
         cl_csv_path = path to the CSV containing classifications with fieldnames 'cl_fieldnames'
         subjects_csv_path = path to the CSV containing subjects' data (fieldnames: 'subject_fieldnames')
         users_csv_path = path to the CSV containing subjects' data (fieldnames: 'subject_fieldnames')
         subjects_manifest_path = path to .xlsx copy of subjects_csv
         users_manifest_path = path to .xlsx copy of users_csv
+        subject_history_csv_path = path to the CSV containing subjects' histories (fieldnames:
+                                   'subject_history_fieldnames'), one row per subject per run
+        user_history_csv_path = path to the CSV containing users' histories (fieldnames: 'user_history_fieldnames')
+        history_limit = maximum number of (most recent) runs kept in each subject's and user's history
+        db_path = path to the database in which the consensus state is kept (see 'ConsensusStore')
         """
         # Dictionary with key-value pairs, '(subject ID)': Subject instance
         self.subjects = {}
         # Dictionary with key-value pairs, '(user ID)': User instance
         self.users = {}
+        # Sparse matrices, scores and weights used during consensus analysis (see 'build_matrices'), and the IDs
+        # of their subjects (rows) and users (columns)
+        self.subject_ids, self.user_ids = [], []
+        self.matrices = None
+        self.residuals = []
+        # Subjects whose scores are held fixed during incremental runs (see 'run_incremental')
+        self.boundary_subject_ids = set()
+        self.history_limit = history_limit
+        self.cl_csv_path = cl_csv_path
+        self.store = ConsensusStore(db_path, self.labels)
         # Class instances used to interface with CSV / manifest (Excel) files
         self.cl_csv = CsvUtils(cl_csv_path, fieldnames_list=self.cl_fieldnames)
         self.subject_csv = CsvUtils(subjects_csv_path, fieldnames_list=self.subject_fieldnames)
         self.user_csv = CsvUtils(users_csv_path, fieldnames_list=self.user_fieldnames)
         self.subject_manifest = ExcelUtils(subjects_manifest_path, fieldnames_list=self.subject_fieldnames)
         self.user_manifest = ExcelUtils(users_manifest_path, fieldnames_list=self.user_fieldnames)
-
-    def run(self, n_iterations=1):
-        """
-        Performs n_iterations of consensus analysis.
-        """
-        # Loading previous subject and user data
-        self.load_subjects()
-        self.load_users()
+        self.subject_history_csv = CsvUtils(subject_history_csv_path, fieldnames_list=self.subject_history_fieldnames)
+        self.user_history_csv = CsvUtils(user_history_csv_path, fieldnames_list=self.user_history_fieldnames)
+
+    def run(self, n_iterations=1, tolerance=None, max_iterations=100, damping=0.0, n_workers=1, batch_size=10000):
+        """
+        Performs n_iterations of consensus analysis or, if a tolerance is given, iterates until the largest change
+        in a user weight or subject score falls below it (performing at most max_iterations).
+            damping = fraction (0 to 1) of each user's previous weight kept at every iteration, which slows
+                      oscillating weights down
+            n_workers = number of processes over which the connected components of the user-subject graph are
+                        iterated on (None for the number of CPUs; see 'consensus_analysis')
+            batch_size = number of classifications below which components are batched together (see
+                         'consensus_analysis')
+        Returns the number of iterations performed and the residual (the largest change in the last iteration).
+        """
+        # Loading previous subject and user data (from CSVs until the consensus database has been written)
+        conn = self.store.connect()
+        if self.store.is_empty(conn):
+            self.load_subjects()
+            self.load_users()
+        else:
+            self.load_store(conn)
         # Parsing new classifications, initializing new subjects and users
         self.parse_classifications()
         # Clearing the previous CSVs / manifests
@@ -144,10 +529,148 @@ class ConsensusAnalysis:
         self.user_csv.clear()
         self.subject_manifest.clear()
         self.user_manifest.clear()
-        # Performing n_iterations of consensus analysis
-        self.consensus_analysis(n_iterations)
-        # Rewriting CSVs / manifests
+        self.subject_history_csv.clear()
+        self.user_history_csv.clear()
+        # Performing consensus analysis
+        n_iterations, residual = self.consensus_analysis(n_iterations, tolerance, max_iterations, damping,
+                                                         n_workers=n_workers, batch_size=batch_size)
+        # Rewriting CSVs / manifests and the consensus database
         self.update_CSVs()
+        self.store.replace_all(conn, self.subjects.values(), self.users.values())
+        conn.commit()
+        conn.close()
+        return n_iterations, residual
+
+    def run_incremental(self, tolerance=1e-6, max_iterations=100, damping=0.0, hops=1, n_workers=1,
+                        batch_size=10000):
+        """
+        Applies only the classifications added to 'cl_csv' since the last run, refining the scores and weights of
+        their neighborhood in the user-subject graph while holding the rest fixed:
+            - the subjects they classify, and the subjects classified by users of those (repeated 'hops' times),
+              are rescored
+            - the users who classified those subjects are reweighted
+            - subjects outside the neighborhood that these users classified keep their scores
+            - the weights of the neighborhood's users are scaled such that the mean of all user weights stays 1
+        Only the changed subjects and users are written to the consensus database and history side tables; the
+        subject/user CSVs and manifests are regenerated with 'export_manifests'. The result approximates that of
+        'run', which recomputes every subject and user.
+        Returns the number of iterations performed and the residual, like 'run'.
+        """
+        conn = self.store.connect()
+        if self.store.is_empty(conn):
+            # Importing the state recorded in the subject and user CSVs
+            self.load_subjects()
+            self.load_users()
+            self.store.replace_all(conn, self.subjects.values(), self.users.values())
+            conn.commit()
+        new_cls = self.read_new_classifications(conn)
+        if not new_cls:
+            conn.commit()
+            conn.close()
+            print('Consensus analysis: no new classifications.')
+            return 0, None
+
+        # Finding the neighborhood of the new classifications
+        free_subject_ids = set(cl['subject_id'] for cl in new_cls)
+        for _ in range(hops):
+            user_ids = set(cl['user_id'] for cl in self.store.select_classifications(
+                conn, 'subject_id', free_subject_ids))
+            free_subject_ids.update(cl['subject_id'] for cl in self.store.select_classifications(
+                conn, 'user_id', user_ids))
+        subject_cls = self.store.select_classifications(conn, 'subject_id', free_subject_ids)
+        free_user_ids = set(cl['user_id'] for cl in subject_cls)
+        # Classifications by the neighborhood's users of subjects outside it
+        boundary_cls = [cl for cl in self.store.select_classifications(conn, 'user_id', free_user_ids)
+                        if cl['subject_id'] not in free_subject_ids]
+        self.boundary_subject_ids = set(cl['subject_id'] for cl in boundary_cls)
+
+        # Loading the neighborhood's subjects and users, initializing new ones
+        self.subjects = self.store.load_subjects(conn, free_subject_ids | self.boundary_subject_ids,
+                                                 self.history_limit)
+        self.users = self.store.load_users(conn, free_user_ids, self.history_limit)
+        n_users, weight_sum = conn.execute('SELECT COUNT(*), TOTAL(weight) FROM users').fetchone()
+        # The sum that the neighborhood's weights are scaled to, such that the mean of all weights is 1
+        weight_sum_target = n_users + len(free_user_ids - set(self.users)) \
+            - (weight_sum - sum(user.weight for user in self.users.values()))
+        for subject_id in free_subject_ids - set(self.subjects):
+            self.subjects[subject_id] = Subject(subject_id, history_limit=self.history_limit)
+        for user_id in free_user_ids - set(self.users):
+            self.users[user_id] = User(user_id, history_limit=self.history_limit)
+        for cl in new_cls:
+            self.subjects[cl['subject_id']].n_users[cl['label']] += 1
+            self.users[cl['user_id']].n_subjects += 1
+        for cl in subject_cls + boundary_cls:
+            self.subjects[cl['subject_id']].classifications.append(cl)
+
+        # Performing consensus analysis on the neighborhood
+        n_iterations, residual = self.consensus_analysis(1, tolerance, max_iterations, damping, weight_sum_target,
+                                                         n_workers, batch_size)
+        # Writing the changed subjects and users
+        changed_subjects = [self.subjects[subject_id] for subject_id in free_subject_ids]
+        self.store.save_subjects(conn, changed_subjects)
+        self.store.save_users(conn, self.users.values())
+        conn.commit()
+        conn.close()
+        self.subject_history_csv.write_rows([row for s in changed_subjects for row in s.dump_history()])
+        self.user_history_csv.write_rows([row for u in self.users.values() for row in u.dump_history()])
+        print(f'Consensus analysis: applied {len(new_cls)} new classifications, updating {len(changed_subjects)} '
+              f'subjects and {len(self.users)} users.')
+        self.boundary_subject_ids = set()
+        return n_iterations, residual
+
+    def read_new_classifications(self, conn):
+        """
+        Reads 'cl_csv', adds the classifications not yet applied to the consensus database, and returns them (as
+        dictionaries like the rows of 'cl_csv'). The whole CSV is read, since it is rewritten (rather than appended
+        to) whenever classifications are processed; classifications already applied are skipped by ID.
+        """
+        with open(self.cl_csv_path, 'rb') as f:
+            data = f.read()
+        # Only complete rows are read; a row still being written is read by the next run
+        data = data[:data.rfind(b'\n') + 1]
+        new_cls = []
+        for cl_row in csv.DictReader(io.StringIO(data.decode())):
+            if cl_row['label'] not in self.labels:
+                continue
+            cl = {'classification_id': cl_row['classification_id'],
+                  'subject_id': int(cl_row['subject_id']),
+                  'user_id': parse_user_id(cl_row['user_id']),
+                  'label': cl_row['label']}
+            if self.store.add_classification(conn, cl):
+                new_cls.append(cl)
+        return new_cls
+
+    def load_store(self, conn, histories=True):
+        """
+        Loads the subject and user data saved in the consensus database, with their histories (read from the
+        history side tables) if 'histories' is True.
+        """
+        self.subjects = self.store.load_subjects(conn, history_limit=self.history_limit)
+        self.users = self.store.load_users(conn, history_limit=self.history_limit)
+        for cl in self.store.select_classifications(conn, 'subject_id'):
+            self.subjects[cl['subject_id']].classifications.append(cl)
+            self.users[cl['user_id']].classifications.append(cl)
+        if not histories:
+            return
+        score_histories = self.load_histories(self.subject_history_csv, Subject.history_fields, 'subject_id', int)
+        weight_histories = self.load_histories(self.user_history_csv, User.history_fields, 'user_id', parse_user_id)
+        for subject_id, score_history in score_histories.items():
+            if subject_id in self.subjects:
+                self.subjects[subject_id].score_history = score_history
+        for user_id, weight_history in weight_histories.items():
+            if user_id in self.users:
+                self.users[user_id].weight_history = weight_history
+
+    def export_manifests(self):
+        """
+        Rewrites the subject/user CSVs and manifests with the data in the consensus database.
+        """
+        conn = self.store.connect()
+        self.load_store(conn, histories=False)
+        conn.close()
+        for csv_or_manifest in [self.subject_csv, self.user_csv, self.subject_manifest, self.user_manifest]:
+            csv_or_manifest.clear()
+        self.write_manifests()
 
     def load_subjects(self):
         """
@@ -155,17 +678,18 @@ class ConsensusAnalysis:
         """
         # Getting a list of all the rows in 'subjects_csv' in dictionary format
         subject_rows = self.subject_csv.read_rows(dict_reader=True)
+        score_histories = self.load_histories(self.subject_history_csv, Subject.history_fields, 'subject_id', int)
         for subject_row in subject_rows:
             # Parsing the row, converting to proper data types
             subject_id = int(subject_row['subject_id'])
             score = json.loads(subject_row['score'])
-            user_weight_sum = int(subject_row['user_weight_sum'])
+            user_weight_sum = float(subject_row['user_weight_sum'])
             n_users = json.loads(subject_row['n_users'])
             classifications = json.loads(subject_row['classifications'])
-            score_history = json.loads(subject_row['score_history'])
+            score_history = score_histories.get(subject_id)
             # Adding a Subject instance whose attributes are this row's data to the 'subjects' dictionary
             self.subjects[subject_id] = Subject(
-                subject_id, score, user_weight_sum, n_users, classifications, score_history)
+                subject_id, score, user_weight_sum, n_users, classifications, score_history, self.history_limit)
 
     def load_users(self):
         """
@@ -173,15 +697,29 @@ class ConsensusAnalysis:
         """
         # Getting a list of all the rows in 'users_csv' in dictionary format
         users_rows = self.user_csv.read_rows(dict_reader=True)
+        weight_histories = self.load_histories(self.user_history_csv, User.history_fields, 'user_id', parse_user_id)
         for users_row in users_rows:
             # Parsing the row, converting to proper data types
-            user_id = int(users_row['user_id'])
+            user_id = parse_user_id(users_row['user_id'])
             weight = float(users_row['weight'])
             n_subjects = int(users_row['n_subjects'])
             classifications = json.loads(users_row['classifications'])
-            weight_history = json.loads(users_row['weight_history'])
+            weight_history = weight_histories.get(user_id)
             # Adding a User instance whose attributes are this row's data to the 'users' dictionary
-            self.users[user_id] = User(user_id, weight, n_subjects, classifications, weight_history)
+            self.users[user_id] = User(user_id, weight, n_subjects, classifications, weight_history,
+                                       self.history_limit)
+
+    def load_histories(self, history_csv, fields, id_fieldname, parse_id):
+        """
+        Loads previous histories from a history side table; returns a dictionary with key-value pairs,
+        '(subject/user ID)': History instance.
+        """
+        rows = {}
+        for history_row in history_csv.read_rows(dict_reader=True):
+            rows.setdefault(parse_id(history_row[id_fieldname]), []).append(
+                [int(history_row['position'])] + [float(history_row[field]) for field in fields])
+        return dict((row_id, History.from_rows(fields, id_rows, self.history_limit))
+                    for row_id, id_rows in rows.items())
 
     def parse_classifications(self):
         """
@@ -189,17 +727,24 @@ class ConsensusAnalysis:
         """
         # Getting a list of all the rows in 'cl_csv' in dictionary format
         cl_rows = self.cl_csv.read_rows(dict_reader=True)
+        # IDs of the classifications already applied to subjects, which are skipped if found again
+        seen_cl_ids = set(str(cl['classification_id']) for subject in self.subjects.values()
+                          for cl in subject.classifications)
         for cl_row in cl_rows:
+            # Skipping classifications already parsed, and ones without a recognized label
+            if cl_row['classification_id'] in seen_cl_ids or cl_row['label'] not in self.labels:
+                continue
+            seen_cl_ids.add(cl_row['classification_id'])
             # Parsing the row, converting to proper data types
             subject_id = cl_row['subject_id'] = int(cl_row['subject_id'])
-            user_id = cl_row['user_id'] = int(cl_row['user_id'])
+            user_id = cl_row['user_id'] = parse_user_id(cl_row['user_id'])
             label = cl_row['label']
             # If the subject is not found 'subjects', add it
             if (y := subject_id) not in self.subjects.keys():
-                self.subjects[y] = Subject(y)
+                self.subjects[y] = Subject(y, history_limit=self.history_limit)
             # If the user is not found 'subjects', add it
             if (y := user_id) not in self.users.keys():
-                self.users[y] = User(y)
+                self.users[y] = User(y, history_limit=self.history_limit)
             # Incrementing subject's number of users who classified it
             self.subjects[subject_id].n_users[label] += 1
             # Incrementing the user's number of subjects classified
@@ -208,67 +753,85 @@ class ConsensusAnalysis:
             self.subjects[subject_id].classifications.append(cl_row)
             self.users[user_id].classifications.append(cl_row)
 
-    def consensus_analysis(self, n_iterations):
-        """
-        Performs n_iterations of consensus analysis.
-        """
-        for n in range(n_iterations):
-            self.update_subject_scores()
-            self.update_user_weights()
-            self.scale_user_weights()
-
-    def update_subject_scores(self):
-        """
-        Updates the scores of subjects in 'subjects' using the weights of all users in 'users'.
-        """
-        # Iterating through subjects
+    def consensus_analysis(self, n_iterations, tolerance=None, max_iterations=100, damping=0.0,
+                           weight_sum_target=None, n_workers=1, batch_size=10000):
+        """
+        Performs n_iterations of consensus analysis, or iterates until convergence if a tolerance is given (see
+        'run'); returns the number of iterations performed and the residual.
+            weight_sum_target = the sum that user weights are scaled to (default: the number of users)
+            n_workers = if not 1, the connected components of the user-subject graph are iterated on separately, on
+                        a pool of this many processes (None for the number of CPUs; see
+                        'ConsensusMatrices.iterate_components')
+            batch_size = number of classifications below which connected components are batched together, when
+                         'n_workers' is not 1
+        """
+        self.build_matrices()
+        if n_workers == 1:
+            self.residuals = self.matrices.iterate(n_iterations, tolerance, max_iterations, damping, weight_sum_target)
+        else:
+            self.residuals = self.matrices.iterate_components(n_iterations, tolerance, max_iterations, damping,
+                                                              weight_sum_target, n_workers, batch_size)
+        residual = self.residuals[-1] if self.residuals else None
+        if self.residuals:
+            self.store_results()
+            print(f'Consensus analysis: {len(self.residuals)} iterations, residual {residual:.3g}.')
+            if tolerance is not None and residual >= tolerance:
+                print(f'Consensus analysis did not converge to within {tolerance} in {max_iterations} iterations.')
+        return len(self.residuals), residual
+
+    def build_matrices(self):
+        """
+        Builds, from subjects' classifications, a sparse (subject x user) matrix for each label, counting the times
+        each user submitted the label on each subject, and the vector of current user weights.
+        """
+        self.subject_ids = list(self.subjects.keys())
+        self.user_ids = list(self.users.keys())
+        subject_index = dict((subject_id, i) for i, subject_id in enumerate(self.subject_ids))
+        user_index = dict((user_id, i) for i, user_id in enumerate(self.user_ids))
+        entries = dict((label, ([], [])) for label in self.labels)
         for subject in self.subjects.values():
-            # Iterating through this subject's classification history
             for cl in subject.classifications:
-                # Getting the user who made the classification
-                user = self.users[cl['user_id']]
-                # Getting the label submitted by the user
-                label = cl['label']
-                # Updating the subject's score
-                subject.update_score(user, label)
-
-    def update_user_weights(self):
-        """
-        Updates the weights of users in 'users' using the scores of all subjects in 'subjects'.
-        """
-        # Iterating through users
-        for user in self.users.values():
-            # Iterating through this user's classification history
-            for cl in user.classifications:
-                # Getting the subject that the classification was made on
-                subject = self.subjects[cl['subject_id']]
-                # Getting the label submitted by the user
-                label = cl['label']
-                # Updating th user's weight
-                user.update_weight(subject, label)
-
-    def scale_user_weights(self):
-        """
-        Scales all user weights, such that the mean equals 1.
-        """
-        # Getting a list of User instances
-        user_list = list(self.users.values())
-        # Getting the total number of users
-        n_users = len(user_list)
-        # Getting the sum of all users' weights
-        user_weight_sum = sum([u.weight for u in user_list])
-        # Calculating the average user weight
-        avg_user_weight = user_weight_sum / n_users
-        # Calculating the scale-factor necessary to make the mean weight equal 1
-        user_weight_scalar = avg_user_weight ** (-1)
-        # Applying the scale-factor to every user weight
-        for user_id in self.users.keys():
-            self.users[user_id].weight *= user_weight_scalar
+                if cl['label'] in entries:
+                    entries[cl['label']][0].append(subject_index[subject.subject_id])
+                    entries[cl['label']][1].append(user_index[cl['user_id']])
+        shape = (len(self.subject_ids), len(self.user_ids))
+        # (Duplicate entries are summed on conversion to CSR format)
+        label_matrices = [sparse.coo_matrix((np.ones(len(rows)), (rows, columns)), shape=shape).tocsr()
+                          for rows, columns in entries.values()]
+        weights = np.array([float(self.users[user_id].weight) for user_id in self.user_ids])
+        boundary = np.array([subject_id in self.boundary_subject_ids for subject_id in self.subject_ids], dtype=bool)
+        boundary_scores = np.array([[self.subjects[subject_id].score[label] if boundary[i] else 0.0
+                                     for i, subject_id in enumerate(self.subject_ids)]
+                                    for label in self.labels]).reshape(len(self.labels), len(self.subject_ids))
+        self.matrices = ConsensusMatrices(label_matrices, weights, boundary, boundary_scores)
+
+    def store_results(self):
+        """
+        Sets the scores and weights computed in the last iteration on the Subject and User instances.
+        """
+        matrices = self.matrices
+        for i, subject_id in enumerate(self.subject_ids):
+            if matrices.boundary[i]:
+                continue
+            self.subjects[subject_id].update_score(
+                dict((label, float(matrices.scores[j, i])) for j, label in enumerate(self.labels)),
+                float(matrices.user_weight_sums[i]))
+        for i, user_id in enumerate(self.user_ids):
+            self.users[user_id].update_weight(float(matrices.weights[i]))
 
     def update_CSVs(self):
         """
         Rewrites CSVs / manifests with the data in the 'subjects' and 'users' dictionaries.
         """
+        self.write_manifests()
+        # Writing subject/user histories to their side tables
+        self.subject_history_csv.write_rows([row for s in self.subjects.values() for row in s.dump_history()])
+        self.user_history_csv.write_rows([row for u in self.users.values() for row in u.dump_history()])
+
+    def write_manifests(self):
+        """
+        Writes the data in the 'subjects' and 'users' dictionaries to the subject/user CSVs and manifests.
+        """
         # Getting subjects' data in list format
         subject_rows = [s.dump() for s in self.subjects.values()]
         # Getting users' data in list format
@@ -282,8 +845,6 @@ class ConsensusAnalysis:
 
 # THE FUNCTIONS BELOW ARE MEANT TO TEST 'ConsensusAnalysis'
 
-import numpy as np
-
 
 def write_test_classifications_csv(n_users, n_subjects, cl_per_user, avg_user_correct_rate, stdev_user_correct_rate):
     user_ids = list(range(1, n_users + 1))
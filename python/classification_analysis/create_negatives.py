@@ -3,14 +3,16 @@ from shutil import copyfile
 
 from python.utils.git_utils import push_files_to_GitHub
 from python.utils.zooniverse_utils import upload_subjects_to_zooniverse
+from python.utils.manifest_store import ManifestStore
 from python.utils.csv_excel_utils import CsvUtils, ExcelUtils
+from python.classification_analysis.process_classifications_csv import CleanedClassificationsStore
 from python.google_drive_folder.google_drive import GoogleDriveUtils
 
 from python.vars.fieldnames import negative_fieldnames
 from python.vars.project_info import negative_subject_set_id, negative_feedback_id
-from python.vars.paths_and_ids import cleaned_classifications_manifest_csv_path, negative_csv_path, \
-    negative_manifest_path, negative_manifest_csv_path, manifests_csv_folder_drive_id, \
-    manifests_folder_drive_id, fetched_images_folder, negative_subjects_folder, negative_folder_drive_id
+from python.vars.paths_and_ids import negative_csv_path, negative_manifest_path, negative_manifest_csv_path, \
+    manifests_csv_folder_drive_id, manifests_folder_drive_id, fetched_images_folder, negative_subjects_folder, \
+    negative_folder_drive_id, manifest_db_path, databases_folder_drive_id
 
 # Ensuring that the current working directory is "CountertopDarkMatter"
 while os.getcwd()[-20:] != "CountertopDarkMatter":
@@ -25,9 +27,12 @@ class CreateNegatives:
     def __init__(self, swap):
         self.subjects = list(swap.subjects.values())
         self.negative_csv = CsvUtils(negative_csv_path)
-        self.negative_manifest = ExcelUtils(negative_manifest_path, negative_fieldnames)
-        self.negative_manifest_csv = CsvUtils(negative_manifest_csv_path, negative_fieldnames)
-        self.cleaned_classifications_csv = CsvUtils(cleaned_classifications_manifest_csv_path, negative_fieldnames)
+        # (The manifest and its backup CSV are views of the same table of the manifest store)
+        self.manifest_store = ManifestStore()
+        self.negative_manifest = ExcelUtils(negative_manifest_path, negative_fieldnames, store=self.manifest_store)
+        self.negative_manifest_csv = CsvUtils(negative_manifest_csv_path, negative_fieldnames,
+                                              store=self.manifest_store)
+        self.cleaned_classifications_store = CleanedClassificationsStore()
         self.gd = GoogleDriveUtils()
 
     def run(self):
@@ -74,12 +79,12 @@ class CreateNegatives:
             negative_subjects: list of (k)SWAP 'Subject' instances that were retired as 'Negative'
         """
         negative_subjects_metadata_dicts = []
+        cleaned_classification_rows = self.cleaned_classifications_store.get_many(
+            [s.subject_id for s in negative_subjects], column='subject_znv_id')
         neg_i = self.negative_manifest.get_first_empty_row() - 1
         for neg_i, negative_subject in enumerate(negative_subjects, start=neg_i):
             negative_subject_id = 'n' + str(neg_i)
-            cleaned_classification_row = self.cleaned_classifications_csv.find_row(
-                identifier=negative_subject.subject_id,
-                column_header='subject_znv_id')
+            cleaned_classification_row = cleaned_classification_rows[int(negative_subject.subject_id)]
             experiment_file_name = cleaned_classification_row['#file_name']
             negative_file_name = negative_subject_id + '_' + experiment_file_name
             negative_subjects_metadata_dicts.append({
@@ -105,13 +110,12 @@ class CreateNegatives:
 
     def write_metadata(self, negative_subjects_metadata_dicts):
         """
-        Writes negatives subjects' metadata  into 'negative_subjects.csv', 'Negative_Manifest.xlsx,
-        and 'Negative_Manifest.csv' (the backup manifest).
+        Writes negatives subjects' metadata  into 'negative_subjects.csv' and the negative manifest, of which
+        'Negative_Manifest.xlsx' and 'Negative_Manifest.csv' (the backup manifest) are exported before uploading.
             negative_subjects_metadata_dicts: dictionaries corresponding to negative subjects' metadata rows
         """
         self.negative_csv.write_rows(negative_subjects_metadata_dicts, dict_writer=True)
         self.negative_manifest.write_rows(negative_subjects_metadata_dicts, dict_writer=True)
-        self.negative_manifest_csv.write_rows(negative_subjects_metadata_dicts, dict_writer=True)
 
     def upload(self):
         """
@@ -119,6 +123,10 @@ class CreateNegatives:
         """
         upload_subjects_to_zooniverse(negative_csv_path, negative_subject_set_id)
         self.gd.upload_folder(negative_subjects_folder, negative_folder_drive_id)
-        # push_files_to_GitHub(negative_manifest_path, negative_manifest_csv_path)  # TODO: UNCOMMENT
+        # (Every manifest is exported, such that the manifest store's database file is up to date with its views)
+        self.manifest_store.export()
+        # push_files_to_GitHub([manifest_db_path, negative_manifest_path,
+        #                       negative_manifest_csv_path])  # TODO: UNCOMMENT
+        self.gd.upload_file(manifest_db_path, databases_folder_drive_id, replace_existing=True)
         self.gd.upload_file(negative_manifest_path, manifests_folder_drive_id, replace_existing=True)
         self.gd.upload_file(negative_manifest_csv_path, manifests_csv_folder_drive_id, replace_existing=True)
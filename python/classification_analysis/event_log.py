@@ -0,0 +1,119 @@
+import os
+import json
+import numpy as np
+
+from python.vars.paths_and_ids import classification_event_log_folder
+
+# Ensuring that the current working directory is "CountertopDarkMatter"
+while os.getcwd()[-20:] != "CountertopDarkMatter":
+    os.chdir("..")
+
+
+class ClassificationEventLog:
+    """
+    Binary, columnar log of the classifications ingested from the Zooniverse export, such that analyses can scan
+    them without parsing any CSV. Each column is a file of fixed-width values, appended to during ingestion and
+    memory-mapped for reading:
+        classification_id (int64)
+        user (int32): index into 'users' (user IDs, or the user names of users not logged in)
+        subject (int32): index into 'subject_ids'
+        workflow_id (int32)
+        label (int8): 1 for a positive (first workflow, as converted for (k)SWAP) or tenebrite (second workflow)
+                      classification, 0 for a negative one, -1 if it was not recognized
+        created_at (int64): UTC seconds since the epoch (-1 if unknown)
+        subject_type (S1): first letter of the subject's '!subject_id' ('e', 's', 'n' or 'm')
+    The number of events and the interned users and subject IDs are saved to 'log.json' once the columns have been
+    appended; values past that number of events (left by an interrupted append) are ignored, and overwritten by the
+    next append.
+    Each classification is logged once: events whose classification ID is already in the log are skipped, such
+    that classifications processed again (eg. when the ingestion records were not updated) are not duplicated.
+    """
+    dtypes = {'classification_id': np.int64, 'user': np.int32, 'subject': np.int32, 'workflow_id': np.int32,
+              'label': np.int8, 'created_at': np.int64, 'subject_type': 'S1'}
+
+    def __init__(self, folder=classification_event_log_folder, chunk_size=1000):
+        """
+            chunk_size: number of events buffered before they are appended
+        """
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self.n_events = 0
+        self.users = []
+        self.subject_ids = []
+        self.buffer = []
+        # IDs of the logged (and buffered) classifications, read from the log when first needed
+        self.logged_ids = None
+        meta_path = os.path.join(folder, 'log.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            self.n_events, self.users, self.subject_ids = meta['n_events'], meta['users'], meta['subject_ids']
+        self.user_indices = dict((user, i) for i, user in enumerate(self.users))
+        self.subject_indices = dict((subject_id, i) for i, subject_id in enumerate(self.subject_ids))
+
+    def __len__(self):
+        return self.n_events + len(self.buffer)
+
+    def column_path(self, name):
+        return os.path.join(self.folder, name + '.bin')
+
+    @staticmethod
+    def intern(key, keys, indices):
+        try:
+            return indices[key]
+        except KeyError:
+            index = indices[key] = len(keys)
+            keys.append(key)
+            return index
+
+    def is_logged(self, classification_id):
+        if self.logged_ids is None:
+            self.logged_ids = set(self.column('classification_id').tolist())
+            self.logged_ids.update(event[0] for event in self.buffer)
+        return classification_id in self.logged_ids
+
+    def append(self, event):
+        """
+        Buffers an event, a tuple like (classification ID, user ID (or user name), subject ID, workflow ID, label,
+        created_at, subject type), unless its classification is already logged; the buffer is appended to the log
+        every 'chunk_size' events.
+        """
+        classification_id, user, subject_id, workflow_id, label, created_at, subject_type = event
+        if self.is_logged(classification_id):
+            return
+        self.logged_ids.add(classification_id)
+        self.buffer.append((classification_id, self.intern(user, self.users, self.user_indices),
+                            self.intern(subject_id, self.subject_ids, self.subject_indices), workflow_id, label,
+                            created_at, subject_type))
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Appends the buffered events to the column files, then saves the number of events and interned keys.
+        """
+        if not self.buffer:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        for name, values in zip(self.dtypes, zip(*self.buffer)):
+            values = np.array(values, dtype=self.dtypes[name])
+            with open(self.column_path(name), 'ab') as f:
+                f.truncate(self.n_events * values.itemsize)
+                f.write(values.tobytes())
+        self.n_events += len(self.buffer)
+        self.buffer = []
+        meta_path = os.path.join(self.folder, 'log.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'n_events': self.n_events, 'users': self.users, 'subject_ids': self.subject_ids}, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def column(self, name):
+        """
+        Returns a column of the (flushed) events, memory-mapped read-only.
+        """
+        if not self.n_events:
+            return np.zeros(0, dtype=self.dtypes[name])
+        return np.memmap(self.column_path(name), dtype=self.dtypes[name], mode='r', shape=(self.n_events,))
+
+    def columns(self):
+        return dict((name, self.column(name)) for name in self.dtypes)
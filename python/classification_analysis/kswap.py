@@ -1,15 +1,260 @@
 import os
 import csv
 import json
+import heapq
 import sqlite3
 import numpy as np
+from array import array
+from functools import partial
+from datetime import datetime, timezone
 from collections import Counter
-from panoptes_client import Panoptes, Workflow
-from panoptes_client import Subject as PanoptesSubject
+from concurrent.futures import ProcessPoolExecutor
 
-from python.vars.zooniverse_login import zooniverse_username, zooniverse_password
-# (Zooniverse username and password are expected to be found in the below os.environ variables)
-os.environ["PANOPTES_USERNAME"], os.environ["PANOPTES_PASSWORD"] = zooniverse_username, zooniverse_password
+from python.vars.paths_and_ids import retired_subjects_journal_path
+
+
+class UserHistory(object):
+    '''
+        Columnar record of the subjects a User classified: parallel arrays of subject IDs and the
+        version (index into User.score_versions) of the user's score after each classification.
+    '''
+    def __init__(self):
+        self.subject_id = array('q')
+        self.score_version = array('i')
+
+    def __len__(self):
+        return len(self.subject_id)
+
+    def append(self, subject_id, score_version):
+        self.subject_id.append(subject_id)
+        self.score_version.append(score_version)
+
+    def dump(self):
+        return json.dumps({'subject_id': self.subject_id.tolist(),
+                           'score_version': self.score_version.tolist()})
+
+    @classmethod
+    def load(cls, data):
+        history = cls()
+        history.subject_id.extend(data['subject_id'])
+        history.score_version.extend(data['score_version'])
+        return history
+
+
+class SubjectHistory(object):
+    '''
+        Columnar record of the classifications applied to a Subject: parallel arrays of classification IDs,
+        user indices (into kSWAP.user_ids), user score versions (into User.score_versions), submitted labels,
+        classification times (UTC seconds since the epoch, -1 if unknown) and the subject's posterior for each
+        class after the classification. User scores are referenced by version rather than copied into every entry.
+    '''
+    def __init__(self, classes):
+        self.classes = list(classes)
+        self.classification_id = array('q')
+        self.user_index = array('i')
+        self.score_version = array('i')
+        self.label = array('b')
+        self.created_at = array('q')
+        self.posterior = dict((c, array('d')) for c in self.classes)
+        self.n_saved = 0  # number of entries already written to the history store
+
+    def __len__(self):
+        return len(self.classification_id)
+
+    def append(self, classification_id, user_index, score_version, label, score, created_at=-1):
+        self.classification_id.append(classification_id)
+        self.user_index.append(user_index)
+        self.score_version.append(score_version)
+        self.label.append(label)
+        self.created_at.append(created_at)
+        for c in self.classes:
+            self.posterior[c].append(score[c])
+
+    def score(self, i):
+        return dict((c, self.posterior[c][i]) for c in self.classes)
+
+    def classification_ids_labelled(self, label):
+        '''
+            Returns the IDs of the classifications in which 'label' was submitted.
+        '''
+        return [cl_id for cl_id, cl_label in zip(self.classification_id, self.label) if cl_label == label]
+
+    def indices_of(self, classification_ids):
+        '''
+            Returns the (ordered) positions in the history of the given classification IDs.
+        '''
+        classification_ids = set(int(cl_id) for cl_id in classification_ids)
+        return [i for i, cl_id in enumerate(self.classification_id) if cl_id in classification_ids]
+
+    def dump(self):
+        columns = {'classification_id': self.classification_id.tolist(),
+                   'user_index': self.user_index.tolist(),
+                   'score_version': self.score_version.tolist(),
+                   'label': self.label.tolist(),
+                   'created_at': self.created_at.tolist()}
+        columns['posterior'] = dict((c, self.posterior[c].tolist()) for c in self.classes)
+        return json.dumps(columns)
+
+    @classmethod
+    def load(cls, data, classes):
+        history = cls(classes)
+        history.classification_id.extend(data['classification_id'])
+        history.user_index.extend(data['user_index'])
+        history.score_version.extend(data['score_version'])
+        history.label.extend(data['label'])
+        history.created_at.extend(data.get('created_at', [-1] * len(history)))
+        for c in history.classes:
+            history.posterior[c].extend(data['posterior'][c])
+        return history
+
+
+class SubjectHistoryStore(object):
+    '''
+        Subject histories saved in the kSWAP database's 'subject_history' table, one row per classification,
+        indexed by (subject_id, classification_id) and by (subject_id, created_at), such that the posteriors of
+        many subjects after a given classification or at a given time are queried without loading whole histories.
+    '''
+    def __init__(self, db_file, classes, timeout=10):
+        self.db_file = db_file
+        self.classes = list(classes)
+        self.timeout = timeout
+        self.posterior_columns = ['posterior_{}'.format(c) for c in self.classes]
+        self.columns = ['subject_id', 'position', 'classification_id', 'user_index', 'score_version', 'label',
+                        'created_at'] + self.posterior_columns
+
+    def connect(self):
+        return sqlite3.connect(self.db_file, timeout=self.timeout)
+
+    def create(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS subject_history ({}, PRIMARY KEY (subject_id, position))'
+                     .format(', '.join(self.columns)))
+        conn.execute('CREATE INDEX IF NOT EXISTS subject_history_classification_id '
+                     'ON subject_history (subject_id, classification_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS subject_history_created_at '
+                     'ON subject_history (subject_id, created_at)')
+
+    def rows(self, subject_id, history, start=0):
+        for i in range(start, len(history)):
+            yield (subject_id, i, history.classification_id[i], history.user_index[i], history.score_version[i],
+                   history.label[i], history.created_at[i] if history.created_at[i] >= 0 else None) + \
+                tuple(history.posterior[c][i] for c in self.classes)
+
+    def save(self, conn, subject_id, history):
+        '''
+            Writes the entries of the history that are not yet saved; a history that was not read from the store
+            replaces the subject's saved history. Returns the number of entries saved (to be set as
+            'history.n_saved' once committed).
+        '''
+        if history.n_saved == 0:
+            conn.execute('DELETE FROM subject_history WHERE subject_id = ?', (subject_id,))
+        conn.executemany('INSERT OR REPLACE INTO subject_history VALUES ({})'.format(','.join('?' * len(self.columns))),
+                         self.rows(subject_id, history, history.n_saved))
+        return len(history)
+
+    def to_history(self, rows):
+        history = SubjectHistory(self.classes)
+        for row in rows:
+            history.append(row[2], row[3], row[4], row[5], dict(zip(self.classes, row[7:])),
+                           -1 if row[6] is None else row[6])
+        history.n_saved = len(history)
+        return history
+
+    def load(self, subject_id, conn=None):
+        '''
+            Returns the subject's saved history (a SubjectHistory), or None if it has none.
+        '''
+        close = conn is None
+        conn = conn or self.connect()
+        rows = conn.execute('SELECT * FROM subject_history WHERE subject_id = ? ORDER BY position',
+                            (subject_id,)).fetchall()
+        if close:
+            conn.close()
+        return self.to_history(rows) if rows else None
+
+    def load_all(self, conn):
+        '''
+            Returns a dictionary like 'subject_id': SubjectHistory of every saved history, read in one scan.
+        '''
+        histories = {}
+        subject_rows, subject_id = [], None
+        for row in conn.execute('SELECT * FROM subject_history ORDER BY subject_id, position'):
+            if row[0] != subject_id and subject_rows:
+                histories[subject_id] = self.to_history(subject_rows)
+                subject_rows = []
+            subject_id = row[0]
+            subject_rows.append(row)
+        if subject_rows:
+            histories[subject_id] = self.to_history(subject_rows)
+        return histories
+
+    def trajectories(self, subject_ids, since=None, until=None):
+        '''
+            Yields (subject ID, SubjectHistory) for each of the given subjects, holding its posterior trajectory
+            between the times 'since' and 'until' (inclusive; datetimes or UTC seconds since the epoch, None for
+            no bound). Subjects are read one at a time, such that only one history is held in memory.
+        '''
+        conditions, bounds = '', []
+        if since is not None:
+            conditions += ' AND created_at >= ?'
+            bounds.append(to_timestamp(since))
+        if until is not None:
+            conditions += ' AND created_at <= ?'
+            bounds.append(to_timestamp(until))
+        conn = self.connect()
+        try:
+            for subject_id in subject_ids:
+                rows = conn.execute('SELECT * FROM subject_history WHERE subject_id = ?' + conditions +
+                                    ' ORDER BY position', [subject_id] + bounds).fetchall()
+                yield subject_id, self.to_history(rows)
+        finally:
+            conn.close()
+
+    def posteriors_at(self, subject_ids, classification_id=None, time=None):
+        '''
+            Returns a dictionary like 'subject_id': posterior (a dictionary like 'class': probability) of the given
+            subjects after the last of their classifications with an ID up to 'classification_id', or made up to
+            'time' (a datetime or UTC seconds since the epoch); subjects not classified by then are left out.
+        '''
+        if (classification_id is None) == (time is None):
+            raise ValueError('Exactly one of classification_id and time must be given.')
+        if classification_id is not None:
+            query = 'classification_id <= ? ORDER BY classification_id DESC'
+            bound = classification_id
+        else:
+            query = 'created_at <= ? ORDER BY created_at DESC, position DESC'
+            bound = to_timestamp(time)
+        query = 'SELECT {} FROM subject_history WHERE subject_id = ? AND {} LIMIT 1' \
+            .format(', '.join(self.posterior_columns), query)
+        posteriors = {}
+        conn = self.connect()
+        for subject_id in subject_ids:
+            row = conn.execute(query, (subject_id, bound)).fetchone()
+            if row is not None:
+                posteriors[subject_id] = dict(zip(self.classes, row))
+        conn.close()
+        return posteriors
+
+
+def to_timestamp(time):
+    '''
+        Converts a datetime (naive datetimes are taken to be UTC) to seconds since the epoch.
+    '''
+    if isinstance(time, datetime):
+        if time.tzinfo is None:
+            time = time.replace(tzinfo=timezone.utc)
+        return int(time.timestamp())
+    return time
+
+
+def parse_created_at(created_at):
+    '''
+        Converts a 'created_at' value of a classification CSV dump (eg. '2021-09-08 16:40:20 UTC') to UTC seconds
+        since the epoch; -1 if it is missing or malformed.
+    '''
+    try:
+        return int(datetime.fromisoformat(created_at[:19]).replace(tzinfo=timezone.utc).timestamp())
+    except (TypeError, ValueError):
+        return -1
 
 
 class User(object):
@@ -17,8 +262,10 @@ class User(object):
                  user_id,
                  classes,
                  gamma,
-                 user_default=None):
+                 user_default=None,
+                 index=None):
         self.user_id = user_id
+        self.index = index  # position of the user in kSWAP.user_ids
         self.classes = classes
         self.k = len(classes)
         self.gamma = gamma
@@ -27,7 +274,40 @@ class User(object):
         else:
             self.initialise_user_score()
         self.initialise_confusion_matrix()
-        self.history = [('_', self.user_score)]
+        # Every score the user has held; histories reference these by index ('version')
+        self.score_versions = [self.user_score]
+        self.history = UserHistory()
+
+    @property
+    def score_versions(self):
+        self.load_history()
+        return self._score_versions
+
+    @score_versions.setter
+    def score_versions(self, score_versions):
+        self._score_versions = score_versions
+
+    @property
+    def history(self):
+        self.load_history()
+        return self._history
+
+    @history.setter
+    def history(self, history):
+        self._history = history
+        self.history_loader = None
+
+    def load_history(self):
+        '''
+            Loads the score versions and history of a user restored from a snapshot, on first access.
+        '''
+        if self.history_loader is not None:
+            self._score_versions, self._history = self.history_loader()
+            self.history_loader = None
+
+    @property
+    def score_version(self):
+        return len(self.score_versions) - 1
 
     def initialise_confusion_matrix(self):
         self.confusion_matrix = {'matrix': [[0] * self.k for i in range(self.k)],
@@ -54,12 +334,24 @@ class User(object):
                 user_score[c_i][j] = (self.confusion_matrix['matrix'][i][j] + self.gamma) \
                                      / (self.confusion_matrix['n_gold'][i] + 2.0 * self.gamma)
         self.user_score = user_score
+        self.score_versions.append(user_score)
 
     def dump(self):
         return (self.user_id,
+                self.index,
                 json.dumps(self.user_score),
                 json.dumps(self.confusion_matrix),
-                json.dumps(self.history))
+                json.dumps(self.score_versions),
+                self.history.dump())
+
+
+def get_posterior(score, likelihood, epsilon):
+    '''
+        Returns the posterior (a list, in class order) of a subject of score 'score' (a list, in class order) after a
+        classification of the given likelihood (see 'Subject.update_posterior').
+    '''
+    denomenator = sum([l_c * s_c for s_c, l_c in zip(score, likelihood)])
+    return [(s_c * l_c) / (denomenator + epsilon) for s_c, l_c in zip(score, likelihood)]
 
 
 class Subject(object):
@@ -76,7 +368,7 @@ class Subject(object):
         self.subject_id = subject_id
         self.p0 = p0  # Custom Addition
         self.score = p0
-        self.classes = classes
+        self.classes = list(classes)
         self.k = len(self.classes)
         self.gold_label = gold_label
         self.epsilon = epsilon
@@ -84,23 +376,58 @@ class Subject(object):
         self.retired_as = None
         self.seen = 0
         self.posterior_to_prior = 1  # Custom Addition
-        self.history = [('_', '_', '_', '_', self.score, self.posterior_to_prior)]  # Custom Addition
-
-    def update_score(self, id, label, user):
-        score = {c: None for c in self.classes}
+        self.history = SubjectHistory(classes)  # Custom Addition
+        self.label_counts = Counter()  # Custom Addition (running count of each submitted label)
+
+    @property
+    def history(self):
+        # (The history of a subject restored from a snapshot is loaded on first access)
+        if self.history_loader is not None:
+            self._history = self.history_loader()
+            self.history_loader = None
+        return self._history
+
+    @history.setter
+    def history(self, history):
+        self._history = history
+        self.history_loader = None
+
+    def update_score(self, id, label, user, created_at=-1):
+        likelihood = [user.user_score[c][label] for c in self.classes]
+        self.update_posterior(id, user.index, user.score_version, label, likelihood, created_at)
+
+    def update_posterior(self, id, user_index, score_version, label, likelihood, created_at=-1):
+        '''
+            likelihood = for each class c, the probability that the classifying user submits 'label'
+                         given that the subject belongs to c (ie. user_score[c][label]).
+        '''
         if type(self.score) is str:
             self.score = json.loads(self.score)
-        denomenator = sum([user.user_score[c][label] * self.score[c] for c in self.classes])
-
-        for c in self.classes:
-            numerator = (self.score[c] * user.user_score[c][label])
-            score[c] = numerator / (denomenator + self.epsilon)
+        posterior = get_posterior([self.score[c] for c in self.classes], likelihood, self.epsilon)
+        self.add_posterior(id, user_index, score_version, label, dict(zip(self.classes, posterior)), created_at)
 
+    def add_posterior(self, id, user_index, score_version, label, score, created_at=-1):
+        '''
+            Records the subject's posterior 'score' (a dictionary like 'class': probability) after a classification
+            (see 'update_posterior').
+        '''
         self.score = score
         self.posterior_to_prior = self.score['1'] / self.p0['1']  # Custom Addition
-        self.history.append((id, user.user_id, user.user_score, label, self.score, self.posterior_to_prior))  # Custom Addition
+        self.history.append(id, user_index, score_version, label, self.score, created_at)  # Custom Addition
+        self.label_counts[label] += 1  # Custom Addition
         self.seen += 1
 
+    def get_score_list(self):
+        '''
+            Returns the subject's score as a list, in class order.
+        '''
+        score = json.loads(self.score) if type(self.score) is str else self.score
+        return [score[c] for c in self.classes]
+
+    def majority_label(self):
+        # (Ties go to the label received first, 'label_counts' being in first-received order)
+        return self.label_counts.most_common(1)[0][0]
+
     def dump(self):
         return (self.subject_id,
                 self.gold_label,
@@ -108,8 +435,7 @@ class Subject(object):
                 self.retired,
                 self.retired_as,
                 self.seen,
-                self.posterior_to_prior,  # Custom Addition
-                json.dumps(self.history))
+                self.posterior_to_prior)  # Custom Addition
 
 
 class Classification(object):
@@ -117,8 +443,10 @@ class Classification(object):
                  id,
                  user_id,
                  subject_id,
-                 annotation,
-                 label_map):
+                 annotation=None,
+                 label_map=None,
+                 label=None,
+                 created_at=-1):
 
         self.id = int(id)
         try:
@@ -127,7 +455,9 @@ class Classification(object):
             self.user_id = user_id
         self.subject_id = int(subject_id)
         self.label_map = label_map
-        self.label = self.parse(annotation)
+        # (An already-parsed 'label' is passed when classifications are rebuilt from a ClassificationTable)
+        self.label = self.parse(annotation) if label is None else label
+        self.created_at = created_at  # UTC seconds since the epoch (-1 if unknown)
 
     def parse(self, annotation):
         value = str(annotation[0]['value'])  # Custom Addition (str)
@@ -137,36 +467,268 @@ class Classification(object):
             raise ValueError('Annotation value {} not recognised.'.format(value))
 
 
+class ClassificationTable(object):
+    '''
+        Compact in-memory table of the classifications in a CSV dump that were made on the configured workflow,
+        parsed once: parallel arrays of classification IDs, users (indices into 'user_ids'), subject IDs, labels
+        and classification times.
+    '''
+    def __init__(self):
+        self.classification_id = array('q')
+        self.user = array('i')
+        self.subject_id = array('q')
+        self.label = array('b')
+        self.created_at = array('q')
+        self.user_ids = []
+        self.user_keys = {}
+
+    def __len__(self):
+        return len(self.classification_id)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.classification(i)
+
+    def append(self, cl):
+        try:
+            user = self.user_keys[cl.user_id]
+        except KeyError:
+            user = self.user_keys[cl.user_id] = len(self.user_ids)
+            self.user_ids.append(cl.user_id)
+        self.classification_id.append(cl.id)
+        self.user.append(user)
+        self.subject_id.append(cl.subject_id)
+        self.label.append(cl.label)
+        self.created_at.append(cl.created_at)
+
+    @classmethod
+    def from_event_log(cls, event_log, workflow, label_map, seen=None):
+        '''
+            Builds the table from a ClassificationEventLog (see 'event_log.py'), without parsing any CSV: the
+            events made on 'workflow' whose label is in 'label_map' (like Config.label_map), in the order they were
+            logged, leaving out the classifications whose IDs are in 'seen' (eg. 'kSWAP.seen'). Users are indexed
+            in the order they first classify, as by 'kSWAP.read_classifications'.
+        '''
+        table = cls()
+        columns = event_log.columns()
+        labels = columns['label'].astype(np.int16)
+        label_lookup = np.full(256, -1, dtype=np.int16)
+        for value, label in label_map.items():
+            label_lookup[int(value) + 128] = label
+        labels = label_lookup[labels + 128]
+        selected = (columns['workflow_id'] == workflow) & (labels >= 0)
+        if seen:
+            selected &= ~np.isin(columns['classification_id'], np.fromiter(seen, dtype=np.int64, count=len(seen)))
+        rows = np.flatnonzero(selected)
+        users = np.asarray(columns['user'])[rows]
+        unique_users, first_rows = np.unique(users, return_index=True)
+        user_order = unique_users[np.argsort(first_rows)]
+        user_remap = np.zeros(len(event_log.users), dtype=np.int32)
+        user_remap[user_order] = np.arange(len(user_order))
+        table.user_ids = [event_log.users[u] for u in user_order]
+        table.user_keys = dict((user_id, i) for i, user_id in enumerate(table.user_ids))
+        subject_ids = np.array(event_log.subject_ids, dtype=np.int64)
+        table.classification_id.frombytes(np.ascontiguousarray(columns['classification_id'][rows]).tobytes())
+        table.user.frombytes(user_remap[users].tobytes())
+        table.subject_id.frombytes(subject_ids[np.asarray(columns['subject'])[rows]].tobytes())
+        table.label.frombytes(labels[rows].astype(np.int8).tobytes())
+        table.created_at.frombytes(np.ascontiguousarray(columns['created_at'][rows]).tobytes())
+        return table
+
+    def classification(self, i):
+        return Classification(self.classification_id[i],
+                              self.user_ids[self.user[i]],
+                              self.subject_id[i],
+                              label=self.label[i],
+                              created_at=self.created_at[i])
+
+    def subject_indices(self, subject_ids):
+        '''
+            Returns the (ordered) row indices of the classifications made on the given subjects.
+        '''
+        subject_ids = set(subject_ids)
+        return [i for i, subject_id in enumerate(self.subject_id) if subject_id in subject_ids]
+
+
+class RetirementIndex(object):
+    '''
+        Incremental indexes of retirement candidates: a min-heap of subjects ordered by posterior-to-prior ratio
+        and a max-heap of subjects ordered by number of classifications seen. Heap entries are invalidated lazily;
+        an entry is current only if it matches the (ratio, seen) recorded for its subject in 'current'.
+    '''
+    def __init__(self):
+        self.by_posterior_to_prior = []  # heap of (posterior_to_prior, subject_id)
+        self.by_seen = []  # heap of (-seen, subject_id)
+        self.current = {}  # subject_id: (posterior_to_prior, seen)
+
+    def __len__(self):
+        return len(self.current)
+
+    def update(self, subject_id, posterior_to_prior, seen):
+        entry = (posterior_to_prior, seen)
+        if self.current.get(subject_id) == entry:
+            return
+        self.current[subject_id] = entry
+        heapq.heappush(self.by_posterior_to_prior, (posterior_to_prior, subject_id))
+        heapq.heappush(self.by_seen, (-seen, subject_id))
+        if len(self.by_posterior_to_prior) > 2 * len(self.current) + 64:
+            self.compact()
+
+    def remove(self, subject_id):
+        self.current.pop(subject_id, None)
+
+    def compact(self):
+        '''
+            Rebuilds the heaps from the current entries, dropping stale ones.
+        '''
+        self.by_posterior_to_prior = [(e[0], subject_id) for subject_id, e in self.current.items()]
+        self.by_seen = [(-e[1], subject_id) for subject_id, e in self.current.items()]
+        heapq.heapify(self.by_posterior_to_prior)
+        heapq.heapify(self.by_seen)
+
+    def pop_while(self, heap, is_candidate, is_current):
+        '''
+            Returns the (ordered) IDs of the subjects at the top of 'heap' that satisfy 'is_candidate',
+            leaving their entries in the heap.
+        '''
+        popped, subject_ids, seen_subject_ids = [], [], set()
+        while heap and is_candidate(heap[0][0]):
+            key, subject_id = heapq.heappop(heap)
+            if subject_id in self.current and is_current(key, self.current[subject_id]) \
+                    and subject_id not in seen_subject_ids:
+                popped.append((key, subject_id))
+                subject_ids.append(subject_id)
+                seen_subject_ids.add(subject_id)
+        for entry in popped:
+            heapq.heappush(heap, entry)
+        return subject_ids
+
+    def candidates(self, threshold, retirement_limit):
+        '''
+            Returns the IDs of subjects whose posterior-to-prior ratio is below 'threshold', followed by those of
+            subjects that have been seen at least 'retirement_limit' times.
+        '''
+        below_threshold = self.pop_while(self.by_posterior_to_prior, lambda key: key < threshold,
+                                         lambda key, entry: key == entry[0])
+        past_limit = self.pop_while(self.by_seen, lambda key: -key >= retirement_limit,
+                                    lambda key, entry: -key == entry[1])
+        below_threshold_ids = set(below_threshold)
+        return below_threshold + [subject_id for subject_id in past_limit if subject_id not in below_threshold_ids]
+
+
+# Frozen user scores shared (read-only) by the workers of 'kSWAP.process_classifications_sharded'
+_shard_likelihoods, _shard_user_index, _shard_score_version = None, None, None
+
+
+def init_shard_worker(likelihoods, user_index, score_version):
+    '''
+        likelihoods = array such that likelihoods[u][label] lists, for each class, the probability that
+                      table user u submits 'label' (ie. user_score[c][label])
+        user_index, score_version = kSWAP user index and user score version of each table user
+    '''
+    global _shard_likelihoods, _shard_user_index, _shard_score_version
+    _shard_likelihoods = likelihoods.tolist()
+    _shard_user_index, _shard_score_version = user_index, score_version
+
+
+def score_shard(scores, users, subject_ids, labels):
+    '''
+        Scores, in order, the given classifications (parallel lists) of a shard of subjects, starting from their
+        scores, a dictionary like 'subject_id': (score, epsilon) with scores listed in class order; returns the
+        posterior (in class order) of the classified subject after each classification.
+    '''
+    posteriors = []
+    for u, subject_id, label in zip(users, subject_ids, labels):
+        score, epsilon = scores[subject_id]
+        score = get_posterior(score, _shard_likelihoods[u][label], epsilon)
+        scores[subject_id] = score, epsilon
+        posteriors.append(score)
+    return posteriors
+
+
+def load_user_history(db_file, user_id):
+    '''
+        Reads a user's score versions and history from the kSWAP database (see 'kSWAP.load_snapshot').
+    '''
+    conn = sqlite3.connect(db_file)
+    score_versions, history = conn.execute('SELECT score_versions, history FROM users WHERE user_id = ?',
+                                           (user_id,)).fetchone()
+    conn.close()
+    return json.loads(score_versions), UserHistory.load(json.loads(history))
+
+
+def load_subject_history(db_file, subject_id, classes):
+    '''
+        Reads a subject's history from the kSWAP database's history store (see 'kSWAP.load_snapshot').
+    '''
+    conn = sqlite3.connect(db_file)
+    history = SubjectHistoryStore(db_file, classes).load(subject_id, conn)
+    if history is None:
+        # (Histories saved before the history store are in the subjects table)
+        saved_history, = conn.execute('SELECT history FROM subjects WHERE subject_id = ?', (subject_id,)).fetchone()
+        history = SubjectHistory.load(json.loads(saved_history), classes) if saved_history \
+            else SubjectHistory(classes)
+    conn.close()
+    return history
+
+
 class kSWAP(object):
     def __init__(self,
                  config=None,
                  timeout=10):
         self.users = {}
+        self.user_ids = []  # user IDs by user index (see 'get_user')
         self.subjects = {}
+        self.retirement_index = RetirementIndex()
         self.objects = {}
         self.config = config
         self.last_id = 0
         self.seen = set([])
         self.db_exists = False
         self.timeout = timeout  # wait x seconds to acquire db connection
+        # The Panoptes workflow is only needed to retire subjects; it is connected to lazily (see 'workflow')
+        self._workflow = None
         try:
             self.create_db()
             self.save()
         except sqlite3.OperationalError:
             self.db_exists = True
 
+    @property
+    def workflow(self):
+        """
+        The Panoptes workflow that subjects are retired from; connecting to Zooniverse on first access only,
+        such that loading, running and saving kSWAP offline requires no network access.
+        """
+        if self._workflow is None:
+            self._workflow = self.connect_panoptes()
+        return self._workflow
+
+    def connect_panoptes(self):
+        from panoptes_client import Workflow
+        self.login_panoptes()
+        return Workflow.find(self.config.workflow)
+
+    @staticmethod
+    def login_panoptes():
+        from panoptes_client import Panoptes
+        from python.vars.zooniverse_login import zooniverse_username, zooniverse_password
+        # (Zooniverse username and password are expected to be found in the below os.environ variables)
+        os.environ["PANOPTES_USERNAME"], os.environ["PANOPTES_PASSWORD"] = zooniverse_username, zooniverse_password
         Panoptes.connect(username=os.environ["PANOPTES_USERNAME"],
                          password=os.environ["PANOPTES_PASSWORD"])
 
-        self.workflow = Workflow.find(config.workflow)
-
     def connect_db(self):
         return sqlite3.connect(self.config.db_path + self.config.db_name, timeout=self.timeout)
 
+    def history_store(self):
+        return SubjectHistoryStore(self.config.db_path + self.config.db_name, self.config.label_map.keys(),
+                                   timeout=self.timeout)
+
     def create_db(self):
         conn = self.connect_db()
-        conn.execute('CREATE TABLE users (user_id PRIMARY KEY, user_score, ' + \
-                     'confusion_matrix, history)')
+        conn.execute('CREATE TABLE users (user_id PRIMARY KEY, user_index, user_score, ' + \
+                     'confusion_matrix, score_versions, history)')
 
         conn.execute('CREATE TABLE subjects (subject_id PRIMARY KEY, ' + \
                      'gold_label, score, retired, retired_as, seen, posterior_to_prior, history)')  # Custom Addition
@@ -177,19 +739,75 @@ class kSWAP(object):
                      'workflow, p0, gamma, retirement_limit, db_path, ' + \
                      'db_name, timeout, last_id, seen)')
 
+        self.history_store().create(conn)
+
         conn.close()
 
+    def migrate_db(self, conn):
+        """
+        Adds the columns introduced with the columnar user/subject histories, and the subject history store, to
+        databases created before them.
+        """
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(users)')]
+        for column in ['user_index', 'score_versions']:
+            if column not in columns:
+                conn.execute('ALTER TABLE users ADD COLUMN {}'.format(column))
+        self.history_store().create(conn)
+        conn.commit()
+
+    def get_user(self, user_id):
+        """
+        Returns the User with the given ID, creating it (and assigning it the next user index) if it is unknown.
+        """
+        try:
+            return self.users[user_id]
+        except KeyError:
+            self.users[user_id] = User(user_id=user_id,
+                                       classes=self.config.label_map.keys(),
+                                       gamma=self.config.gamma,
+                                       user_default=self.config.user_default,
+                                       index=len(self.user_ids))
+            self.user_ids.append(user_id)
+            return self.users[user_id]
+
     def load_users(self, users):
+        users = sorted(users, key=lambda u: (u['user_index'] is None, u['user_index'] or 0))
         for user in users:
             user_score = json.loads(user['user_score'])
             self.users[user['user_id']] = User(user_id=user['user_id'],
                                                classes=self.config.label_map.keys(),
                                                gamma=self.config.gamma,
-                                               user_default=user_score)
+                                               user_default=user_score,
+                                               index=len(self.user_ids))
+            self.user_ids.append(user['user_id'])
             self.users[user['user_id']].confusion_matrix = json.loads(user['confusion_matrix'])
-            self.users[user['user_id']].history = json.loads(user['history'])
-
-    def load_subjects(self, subjects):
+            history = json.loads(user['history'])
+            if type(history) is list:
+                self.load_legacy_user_history(self.users[user['user_id']], history)
+            else:
+                self.users[user['user_id']].score_versions = json.loads(user['score_versions'])
+                self.users[user['user_id']].history = UserHistory.load(history)
+
+    @staticmethod
+    def load_legacy_user_history(user, history):
+        """
+        Converts a user history saved as a list of (subject ID, user score) pairs into columnar form,
+        collapsing the copied user scores into score versions.
+        """
+        user.score_versions = []
+        for subject_id, user_score in history:
+            if not user.score_versions or user.score_versions[-1] != user_score:
+                user.score_versions.append(user_score)
+            if subject_id != '_':
+                user.history.append(subject_id, user.score_version)
+        if not user.score_versions or user.score_versions[-1] != user.user_score:
+            user.score_versions.append(user.user_score)
+
+    def load_subjects(self, subjects, histories=None):
+        """
+            histories: dictionary like 'subject_id': SubjectHistory of the histories in the history store
+        """
+        histories = histories or {}
         for subject in subjects:
             self.subjects[subject['subject_id']] = Subject(subject_id=subject['subject_id'],
                                                            classes=self.config.label_map.keys(),
@@ -200,7 +818,72 @@ class kSWAP(object):
             self.subjects[subject['subject_id']].retired_as = subject['retired_as']
             self.subjects[subject['subject_id']].seen = subject['seen']
             self.subjects[subject['subject_id']].posterior_to_prior = subject['posterior_to_prior']  # Custom Addition
-            self.subjects[subject['subject_id']].history = json.loads(subject['history'])
+            if subject['history'] is None:
+                history = histories.get(subject['subject_id'], SubjectHistory(self.config.label_map.keys()))
+            else:
+                # (Histories saved before the history store are in the subjects table; they are moved on saving)
+                history = json.loads(subject['history'])
+                if type(history) is list:
+                    history = self.load_legacy_subject_history(history)
+                else:
+                    history = SubjectHistory.load(history, self.config.label_map.keys())
+            self.subjects[subject['subject_id']].history = history
+            self.subjects[subject['subject_id']].label_counts = Counter(history.label)
+            self.index_subject(self.subjects[subject['subject_id']])
+
+    def load_legacy_subject_history(self, history):
+        """
+        Converts a subject history saved as a list of (classification ID, user ID, user score, label, score,
+        posterior-to-prior) tuples into columnar form, referencing user scores by version.
+        """
+        columnar_history = SubjectHistory(self.config.label_map.keys())
+        for cl_id, user_id, user_score, label, score, posterior_to_prior in history:
+            if cl_id == '_':
+                # Placeholder entry holding the prior
+                continue
+            user = self.get_user(user_id)
+            try:
+                score_version = user.score_versions.index(user_score)
+            except ValueError:
+                score_version = user.score_version
+            columnar_history.append(cl_id, user.index, score_version, label, score)
+        return columnar_history
+
+    def history_rows(self, subject, classification_ids=None):
+        """
+        Returns the subject's history as a list of (classification ID, user ID, user score, label, score,
+        posterior-to-prior) tuples, restricted to the given classification IDs if any are passed.
+        """
+        history = subject.history
+        if classification_ids is None:
+            indices = range(len(history))
+        else:
+            indices = history.indices_of(classification_ids)
+        rows = []
+        for i in indices:
+            user_id = self.user_ids[history.user_index[i]]
+            user_score = self.users[user_id].score_versions[history.score_version[i]]
+            score = history.score(i)
+            rows.append((history.classification_id[i], user_id, user_score, history.label[i], score,
+                         score['1'] / subject.p0['1']))
+        return rows
+
+    def posterior_trajectories(self, subject_ids, since=None, until=None):
+        """
+        Yields (subject ID, SubjectHistory) for each of the given subjects, from the history store (ie. as of the
+        last save), restricted to the classifications made between 'since' and 'until' if given; subjects are
+        read one at a time (see 'SubjectHistoryStore.trajectories').
+        """
+        return self.history_store().trajectories(subject_ids, since, until)
+
+    def posteriors_at(self, subject_ids, classification_id=None, time=None):
+        """
+        Returns a dictionary like 'subject_id': posterior (a dictionary like 'class': probability) of the given
+        subjects, as of the last save, after the classification with ID 'classification_id' (or the last
+        classification before it) or at 'time'; subjects not yet classified by then have their prior.
+        """
+        posteriors = self.history_store().posteriors_at(subject_ids, classification_id, time)
+        return dict((subject_id, posteriors.get(subject_id, dict(self.config.p0))) for subject_id in subject_ids)
 
     def load(self):
         def it(rows):
@@ -208,6 +891,7 @@ class kSWAP(object):
                 yield dict(item)
 
         conn = self.connect_db()
+        self.migrate_db(conn)
         conn.row_factory = sqlite3.Row
         c = conn.cursor()
 
@@ -224,24 +908,150 @@ class kSWAP(object):
         swap.load_users(it(c.fetchall()))
 
         c.execute('SELECT * FROM subjects')
-        swap.load_subjects(it(c.fetchall()))
+        swap.load_subjects(it(c.fetchall()), self.history_store().load_all(conn))
 
         conn.close()
 
         return swap
 
-    def dump_users(self):
+    def save_snapshot(self, user_ids=None, subject_ids=None):
+        """
+        Saves the state to the database (which deletes any previous snapshot), then writes a binary snapshot
+        ('.npz') of the current user scores and confusion matrices, subject scores and retirement states, seen
+        classification IDs and ID maps, from which 'load_snapshot' restores kSWAP without reading the histories.
+            user_ids, subject_ids: as in 'save'
+        """
+        self.save(user_ids, subject_ids)
+        classes = list(self.config.label_map.keys())
+        labels = sorted(self.config.label_map.values())
+        users = [self.users[user_id] for user_id in self.user_ids]
+        subjects = list(self.subjects.values())
+        snapshot = {
+            'last_id': np.array(self.last_id, dtype=np.int64),
+            'seen': np.fromiter(self.seen, dtype=np.int64, count=len(self.seen)),
+            # User IDs are ints, or strings for users that were not logged in
+            'user_ids': np.array([str(user_id) for user_id in self.user_ids]),
+            'user_id_is_int': np.array([type(user_id) is int for user_id in self.user_ids], dtype=bool),
+            'user_scores': np.array([[user.user_score[c] for c in classes] for user in users],
+                                    dtype=np.float64).reshape(len(users), len(classes), len(labels)),
+            'confusion_matrices': np.array([user.confusion_matrix['matrix'] for user in users],
+                                           dtype=np.int64).reshape(len(users), len(classes), len(labels)),
+            'n_gold': np.array([user.confusion_matrix['n_gold'] for user in users],
+                               dtype=np.int64).reshape(len(users), len(classes)),
+            'subject_ids': np.array([subject.subject_id for subject in subjects], dtype=np.int64),
+            'gold_labels': np.array([subject.gold_label for subject in subjects], dtype=np.int64),
+            'scores': np.array([[subject.score[c] for c in classes] for subject in subjects],
+                               dtype=np.float64).reshape(len(subjects), len(classes)),
+            'retired': np.array([bool(subject.retired) for subject in subjects], dtype=bool),
+            # (-1 for subjects that are not retired)
+            'retired_as': np.array([-1 if subject.retired_as is None else subject.retired_as
+                                    for subject in subjects], dtype=np.int64),
+            'seen_counts': np.array([subject.seen for subject in subjects], dtype=np.int64),
+            'posterior_to_prior': np.array([subject.posterior_to_prior for subject in subjects], dtype=np.float64),
+            'label_counts': np.array([[subject.label_counts[label] for label in labels] for subject in subjects],
+                                     dtype=np.int64).reshape(len(subjects), len(labels)),
+            # Labels in the order each subject first received them (padded with -1), by which 'majority_label'
+            # breaks ties
+            'label_orders': np.array([list(subject.label_counts) + [-1] * (len(labels) - len(subject.label_counts))
+                                      for subject in subjects], dtype=np.int64).reshape(len(subjects), len(labels)),
+        }
+        snapshot_file = self.config.db_path + self.config.snapshot_name
+        # (Written to a temporary file first, such that an interrupted save leaves the previous snapshot intact)
+        with open(snapshot_file + '.tmp', 'wb') as f:
+            np.savez(f, **snapshot)
+        os.replace(snapshot_file + '.tmp', snapshot_file)
+
+    def load_snapshot(self):
+        """
+        Restores kSWAP from the snapshot written by 'save_snapshot'; user and subject histories stay in the
+        database and are read only when accessed. Falls back to 'load' if there is no snapshot (every 'save' deletes
+        it), or if it does not match the database's last classification ID.
+        """
+        snapshot_file = self.config.db_path + self.config.snapshot_name
+        db_file = self.config.db_path + self.config.db_name
+        if not os.path.exists(snapshot_file):
+            return self.load()
+        conn = self.connect_db()
+        self.migrate_db(conn)
+        timeout, last_id = conn.execute('SELECT timeout, last_id FROM config').fetchone()
+        conn.close()
+        with np.load(snapshot_file) as snapshot:
+            snapshot = dict(snapshot)
+        if int(snapshot['last_id']) != last_id:
+            print('Snapshot is out of date with the database; loading from the database.')
+            return self.load()
+        if 'label_orders' not in snapshot:
+            print('Snapshot does not record the order of subject labels; loading from the database.')
+            return self.load()
+
+        swap = kSWAP(config=self.config,
+                     timeout=timeout)
+        swap.last_id = last_id
+        swap.seen = set(snapshot['seen'].tolist())
+
+        classes = list(self.config.label_map.keys())
+        user_ids = [int(user_id) if is_int else user_id for user_id, is_int
+                    in zip(snapshot['user_ids'].tolist(), snapshot['user_id_is_int'].tolist())]
+        for user_id, user_score, matrix, n_gold in zip(user_ids, snapshot['user_scores'].tolist(),
+                                                       snapshot['confusion_matrices'].tolist(),
+                                                       snapshot['n_gold'].tolist()):
+            user = swap.get_user(user_id)
+            user.user_score = dict(zip(classes, user_score))
+            user.confusion_matrix = {'matrix': matrix, 'n_gold': n_gold}
+            user.history_loader = partial(load_user_history, db_file, user_id)
+
+        labels = sorted(self.config.label_map.values())
+        subject_columns = zip(snapshot['subject_ids'].tolist(), snapshot['gold_labels'].tolist(),
+                              snapshot['scores'].tolist(), snapshot['retired'].tolist(),
+                              snapshot['retired_as'].tolist(), snapshot['seen_counts'].tolist(),
+                              snapshot['posterior_to_prior'].tolist(), snapshot['label_counts'].tolist(),
+                              snapshot['label_orders'].tolist())
+        for (subject_id, gold_label, score, retired, retired_as, seen, posterior_to_prior, label_counts,
+             label_order) in subject_columns:
+            subject = Subject(subject_id=subject_id,
+                              classes=classes,
+                              p0=self.config.p0,
+                              gold_label=gold_label)
+            subject.score = dict(zip(classes, score))
+            subject.retired = retired
+            subject.retired_as = None if retired_as == -1 else retired_as
+            subject.seen = seen
+            subject.posterior_to_prior = posterior_to_prior
+            # (In first-received order, as when counted from the history; see 'Subject.majority_label')
+            label_counts = dict(zip(labels, label_counts))
+            subject.label_counts = Counter(dict((label, label_counts[label]) for label in label_order if label != -1))
+            subject.history_loader = partial(load_subject_history, db_file, subject_id, classes)
+            swap.subjects[subject_id] = subject
+            swap.index_subject(subject)
+
+        return swap
+
+    def dump_users(self, user_ids=None):
         users = []
-        for u in self.users.keys():
-            users.append(self.users[u].dump())
+        for u in (self.users.keys() if user_ids is None else user_ids):
+            if self.users[u].history_loader is None:
+                users.append(self.users[u].dump())
         return users
 
-    def dump_subjects(self):
+    def dump_subjects(self, subject_ids=None):
         subjects = []
-        for s in self.subjects.keys():
-            subjects.append(self.subjects[s].dump())
+        for s in (self.subjects.keys() if subject_ids is None else subject_ids):
+            if self.subjects[s].history_loader is None:
+                subjects.append(self.subjects[s].dump())
         return subjects
 
+    def dump_unloaded_users(self, user_ids=None):
+        # (Users restored from a snapshot whose histories were never loaded; their saved histories are kept)
+        users = self.users.values() if user_ids is None else [self.users[u] for u in user_ids]
+        return [(user.index, json.dumps(user.user_score), json.dumps(user.confusion_matrix), user.user_id)
+                for user in users if user.history_loader is not None]
+
+    def dump_unloaded_subjects(self, subject_ids=None):
+        subjects = self.subjects.values() if subject_ids is None else [self.subjects[s] for s in subject_ids]
+        return [(subject.gold_label, json.dumps(subject.score), subject.retired, subject.retired_as, subject.seen,
+                 subject.posterior_to_prior, subject.subject_id)
+                for subject in subjects if subject.history_loader is not None]
+
     def dump_objects(self):
         objects = []
         for o in self.objects.keys():
@@ -255,34 +1065,56 @@ class kSWAP(object):
                 self.config.db_name, self.timeout, self.last_id,
                 json.dumps(list(self.seen)))
 
-    def save(self):
+    def save(self, user_ids=None, subject_ids=None):
+        """
+        Saves the state to the database.
+            user_ids, subject_ids: if given, only these users and subjects are saved (eg. those changed since the
+                                   last save, see 'OnlineSWAP.checkpoint'); all of them otherwise
+        """
+        # The snapshot no longer matches the saved state (retirements and golds change it without new
+        # classifications); it is deleted before the database is written, such that it can never be loaded over it
+        snapshot_file = self.config.db_path + self.config.snapshot_name
+        if os.path.exists(snapshot_file):
+            os.remove(snapshot_file)
         conn = self.connect_db()
+        self.migrate_db(conn)
         c = conn.cursor()
 
         def zip_name(data):
             return [d.values() for d in data]
 
-        c.executemany('INSERT OR REPLACE INTO users VALUES (?,?,?,?)',
-                      self.dump_users())
+        c.executemany('INSERT OR REPLACE INTO users (user_id, user_index, user_score, confusion_matrix, '
+                      'score_versions, history) VALUES (?,?,?,?,?,?)',
+                      self.dump_users(user_ids))
+
+        c.executemany('UPDATE users SET user_index = ?, user_score = ?, confusion_matrix = ? WHERE user_id = ?',
+                      self.dump_unloaded_users(user_ids))
+
+        c.executemany('INSERT OR REPLACE INTO subjects (subject_id, gold_label, score, retired, retired_as, seen, '
+                      'posterior_to_prior, history) VALUES (?,?,?,?,?,?,?,NULL)',
+                      self.dump_subjects(subject_ids))
+
+        # Appending the history entries made since the last save to the history store
+        history_store = self.history_store()
+        subjects = self.subjects.values() if subject_ids is None else [self.subjects[s] for s in subject_ids]
+        n_saved = [(subject.history, history_store.save(conn, subject.subject_id, subject.history))
+                   for subject in subjects if subject.history_loader is None]
 
-        c.executemany('INSERT OR REPLACE INTO subjects VALUES (?,?,?,?,?,?,?,?)',
-                      self.dump_subjects())
+        c.executemany('UPDATE subjects SET gold_label = ?, score = ?, retired = ?, retired_as = ?, seen = ?, '
+                      'posterior_to_prior = ? WHERE subject_id = ?',
+                      self.dump_unloaded_subjects(subject_ids))
 
         c.execute('INSERT OR REPLACE INTO config VALUES (?,?,?,?,?,?,?,?,?,?,?)',
                   self.dump_config())
 
         conn.commit()
         conn.close()
+        for history, n in n_saved:
+            history.n_saved = n
 
     def process_classification(self, cl, online=False):
         # check user is known
-        try:
-            self.users[cl.user_id]
-        except KeyError:
-            self.users[cl.user_id] = User(user_id=cl.user_id,
-                                          classes=self.config.label_map.keys(),
-                                          gamma=self.config.gamma,
-                                          user_default=self.config.user_default)
+        self.get_user(cl.user_id)
         # check subject is known
         try:
             self.subjects[cl.subject_id]
@@ -291,91 +1123,206 @@ class kSWAP(object):
                                                    p0=self.config.p0,
                                                    classes=self.config.label_map.keys())
 
-        self.subjects[cl.subject_id].update_score(cl.id, cl.label, self.users[cl.user_id])
+        self.subjects[cl.subject_id].update_score(cl.id, cl.label, self.users[cl.user_id], cl.created_at)
+        self.index_subject(self.subjects[cl.subject_id])
 
         if self.subjects[cl.subject_id].gold_label in self.config.label_map.values() and online:
             gold_label = self.subjects[cl.subject_id].gold_label
             assert gold_label in self.config.label_map.values()
             self.users[cl.user_id].update_user_score(gold_label, cl.label)
-        self.users[cl.user_id].history.append((cl.subject_id, self.users[cl.user_id].user_score))
+        self.users[cl.user_id].history.append(cl.subject_id, self.users[cl.user_id].score_version)
         self.last_id = cl.id
         self.seen.add(cl.id)
 
-    def retire(self, subject_batch):
-
-        def majority_vote(sequence):
-            occurence_count = Counter(sequence)
-            return occurence_count.most_common(1)[0][0]
+    def index_subject(self, subject):
+        """
+        Updates the subject's entries in the retirement index; gold and retired subjects are never candidates.
+        """
+        if subject.retired or subject.gold_label in self.config.label_map.values():
+            self.retirement_index.remove(subject.subject_id)
+        else:
+            self.retirement_index.update(subject.subject_id, subject.posterior_to_prior, subject.seen)
+
+    def retire(self, subject_batch=None):
+        """
+        Retires the subjects whose posterior-to-prior ratio fell below the threshold (as 0) or that reached the
+        retirement limit (as their majority label); candidates are pulled from the retirement index.
+            subject_batch: if given, only subjects with these IDs are considered
+        """
+        candidates = self.retirement_index.candidates(self.config.thresholds[0], self.config.retirement_limit)
+        if subject_batch is not None:
+            subject_batch = set(subject_batch)
+            for subject_id in subject_batch - self.subjects.keys():
+                print('Subject {} is missing.'.format(subject_id))
+            candidates = [subject_id for subject_id in candidates if subject_id in subject_batch]
 
         to_retire = []
-        for subject_id in subject_batch:
-            try:
-                subject = self.subjects[subject_id]
-            except KeyError:
-                print('Subject {} is missing.'.format(subject_id))
-                continue
-            if subject.gold_label in self.config.label_map.keys():
-                # if this is a gold standard image never retire
-                continue
+        for subject_id in candidates:
+            subject = self.subjects[subject_id]
 
             # Custom Addition
             if subject.posterior_to_prior < self.config.thresholds[0]:
                 subject.retired = True
                 subject.retired_as = 0
-                to_retire.append(subject_id)
 
             # for c in self.config.label_map.keys():
             #     label = self.config.label_map[c]
             #     if subject.score[c] < self.config.thresholds[label]:
             #         subject.retired = True
             #         subject.retired_as = label
-            #         to_retire.append(subject_id)
 
             if subject.seen >= self.config.retirement_limit:
                 subject.retired = True
-                subject.retired_as = majority_vote([h[2+1] for h in subject.history])
-                to_retire.append(subject_id)
+                subject.retired_as = subject.majority_label()
+            to_retire.append(subject_id)
+            self.index_subject(subject)
         return to_retire
 
-    def send_panoptes(self, subject_batch):
-        subjects = []
-        for subject_id in subject_batch:
-            subjects.append(PanoptesSubject().find(subject_id))
-        self.workflow.retire_subjects(subjects)
-
-    def process_classifications_from_csv_dump(self, path, online=False):
+    def send_panoptes(self, subject_batch, journal_path=retired_subjects_journal_path):
+        """
+        Retires the subjects on Zooniverse in concurrent batches (see 'RetirementClient'), logging in to
+        Panoptes if need be; returns lists of the subject IDs retired and of those that failed to be.
+            journal_path: CSV recording retired subjects, such that an interrupted retirement can be resumed
+                          (None to not keep one)
+        """
+        from panoptes_client import Panoptes
+        from python.utils.retirement_utils import RetirementClient
+        if self._workflow is None:
+            # (Only the connection is needed, not the workflow itself)
+            self.login_panoptes()
+        client = Panoptes.client()
+        retirement_client = RetirementClient(self.config.workflow, endpoint=client.endpoint,
+                                             token=client.get_bearer_token(), journal_path=journal_path)
+        return retirement_client.retire_subjects(subject_batch)
+
+    def parse_row(self, row):
+        """
+        Returns the Classification in a row of a classification CSV dump, or None if the row was made on a
+        different workflow than configured or its annotation value is not recognized.
+        """
+        return self.parse_classification(row, self.config.workflow, self.config.label_map)
+
+    @staticmethod
+    def parse_classification(row, workflow, label_map):
+        """
+        'parse_row' for the given workflow ID and label map, such that dumps can be parsed without a kSWAP (and
+        so without its database).
+        """
+        id = int(row['classification_id'])
+        try:
+            assert int(row['workflow_id']) == workflow
+            # TODO: Uncomment below after beta
+            # # ignore repeat classifications of the same subject
+            # if json.loads(row['metadata'])['seen_before']:
+            #     continue
+        except KeyError as e:
+            print('Workflow not recognized.', row)
+            pass
+        except AssertionError as e:
+            print("Different workflow than configured.", row)
+            return None
+        try:
+            user_id = int(row['user_id'])
+        except ValueError:
+            user_id = row['user_name']
+        subject_id = int(row['subject_ids'])
+        annotation = json.loads(row['annotations'])
+        try:
+            return Classification(id,
+                                  user_id,
+                                  subject_id,
+                                  annotation,
+                                  label_map=label_map,
+                                  created_at=parse_created_at(row.get('created_at')))
+        except ValueError as e:
+            print('Classification value error.')
+            return None
+
+    def read_classifications(self, path):
+        """
+        Reads and parses a classification CSV dump (once) into a ClassificationTable.
+        """
+        return self.read_classification_dump(path, self.config.workflow, self.config.label_map)
+
+    @classmethod
+    def read_classification_dump(cls, path, workflow, label_map):
+        """
+        'read_classifications' for the given workflow ID and label map, without a kSWAP (nor its database).
+        """
+        table = ClassificationTable()
         with open(path, 'r') as csvdump:
             reader = csv.DictReader(csvdump)
             for row in reader:
-                id = int(row['classification_id'])
-                try:
-                    assert int(row['workflow_id']) == self.config.workflow
-                    # TODO: Uncomment below after beta
-                    # # ignore repeat classifications of the same subject
-                    # if json.loads(row['metadata'])['seen_before']:
-                    #     continue
-                except KeyError as e:
-                    print('Workflow not recognized.', row)
-                    pass
-                except AssertionError as e:
-                    print("Different workflow than configured.", row)
-                    continue
-                try:
-                    user_id = int(row['user_id'])
-                except ValueError:
-                    user_id = row['user_name']
-                subject_id = int(row['subject_ids'])
-                annotation = json.loads(row['annotations'])
-                try:
-                    cl = Classification(id,
-                                        user_id,
-                                        subject_id,
-                                        annotation,
-                                        label_map=self.config.label_map)
-                except ValueError as e:
-                    print('Classification value error.')
+                cl = cls.parse_classification(row, workflow, label_map)
+                if cl is not None:
+                    table.append(cl)
+        return table
+
+    def process_classifications(self, table, online=False):
+        for cl in table:
+            self.process_classification(cl, online)
+
+    def process_classifications_sharded(self, table, n_workers=None, n_shards=None):
+        """
+        Offline scoring on a process pool. User scores are frozen once the golds are applied, so subjects can be
+        scored independently: subjects are partitioned into 'n_shards' shards (by subject ID), each shard is scored
+        against a shared read-only array of user scores, and the results are merged back into the kSWAP state.
+        Equivalent to 'process_classifications(table, online=False)'. Only the subjects' current scores are sent
+        to the workers, which return the posteriors after each classification (the histories being appended to
+        here); the array of user scores is copied once to each worker, so scales with the number of users.
+            n_workers: number of worker processes (default: number of CPUs)
+            n_shards: number of subject shards (default: 4 * n_workers)
+        """
+        if not len(table):
+            return
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        if n_shards is None:
+            n_shards = 4 * n_workers
+        classes = list(self.config.label_map.keys())
+        labels = sorted(self.config.label_map.values())
+        users = [self.get_user(user_id) for user_id in table.user_ids]
+        likelihoods = np.array([[[user.user_score[c][label] for c in classes] for label in labels]
+                                for user in users])
+        user_index = [user.index for user in users]
+        score_version = [user.score_version for user in users]
+        # Creating unknown subjects here, in the order they are first classified
+        for subject_id in table.subject_id:
+            if subject_id not in self.subjects:
+                self.subjects[subject_id] = Subject(subject_id=subject_id,
+                                                    p0=self.config.p0,
+                                                    classes=classes)
+        shard_rows = [[] for n in range(n_shards)]
+        for i, subject_id in enumerate(table.subject_id):
+            shard_rows[subject_id % n_shards].append(i)
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_shard_worker,
+                                 initargs=(likelihoods, user_index, score_version)) as executor:
+            futures = []
+            for rows in shard_rows:
+                if not rows:
                     continue
-                self.process_classification(cl, online)
+                subject_ids = [table.subject_id[i] for i in rows]
+                scores = dict((s, (self.subjects[s].get_score_list(), self.subjects[s].epsilon))
+                              for s in set(subject_ids))
+                futures.append((rows, executor.submit(score_shard, scores, [table.user[i] for i in rows],
+                                                      subject_ids, [table.label[i] for i in rows])))
+            # Recording the posteriors in the subjects' histories, in the order they were classified
+            for rows, future in futures:
+                for i, posterior in zip(rows, future.result()):
+                    u = table.user[i]
+                    self.subjects[table.subject_id[i]].add_posterior(table.classification_id[i], user_index[u],
+                                                                     score_version[u], table.label[i],
+                                                                     dict(zip(classes, posterior)),
+                                                                     table.created_at[i])
+                for subject_id in set(table.subject_id[i] for i in rows):
+                    self.index_subject(self.subjects[subject_id])
+        for u, subject_id in zip(table.user, table.subject_id):
+            users[u].history.append(subject_id, score_version[u])
+        self.last_id = table.classification_id[-1]
+        self.seen.update(table.classification_id)
+
+    def process_classifications_from_csv_dump(self, path, online=False):
+        self.process_classifications(self.read_classifications(path), online)
 
         # TODO: Uncomment below after beta
         # to_retire = self.retire(self.subjects.keys())
@@ -391,63 +1338,40 @@ class kSWAP(object):
                                                     classes=self.config.label_map.keys(),
                                                     p0=self.config.p0,
                                                     gold_label=gold_label)
-
-    def apply_golds(self, path):
-        with open(path, 'r') as csvdump:
-            reader = csv.DictReader(csvdump)
-            for row in reader:
-                id = int(row['classification_id'])
-                try:
-                    user_id = int(row['user_id'])
-                except ValueError as e:
-                    user_id = row['user_name']
-                subject_id = int(row['subject_ids'])
-                annotation = json.loads(row['annotations'])
-                try:
-                    assert int(row['workflow_id']) == self.config.workflow
-                    # TODO: Uncomment below after beta
-                    # # ignore repeat classifications of the same subject
-                    # if json.loads(row['metadata'])['seen_before']:
-                    #     continue
-                except KeyError as e:
-                    print('Workflow not recognized.', row)
-                    pass
-                except AssertionError as e:
-                    print("Different workflow than configured.", row)
-                    continue
-
-                try:
-                    cl = Classification(id,
-                                        user_id,
-                                        subject_id,
-                                        annotation,
-                                        label_map=self.config.label_map)
-                except ValueError as e:
-                    print('Classification value error.')
-                    continue
-                try:
-                    self.users[cl.user_id]
-                except KeyError:
-                    self.users[cl.user_id] = User(user_id=cl.user_id,
-                                                  classes=self.config.label_map.keys(),
-                                                  gamma=self.config.gamma,
-                                                  user_default=self.config.user_default)
-
-                try:
-                    gold_label = self.subjects[cl.subject_id].gold_label
-                    assert gold_label in self.config.label_map.values()
-                    self.users[cl.user_id].update_user_score(gold_label, cl.label)
-                except AssertionError as e:
-                    # Subject is not a `gold' or `training' subject
-                    continue
-                except KeyError as e:
-                    # print(f"User ID {cl.user_id} not recognized.")
-                    continue
-
-    def run_offline(self, gold_csv, classification_csv):
+                self.index_subject(self.subjects[subject_id])
+
+    def apply_golds(self, table):
+        """
+        Updates user scores with the classifications made on gold subjects.
+            table: ClassificationTable (or path to the classification CSV dump)
+        """
+        if type(table) is str:
+            table = self.read_classifications(table)
+        gold_subject_ids = [subject_id for subject_id, subject in self.subjects.items()
+                            if subject.gold_label in self.config.label_map.values()]
+        for i in table.subject_indices(gold_subject_ids):
+            cl = table.classification(i)
+            gold_label = self.subjects[cl.subject_id].gold_label
+            self.get_user(cl.user_id).update_user_score(gold_label, cl.label)
+
+    def run_offline(self, gold_csv, classification_csv, n_workers=1, event_log=None):
+        """
+            n_workers: if greater than 1, subjects are scored on a pool of this many processes
+                       (see 'process_classifications_sharded')
+            event_log: ClassificationEventLog (see 'event_log.py') from which the classifications not yet seen are
+                       read, instead of parsing 'classification_csv'
+        """
+        if event_log is not None:
+            table = ClassificationTable.from_event_log(event_log, self.config.workflow, self.config.label_map,
+                                                       self.seen)
+        else:
+            table = self.read_classifications(classification_csv)
         self.get_golds(gold_csv)
-        self.apply_golds(classification_csv)
-        self.process_classifications_from_csv_dump(classification_csv)
+        self.apply_golds(table)
+        if n_workers > 1:
+            self.process_classifications_sharded(table, n_workers=n_workers)
+        else:
+            self.process_classifications(table)
 
     def run_online(self, gold_csv, classification_csv):
         self.get_golds(gold_csv)
@@ -0,0 +1,199 @@
+import os
+import csv
+import gc
+import sys
+import json
+import time
+import shutil
+import tempfile
+import tracemalloc
+import numpy as np
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+
+from python.classification_analysis.kswap import kSWAP
+from python.classification_analysis.offline_swap_config import Config
+from python.vars.project_info import first_workflow_id
+from python.vars.fieldnames import classifications_fieldnames, golds_fieldnames
+from python.vars.thresholds import retirement_lower_threshold, first_workflow_classification_limit
+from python.vars.paths_and_ids import kswap_benchmark_results_path
+
+try:
+    import resource
+except ImportError:
+    # (Not available on Windows, where peak memory is not reported)
+    resource = None
+
+# Ensuring that the current working directory is "CountertopDarkMatter"
+while os.getcwd()[-20:] != "CountertopDarkMatter":
+    os.chdir("..")
+
+
+def generate_classification_dump(classifications_csv_path, golds_csv_path, n_classifications, n_users, n_subjects,
+                                 gold_fraction=0.1, tenebrite_fraction=0.05, skill_alpha=8.0, skill_beta=2.0,
+                                 anonymous_fraction=0.1, workflow_id=first_workflow_id, seed=0):
+    """
+    Writes a synthetic classification dump, in the shape of the Zooniverse-generated 'classifications.csv', and
+    a golds CSV for it.
+        n_classifications, n_users, n_subjects: numbers of rows, of distinct users and of distinct subjects
+        gold_fraction: fraction of subjects that are gold (listed in the golds CSV)
+        tenebrite_fraction: fraction of subjects that truly contain a tenebrite (label 1)
+        skill_alpha, skill_beta: parameters of the Beta distribution from which each user's probability of
+                                 submitting the true label is drawn (the default's mean is 0.8)
+        anonymous_fraction: fraction of users that are not logged in (blank 'user_id')
+    """
+    rng = np.random.default_rng(seed)
+    first_subject_id, first_user_id, first_classification_id = 60000000, 2000000, 350000000
+    true_labels = (rng.random(n_subjects) < tenebrite_fraction).astype(int)
+    is_gold = rng.random(n_subjects) < gold_fraction
+    skills = rng.beta(skill_alpha, skill_beta, n_users)
+    anonymous = rng.random(n_users) < anonymous_fraction
+    # Some users classify much more than others
+    user_weights = rng.pareto(1.5, n_users) + 1
+    users = rng.choice(n_users, size=n_classifications, p=user_weights / user_weights.sum())
+    subjects = rng.integers(0, n_subjects, n_classifications)
+    correct = rng.random(n_classifications) < skills[users]
+    labels = np.where(correct, true_labels[subjects], 1 - true_labels[subjects])
+    seconds = np.sort(rng.integers(0, 90 * 24 * 3600, n_classifications))
+
+    start = datetime(2021, 9, 1)
+    metadata = json.dumps({'source': 'api', 'session': '0' * 64, 'viewport': {'width': 1422, 'height': 766},
+                           'started_at': '2021-09-01T00:00:00.000Z', 'finished_at': '2021-09-01T00:00:01.000Z',
+                           'seen_before': False, 'live_project': True, 'user_language': 'en',
+                           'user_group_ids': [], 'subject_dimensions': [None]})
+    subject_data = '{{"{}":{{"retired":null,"#file_name":"e{}_synthetic.jpeg","#warehouse":"Synthetic"}}}}'
+    with open(classifications_csv_path, 'w', newline='') as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(classifications_fieldnames)
+        for i in range(n_classifications):
+            user, subject = int(users[i]), int(subjects[i])
+            subject_id = first_subject_id + subject
+            if anonymous[user]:
+                user_name, user_id = f'not-logged-in-{user:020x}', ''
+            else:
+                user_name, user_id = f'user{user}', first_user_id + user
+            created_at = (start + timedelta(seconds=int(seconds[i]))).strftime('%Y-%m-%d %H:%M:%S UTC')
+            csv_writer.writerow([first_classification_id + i, user_name, user_id, f'{user:020x}', workflow_id,
+                                 'Classify', '72.96', created_at, '', '', metadata,
+                                 f'[{{"task": "T3", "value": {labels[i]}}}]',
+                                 subject_data.format(subject_id, subject), subject_id])
+
+    with open(golds_csv_path, 'w', newline='') as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(golds_fieldnames)
+        csv_writer.writerows([first_subject_id + subject, true_labels[subject]] for subject in np.flatnonzero(is_gold))
+
+
+def peak_worker_memory_mb():
+    """
+    Returns the largest peak resident memory of the terminated child processes (eg. the scoring workers) of this
+    process, in MB (None where it cannot be measured).
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # (Reported in bytes on macOS, in kilobytes elsewhere)
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def benchmark_kswap(n_classifications, users_per_classification=0.02, subjects_per_classification=0.1,
+                    n_workers=1, folder=None, trace_memory=True, **generate_kwargs):
+    """
+    Generates a synthetic dump of 'n_classifications' rows and times the stages of an offline kSWAP run on it
+    separately, against a fresh database. Returns a dictionary of the workload and of each stage's seconds,
+    classifications per second and peak memory (MB): that allocated during the stage ('peak_memory_mb', traced
+    with tracemalloc) and, for a stage run on worker processes, the largest worker's peak resident memory
+    ('peak_worker_memory_mb'; to be attributed to the stage, the benchmark should run in a fresh process, as in
+    'run_benchmarks').
+        users_per_classification, subjects_per_classification: numbers of users and subjects per row
+        n_workers: if greater than 1, subjects are scored on a pool of this many processes
+        folder: folder in which the dump and database are written (default: a temporary folder, deleted after)
+        trace_memory: 'False' to not trace memory allocations, which slows allocation-heavy stages
+    """
+    temporary_folder = folder is None
+    if temporary_folder:
+        folder = tempfile.mkdtemp()
+    n_users = max(1, int(n_classifications * users_per_classification))
+    n_subjects = max(1, int(n_classifications * subjects_per_classification))
+    classifications_csv_path = os.path.join(folder, 'benchmark_classifications.csv')
+    golds_csv_path = os.path.join(folder, 'benchmark_golds.csv')
+    generate_classification_dump(classifications_csv_path, golds_csv_path, n_classifications, n_users, n_subjects,
+                                 **generate_kwargs)
+
+    swap_config = Config(first_workflow_id, retirement_lower_threshold, first_workflow_classification_limit)
+    swap_config.db_path = folder + os.path.sep
+    db_file = swap_config.db_path + swap_config.db_name
+    if os.path.exists(db_file):
+        os.remove(db_file)
+    swap = kSWAP(config=swap_config)
+
+    stages = {}
+
+    def timed(stage, function, *args, uses_workers=False, **kwargs):
+        gc.collect()
+        if trace_memory:
+            tracemalloc.reset_peak()
+            traced_start = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        stages[stage] = {'seconds': seconds,
+                         'classifications_per_second': n_classifications / seconds if seconds else None,
+                         'peak_memory_mb': (tracemalloc.get_traced_memory()[1] - traced_start) / 1024 ** 2
+                         if trace_memory else None}
+        if uses_workers:
+            stages[stage]['peak_worker_memory_mb'] = peak_worker_memory_mb()
+        print(f'{n_classifications} classifications, {stage}: {seconds:.3f} s')
+        return result
+
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        table = timed('read_classifications', swap.read_classifications, classifications_csv_path)
+        timed('get_golds', swap.get_golds, golds_csv_path)
+        timed('apply_golds', swap.apply_golds, table)
+        if n_workers > 1:
+            timed('scoring', swap.process_classifications_sharded, table, n_workers=n_workers, uses_workers=True)
+        else:
+            timed('scoring', swap.process_classifications, table)
+        retired = timed('retire', swap.retire)
+        timed('save', swap.save)
+        timed('load', kSWAP(config=swap_config).load)
+        timed('save_snapshot', swap.save_snapshot)
+        timed('load_snapshot', kSWAP(config=swap_config).load_snapshot)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        if temporary_folder:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    return {'n_classifications': n_classifications,
+            'n_users': n_users,
+            'n_subjects': n_subjects,
+            'n_workers': n_workers,
+            'n_retired': len(retired),
+            'generate_kwargs': generate_kwargs,
+            'stages': stages}
+
+
+def run_benchmarks(sizes=(10000, 100000, 1000000), results_path=kswap_benchmark_results_path, **benchmark_kwargs):
+    """
+    Benchmarks kSWAP at each workload size, writing the results to a JSON file. Each size is benchmarked in a
+    fresh process, such that no memory (nor worker processes) carry over from one size to the next.
+    """
+    benchmarks = []
+    for size in sizes:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            benchmarks.append(executor.submit(benchmark_kswap, size, **benchmark_kwargs).result())
+    results = {'date': datetime.now().isoformat(timespec='seconds'),
+               'python': sys.version.split()[0],
+               'cpu_count': os.cpu_count(),
+               'benchmarks': benchmarks}
+    os.makedirs(os.path.dirname(results_path), exist_ok=True)
+    with open(results_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    run_benchmarks()
@@ -0,0 +1,234 @@
+import os
+import csv
+import itertools
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+from python.classification_analysis.kswap import kSWAP
+from python.classification_analysis.offline_swap_config import Config
+from python.vars.project_info import first_workflow_id
+from python.vars.fieldnames import kswap_sweep_fieldnames
+from python.vars.paths_and_ids import swap_classifications_csv_path, golds_csv_path, kswap_sweep_results_csv_path
+
+# Ensuring that the current working directory is "CountertopDarkMatter"
+while os.getcwd()[-20:] != "CountertopDarkMatter":
+    os.chdir("..")
+
+
+class SharedClassificationTable:
+    """
+    A classification table, ordered by subject, held in shared memory such that the processes evaluating sweep
+    settings can read it without copying or re-parsing it. Arrays:
+        user: table user index of each classification
+        label: submitted label of each classification
+        gold: gold label of the classified subject (-1 if it is not gold)
+        position: number of earlier classifications of the same subject
+        subject_start: index of the first classification of each subject
+    Classifications of each subject keep the order in which they were made.
+    """
+    dtypes = {'user': np.int32, 'label': np.int8, 'gold': np.int8, 'position': np.int32,
+              'subject_start': np.int64}
+
+    def __init__(self, spec):
+        """
+            spec: dictionary like 'array name': (shared memory block name, length), as returned by 'spec'
+        """
+        self.blocks = dict((name, shared_memory.SharedMemory(name=block_name))
+                           for name, (block_name, length) in spec.items())
+        for name, (block_name, length) in spec.items():
+            setattr(self, name, np.ndarray((length,), dtype=self.dtypes[name], buffer=self.blocks[name].buf))
+        self.n_users = int(self.user.max()) + 1 if len(self.user) else 0
+
+    @classmethod
+    def create(cls, table, gold_labels):
+        """
+        Copies a ClassificationTable into new shared memory blocks (to be released with 'unlink').
+            gold_labels: dictionary like 'subject_id': gold label
+        """
+        subject_ids = np.frombuffer(table.subject_id, dtype=np.int64)
+        order = np.argsort(subject_ids, kind='stable')
+        subject_ids = subject_ids[order]
+        subject_start = np.flatnonzero(np.r_[True, subject_ids[1:] != subject_ids[:-1]]) if len(order) \
+            else np.zeros(0, dtype=np.int64)
+        counts = np.diff(np.r_[subject_start, len(order)])
+        gold = np.array([gold_labels.get(int(subject_id), -1) for subject_id in subject_ids[subject_start]])
+        arrays = {'user': np.frombuffer(table.user, dtype=np.int32)[order],
+                  'label': np.frombuffer(table.label, dtype=np.int8)[order],
+                  'gold': np.repeat(gold, counts),
+                  'position': np.arange(len(order)) - np.repeat(subject_start, counts),
+                  'subject_start': subject_start}
+        spec = {}
+        for name, values in arrays.items():
+            values = np.ascontiguousarray(values, dtype=cls.dtypes[name])
+            # (Shared memory blocks cannot be empty)
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+            spec[name] = (block.name, len(values))
+            block.close()
+        return cls(spec)
+
+    @property
+    def spec(self):
+        return dict((name, (block.name, len(getattr(self, name)))) for name, block in self.blocks.items())
+
+    def close(self):
+        for name in self.blocks:
+            setattr(self, name, None)
+        for block in self.blocks.values():
+            block.close()
+
+    def unlink(self):
+        self.close()
+        for block in self.blocks.values():
+            block.unlink()
+
+
+# Spec of the shared table read by the workers of 'SWAPSweep.run'
+_sweep_spec = None
+
+
+def init_sweep_worker(spec):
+    global _sweep_spec
+    _sweep_spec = spec
+
+
+def evaluate_setting(setting, table=None, user_default=None):
+    """
+    Evaluates one sweep setting on the shared table. Offline kSWAP is simulated: user scores are first trained on
+    every classification of a gold subject, then subjects are scored in order and each is retired by the first
+    classification after which its posterior-to-prior ratio falls below the threshold (as 0) or it reaches the
+    classification limit (as its majority label). Posteriors are accumulated as log-odds, which matches kSWAP's
+    sequential updates up to its 1e-9 regularization of the denominator.
+        setting: dictionary with keys 'gamma', 'p0' (prior probability of a tenebrite; that of no tenebrite is taken
+                 to be 1 - p0), 'threshold' (retirement lower threshold), 'limit' (classification limit)
+        table: SharedClassificationTable; if None, that of the worker's spec is attached to, and closed once the
+               setting is evaluated
+        user_default: score of users with no gold classifications, like Config.user_default
+    """
+    if table is None:
+        table = SharedClassificationTable(_sweep_spec)
+        try:
+            return evaluate_setting(setting, table, user_default)
+        finally:
+            table.close()
+    gamma, threshold, limit = setting['gamma'], setting['threshold'], setting['limit']
+    p0 = {'0': 1 - setting['p0'], '1': setting['p0']}
+    if user_default is None:
+        user_default = {'0': [0.50, 0.50], '1': [0.50, 0.50]}
+
+    # User scores, user_score[u][c][label], from confusion matrices of gold classifications
+    is_gold = table.gold >= 0
+    matrix = np.zeros((table.n_users, 2, 2))
+    np.add.at(matrix, (table.user[is_gold], table.gold[is_gold], table.label[is_gold]), 1)
+    n_gold = matrix.sum(axis=2, keepdims=True)
+    user_score = (matrix + gamma) / (n_gold + 2.0 * gamma)
+    has_golds = n_gold.sum(axis=1)[:, 0] > 0
+    user_score[~has_golds] = np.array([user_default['0'], user_default['1']])
+
+    # Log-odds of a tenebrite after each classification, then posterior-to-prior ratios
+    log_likelihood_ratio = np.log(user_score[:, 1, :]) - np.log(user_score[:, 0, :])
+    increments = log_likelihood_ratio[table.user, table.label]
+    cumulative = np.cumsum(increments)
+    counts = np.diff(np.r_[table.subject_start, len(increments)])
+    offsets = np.repeat(cumulative[table.subject_start] - increments[table.subject_start], counts)
+    log_odds = np.log(p0['1']) - np.log(p0['0']) + cumulative - offsets
+    log_posterior_to_prior = -np.logaddexp(0, -log_odds) - np.log(p0['1'])
+
+    # First classification at which each subject retires (len(table) if it never does)
+    seen = table.position + 1
+    retires = (log_posterior_to_prior < np.log(threshold)) | (seen >= limit)
+    first = np.minimum.reduceat(np.where(retires, np.arange(len(retires)), len(retires)), table.subject_start) \
+        if len(retires) else np.zeros(0, dtype=np.int64)
+    retired = first < len(retires)
+    subject_ends = table.subject_start + counts
+    spent = np.where(retired, first - table.subject_start + 1, counts)
+
+    # Majority label of the classifications up to retirement (ties go to the first label submitted)
+    cumulative_ones = np.cumsum(table.label)
+    ones_before = cumulative_ones[table.subject_start] - table.label[table.subject_start]
+    ones = cumulative_ones[np.minimum(first, subject_ends - 1)] - ones_before
+    majority = np.where(2 * ones > spent, 1, np.where(2 * ones < spent, 0, table.label[table.subject_start]))
+    retired_as = np.where(retired & (spent >= limit), majority, 0)
+
+    gold = table.gold[table.subject_start]
+    is_gold_subject = gold >= 0
+    gold_retired = retired & is_gold_subject
+    n_gold_correct = int(np.sum(gold_retired & (retired_as == gold)))
+    result = dict(setting)
+    result.update({
+        'n_subjects': int(np.sum(~is_gold_subject)),
+        'n_retired': int(np.sum(retired & ~is_gold_subject)),
+        'n_retired_as_0': int(np.sum(retired & ~is_gold_subject & (retired_as == 0))),
+        'n_retired_as_1': int(np.sum(retired & ~is_gold_subject & (retired_as == 1))),
+        'classifications_spent': int(np.sum(spent[~is_gold_subject])),
+        'classifications_saved': int(np.sum((counts - spent)[~is_gold_subject])),
+        'n_gold_subjects': int(np.sum(is_gold_subject)),
+        'n_gold_retired': int(np.sum(gold_retired)),
+        'gold_accuracy': n_gold_correct / int(np.sum(gold_retired)) if np.any(gold_retired) else None,
+        # Gold tenebrite subjects retired as negative (missed tenebrites)
+        'n_gold_missed': int(np.sum(gold_retired & (gold == 1) & (retired_as == 0))),
+    })
+    return result
+
+
+class SWAPSweep:
+    def __init__(self, classifications_csv_path=swap_classifications_csv_path, golds_csv_path=golds_csv_path,
+                 workflow_id=first_workflow_id):
+        """
+        Grid search over kSWAP's hyper-parameters. The classification dump is parsed once, into a table in shared
+        memory that every setting is evaluated against; no kSWAP database is opened.
+        """
+        swap_config = Config(workflow_id, 1, 1)
+        self.user_default = swap_config.user_default
+        table = kSWAP.read_classification_dump(classifications_csv_path, swap_config.workflow, swap_config.label_map)
+        with open(golds_csv_path, 'r') as f:
+            gold_labels = dict((int(row['subject_id']), int(row['gold'])) for row in csv.DictReader(f))
+        self.table = SharedClassificationTable.create(table, gold_labels)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.table is not None:
+            self.table.unlink()
+            self.table = None
+
+    @staticmethod
+    def grid(gammas, p0s, thresholds, limits):
+        """
+        Returns the settings (dictionaries) of every combination of the given values.
+        """
+        return [{'gamma': gamma, 'p0': p0, 'threshold': threshold, 'limit': limit}
+                for gamma, p0, threshold, limit in itertools.product(gammas, p0s, thresholds, limits)]
+
+    def run(self, settings, n_workers=None, results_csv_path=kswap_sweep_results_csv_path):
+        """
+        Evaluates the settings on a pool of 'n_workers' processes (default: number of CPUs); returns the results
+        (see 'evaluate_setting') and writes them to a CSV.
+        """
+        if n_workers == 1:
+            results = [evaluate_setting(setting, self.table, self.user_default) for setting in settings]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=init_sweep_worker,
+                                     initargs=(self.table.spec,)) as executor:
+                results = list(executor.map(evaluate_setting, settings, itertools.repeat(None),
+                                            itertools.repeat(self.user_default), chunksize=4))
+        if results_csv_path:
+            os.makedirs(os.path.dirname(results_csv_path), exist_ok=True)
+            with open(results_csv_path, 'w', newline='') as f:
+                csv_writer = csv.DictWriter(f, fieldnames=kswap_sweep_fieldnames)
+                csv_writer.writeheader()
+                csv_writer.writerows(results)
+        return results
+
+
+if __name__ == '__main__':
+    with SWAPSweep() as sweep:
+        sweep.run(SWAPSweep.grid(gammas=[0.5, 1, 2],
+                                 p0s=[0.001, 0.01, 0.05],
+                                 thresholds=[1e-7, 1e-5, 1e-3],
+                                 limits=[10, 15, 30, 100]))
@@ -0,0 +1,80 @@
+import os
+import sys
+import csv
+import json
+
+from python.utils.csv_excel_utils import CsvUtils, ExcelUtils
+from python.vars.paths_and_ids import consensus_subjects_manifest_path, consensus_subjects_manifest_csv_path, \
+    consensus_users_manifest_path, consensus_users_manifest_csv_path, consensus_subject_history_csv_path, \
+    consensus_user_history_csv_path
+from python.vars.fieldnames import consensus_subjects_fieldnames, consensus_users_fieldnames, \
+    consensus_subject_history_fieldnames, consensus_user_history_fieldnames
+
+# Ensuring that the current working directory is "CountertopDarkMatter"
+while os.getcwd()[-20:] != "CountertopDarkMatter":
+    os.chdir("..")
+
+
+"""
+One-off migration of the recorded consensus subjects and users to the history side tables.
+Consensus subject/user CSVs and manifests used to hold each subject's / user's history as a JSON list in their last
+column ('score_history' / 'weight_history'); histories are now kept in side tables, one row per entry (see
+'ConsensusAnalysis'). This script moves every entry of those columns to the side tables, in order, and rewrites the
+CSVs and manifests without the columns. It must be run once, before 'ConsensusAnalysis' is run on the old records;
+records that were already migrated are left as they are.
+"""
+
+
+def migrate_histories(csv_path, manifest_path, history_csv_path, fieldnames, history_fieldnames, history_column,
+                      history_row):
+    """
+    Moves the entries of the JSON column 'history_column' of a consensus subject/user CSV to its side table, and
+    rewrites the CSV and its manifest with 'fieldnames'; returns the number of history rows written.
+        history_row = function returning the side table row of an entry (a dictionary), given the subject/user ID
+                      and the entry's position in the history
+    """
+    if not os.path.exists(csv_path):
+        print(f'{csv_path} does not exist; there is nothing to migrate.')
+        return 0
+    with open(csv_path, 'r') as f:
+        reader = csv.DictReader(f)
+        rows = list(reader)
+    if history_column not in (reader.fieldnames or []):
+        print(f'{csv_path} has no {history_column} column; it was already migrated.')
+        return 0
+    history_rows = [history_row(row[fieldnames[0]], position, entry)
+                    for row in rows for position, entry in enumerate(json.loads(row[history_column] or '[]'))]
+    # Writing the side table before the histories are removed from the CSV and manifest
+    history_csv = CsvUtils(history_csv_path, fieldnames_list=history_fieldnames)
+    history_csv.clear()
+    history_csv.write_rows(history_rows)
+    rows = [[row[fieldname] for fieldname in fieldnames] for row in rows]
+    for path in [csv_path, manifest_path]:
+        if os.path.exists(path):
+            os.remove(path)
+    CsvUtils(csv_path, fieldnames_list=fieldnames).write_rows(rows)
+    ExcelUtils(manifest_path, fieldnames_list=fieldnames).write_rows(rows)
+    return len(history_rows)
+
+
+def subject_history_row(subject_id, position, entry):
+    return [subject_id, position, entry['score']['negative'], entry['score']['tenebrite'], entry['user_weight_sum'],
+            entry['n_users']['negative'], entry['n_users']['tenebrite']]
+
+
+def user_history_row(user_id, position, entry):
+    return [user_id, position, entry['weight'], entry['n_subjects']]
+
+
+if __name__ == "__main__":
+
+    csv.field_size_limit(sys.maxsize)
+
+    n_rows = migrate_histories(consensus_subjects_manifest_csv_path, consensus_subjects_manifest_path,
+                               consensus_subject_history_csv_path, consensus_subjects_fieldnames,
+                               consensus_subject_history_fieldnames, 'score_history', subject_history_row)
+    print(f'Migrated {n_rows} subject history rows to {consensus_subject_history_csv_path}.')
+    n_rows = migrate_histories(consensus_users_manifest_csv_path, consensus_users_manifest_path,
+                               consensus_user_history_csv_path, consensus_users_fieldnames,
+                               consensus_user_history_fieldnames, 'weight_history', user_history_row)
+    print(f'Migrated {n_rows} user history rows to {consensus_user_history_csv_path}.')
@@ -2,7 +2,7 @@ import os
 
 from python.vars.project_info import project_id
 from python.vars.paths_and_ids import converted_classifications_folder, \
-    classification_analysis_records, offline_swap_db_path
+    classification_analysis_records, offline_swap_db_path, offline_swap_snapshot_path
 
 # Ensuring that the current working directory is "CountertopDarkMatter"
 while os.getcwd()[-20:] != "CountertopDarkMatter":
@@ -16,6 +16,7 @@ class Config(object):
         self.swap_path = '.' + os.path.sep
         self.data_path = converted_classifications_folder + os.path.sep
         self.db_name = os.path.basename(offline_swap_db_path)
+        self.snapshot_name = os.path.basename(offline_swap_snapshot_path)
         self.db_path = classification_analysis_records + os.path.sep
 
         self.label_map    = {'0': 0, '1': 1}
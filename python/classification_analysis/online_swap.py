@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import queue
+
+from python.classification_analysis.kswap import kSWAP
+from python.classification_analysis.offline_swap_config import Config
+from python.vars.project_info import first_workflow_id
+from python.vars.thresholds import retirement_lower_threshold, first_workflow_classification_limit
+from python.vars.paths_and_ids import classification_events_path, retired_subjects_journal_path
+
+# Ensuring that the current working directory is "CountertopDarkMatter"
+while os.getcwd()[-20:] != "CountertopDarkMatter":
+    os.chdir("..")
+
+
+"""
+Classification events are dictionaries in the form of the rows of the 'classifications.csv' Zooniverse export
+(or of the SWAP-converted classifications CSV); at least the keys 'classification_id', 'user_id', 'user_name',
+'workflow_id', 'subject_ids' and 'annotations' are required. 'annotations' may be a JSON string or already-parsed
+list. Sources stand in for a Caesar/Panoptes webhook, which would post the same data.
+"""
+
+
+class TailingFileSource:
+    def __init__(self, path, from_start=True):
+        """
+        Classification events appended, one JSON object per line, to the file at 'path' (eg. by a webhook receiver).
+            from_start: 'True' to also read the events already in the file, 'False' to only read new events
+        """
+        self.path = path
+        self.offset = 0
+        self.partial_line = ''
+        if not from_start and os.path.exists(path):
+            self.offset = os.path.getsize(path)
+
+    def poll(self, timeout):
+        """
+        Returns the events appended to the file since the last poll, waiting up to 'timeout' seconds for some.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self.read_new_events()
+            if events or time.monotonic() >= deadline:
+                return events
+            time.sleep(min(0.05, timeout))
+
+    def read_new_events(self):
+        if not os.path.exists(self.path):
+            return []
+        if os.path.getsize(self.path) < self.offset:
+            # The file was truncated or replaced; start again from its beginning
+            self.offset, self.partial_line = 0, ''
+        with open(self.path, 'r') as f:
+            f.seek(self.offset)
+            data = f.read()
+            self.offset = f.tell()
+        lines = (self.partial_line + data).split('\n')
+        # The last line is incomplete (or empty) until a newline has been written after it
+        self.partial_line = lines.pop()
+        events = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # (A malformed line is skipped, such that it does not stop the service)
+                print(f'Skipping a malformed classification event in {self.path}: {line[:200]}')
+        return events
+
+
+class QueueSource:
+    def __init__(self, event_queue=None):
+        """
+        Classification events put on a queue (eg. by a webhook receiver running in another thread or process).
+        Putting None on the queue stops the service.
+        """
+        self.queue = event_queue if event_queue is not None else queue.Queue()
+        self.closed = False
+
+    def poll(self, timeout):
+        """
+        Returns the events on the queue, waiting up to 'timeout' seconds for the first.
+        """
+        events = []
+        try:
+            events.append(self.queue.get(timeout=timeout))
+            while True:
+                events.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        if None in events:
+            self.closed = True
+            events = events[:events.index(None)]
+        return events
+
+
+class OnlineSWAP:
+    def __init__(self, swap, source, retire_subjects=None, checkpoint_seconds=60, checkpoint_classifications=1000,
+                 poll_seconds=1.0):
+        """
+        Long-running kSWAP service: consumes classification events from 'source', updates users and subjects
+        incrementally (online, so gold classifications update user scores as they arrive), emits retirement
+        decisions as soon as the classification that triggers them is processed, and periodically checkpoints
+        the users and subjects changed since the last checkpoint to the kSWAP database (the snapshot, which holds
+        every user and subject, being written when the service stops).
+            swap: kSWAP instance (eg. loaded from 'offline_swap.db', with golds applied)
+            source: TailingFileSource, QueueSource or any object with a 'poll(timeout)' method returning events
+            retire_subjects: function called with the list of IDs of subjects to retire, returning the lists of
+                             those retired and those that failed to be (default: 'swap.send_panoptes');
+                             failed subjects are re-sent with the next decisions
+            checkpoint_seconds, checkpoint_classifications: the state is saved after whichever comes first
+            poll_seconds: maximum time waited for new events before retirements are re-sent and checkpoints made
+        """
+        self.swap = swap
+        self.source = source
+        if retire_subjects is None:
+            def retire_subjects(subject_ids):
+                return swap.send_panoptes(subject_ids, journal_path=retired_subjects_journal_path)
+        self.retire_subjects = retire_subjects
+        self.checkpoint_seconds = checkpoint_seconds
+        self.checkpoint_classifications = checkpoint_classifications
+        self.poll_seconds = poll_seconds
+        # Retirement decisions made, as tuples like (subject ID, retired_as, triggering classification ID, time)
+        self.decisions = []
+        self.unsent_retirements = []
+        self.n_processed = 0
+        self.n_since_checkpoint = 0
+        # IDs of the users and subjects changed since the last checkpoint
+        self.changed_user_ids = set()
+        self.changed_subject_ids = set()
+        self.last_checkpoint = time.monotonic()
+
+    def run(self, max_classifications=None, idle_seconds=None):
+        """
+        Processes events until the source is closed, 'max_classifications' have been processed, or no event has
+        arrived for 'idle_seconds'; the state is checkpointed before returning.
+        """
+        last_event = time.monotonic()
+        try:
+            while not getattr(self.source, 'closed', False):
+                events = self.source.poll(self.poll_seconds)
+                if events:
+                    last_event = time.monotonic()
+                for event in events:
+                    cl_id = self.process_event(event)
+                    if cl_id is not None:
+                        self.emit_retirements(cl_id)
+                if self.unsent_retirements:
+                    self.send_retirements()
+                if self.n_since_checkpoint >= self.checkpoint_classifications \
+                        or time.monotonic() - self.last_checkpoint >= self.checkpoint_seconds:
+                    self.checkpoint()
+                if max_classifications is not None and self.n_processed >= max_classifications:
+                    break
+                if idle_seconds is not None and time.monotonic() - last_event >= idle_seconds:
+                    break
+        finally:
+            self.checkpoint(snapshot=True)
+
+    @staticmethod
+    def normalize_event(event):
+        """
+        Converts the values of an event into the (string) form of classification CSV cells.
+        """
+        row = dict((key, '' if value is None else value) for key, value in event.items())
+        if type(row.get('annotations')) is not str:
+            row['annotations'] = json.dumps(row['annotations'])
+        for key in ['classification_id', 'user_id', 'workflow_id', 'subject_ids']:
+            if key in row:
+                row[key] = str(row[key])
+        return row
+
+    def process_event(self, event):
+        """
+        Applies a classification event to the kSWAP state; returns its classification ID, or None if the event
+        was not applied (other workflow, unrecognized annotation, or already processed).
+        """
+        cl = self.swap.parse_row(self.normalize_event(event))
+        if cl is None or cl.id in self.swap.seen:
+            return None
+        self.swap.process_classification(cl, online=True)
+        self.changed_user_ids.add(cl.user_id)
+        self.changed_subject_ids.add(cl.subject_id)
+        self.n_processed += 1
+        self.n_since_checkpoint += 1
+        return cl.id
+
+    def emit_retirements(self, cl_id):
+        """
+        Retires the subjects that have become retirement candidates.
+        """
+        to_retire = self.swap.retire()
+        if not to_retire:
+            return
+        now = time.time()
+        for subject_id in to_retire:
+            decision = (subject_id, self.swap.subjects[subject_id].retired_as, cl_id, now)
+            self.decisions.append(decision)
+            print('Retiring subject {} as {} (classification {}).'.format(*decision[:3]))
+        self.changed_subject_ids.update(to_retire)
+        self.unsent_retirements.extend(to_retire)
+        self.send_retirements()
+
+    def send_retirements(self):
+        retired, failed = self.retire_subjects(self.unsent_retirements)
+        self.unsent_retirements = list(failed)
+
+    def checkpoint(self, snapshot=False):
+        """
+        Saves the users and subjects changed since the last checkpoint to the database (which deletes the snapshot),
+        and, if 'snapshot', writes the snapshot.
+        """
+        if snapshot:
+            self.swap.save_snapshot(self.changed_user_ids, self.changed_subject_ids)
+        else:
+            self.swap.save(self.changed_user_ids, self.changed_subject_ids)
+        self.changed_user_ids, self.changed_subject_ids = set(), set()
+        self.n_since_checkpoint = 0
+        self.last_checkpoint = time.monotonic()
+
+
+if __name__ == '__main__':
+    swap_config = Config(first_workflow_id, retirement_lower_threshold, first_workflow_classification_limit)
+    swap = kSWAP(config=swap_config).load_snapshot()
+    service = OnlineSWAP(swap, TailingFileSource(classification_events_path, from_start=False))
+    service.run()
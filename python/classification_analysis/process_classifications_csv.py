@@ -1,19 +1,31 @@
+import io
 import os
-import re
+import csv
 import json
+import sqlite3
+import itertools
+from collections import deque
 from datetime import date, datetime
+from functools import cached_property
+from concurrent.futures import ProcessPoolExecutor
 
 from python.utils.zooniverse_utils import ZooniverseUtils
-from python.utils.csv_excel_utils import CsvUtils, ExcelUtils, fill_dict_from_dict
+from python.utils.manifest_store import ManifestStore
+from python.classification_analysis.kswap import parse_created_at
+from python.classification_analysis.event_log import ClassificationEventLog
+from python.utils.csv_excel_utils import CsvUtils, CsvOffsetIndex, ExcelUtils, RowSink, \
+    fill_dict_from_dict, read_excel_fieldnames
 from python.vars.project_info import first_workflow_id, beta_group_2_first_workflow_id, second_workflow_id
 from python.vars.paths_and_ids import experiment_manifest_path, simulation_manifest_path, negative_manifest_path, \
-    marking_manifest_path, classifications_csv_path, unprocessed_classifications_csv_path, \
-    cleaned_classifications_csv_path, swap_classifications_csv_path, golds_csv_path, \
+    marking_manifest_path, classifications_csv_path, classifications_csv_index_path, \
+    unprocessed_classifications_csv_path, cleaned_classifications_csv_path, swap_classifications_csv_path, \
+    golds_csv_path, \
     cleaned_classifications_manifest_path, swap_classifications_manifest_path, golds_manifest_path, \
     first_unprocessed_row_manifest_path, cleaned_classifications_manifest_csv_path, \
     swap_classifications_manifest_csv_path, golds_manifest_csv_path, \
     first_unprocessed_row_manifest_csv_path, consensus_classifications_csv_path, \
-    consensus_classifications_manifest_path, consensus_classifications_manifest_csv_path
+    consensus_classifications_manifest_path, consensus_classifications_manifest_csv_path, ingestion_watermark_path, \
+    cleaned_classifications_db_path
 from python.vars.fieldnames import consensus_classification_fieldnames, golds_fieldnames, \
     first_unprocessed_row_fieldnames
 
@@ -22,15 +34,209 @@ while os.getcwd()[-20:] != "CountertopDarkMatter":
     os.chdir(os.path.join(".."))
 
 
-class ProcessClassificationsCSV:
-    first_valid_row = 100  # TODO: UPDATE FIRST_UNPROCESSED MANIFEST WITH THIS (CORRECTED) VALUE
+class ParsedClassification:
+    """
+    A row of the 'classifications.csv' Zooniverse export, parsed once and shared by every converter. Its JSON
+    fields are each decoded on first access; the decoded values must not be modified by converters.
+        row: dictionary with the export's fieldnames as keys, and its (string) cells as values
+    """
+    def __init__(self, row):
+        self.row = row
+
+    def __getitem__(self, key):
+        return self.row[key]
+
+    @cached_property
+    def metadata(self):
+        return json.loads(self.row['metadata'])
+
+    @cached_property
+    def annotations(self):
+        return json.loads(self.row['annotations'])
+
+    @property
+    def annotation(self):
+        """
+        The first (task's) annotation.
+        """
+        return self.annotations[0]
+
+    @cached_property
+    def subject_data(self):
+        return json.loads(self.row['subject_data'].replace("null", "false"))
+
+    @cached_property
+    def is_valid(self):
+        """
+        Whether the classified subject carries the '!subject_id' metadata that conversion relies on (the subjects of
+        the first, prototype uploads do not).
+        """
+        return '!subject_id' in list(self.subject_data.values())[0]
+
+    @cached_property
+    def subject_znv_id(self):
+        return list(self.subject_data.keys())[0]
+
+    @cached_property
+    def subject_type(self):
+        """
+        The first letter of the subject's '!subject_id' ('e' for experiment, 's' for simulation, 'n' for negative,
+        'm' for marking).
+        """
+        return list(self.subject_data.values())[0]['!subject_id'][0]
+
+    @cached_property
+    def feedback_success(self):
+        """
+        Whether a training subject was classified correctly (None if the subject gave no feedback).
+        """
+        try:
+            return list(self.metadata['feedback'].values())[0][0]['success']
+        except KeyError:
+            return None
+
+    @cached_property
+    def seconds_spent_classifying(self):
+        return (parse_timestamp(self.metadata['finished_at'])
+                - parse_timestamp(self.metadata['started_at'])).total_seconds()
+
+
+def parse_timestamp(timestamp):
+    """
+    Parses an ISO-8601 timestamp of the Zooniverse export (eg. "2020-05-04T19:36:00.894Z").
+    """
+    # (Before Python 3.11, 'fromisoformat' does not accept the "Z" suffix)
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
 
+class IngestionWatermark:
+    """
+    Record of which classifications of the 'classifications.csv' Zooniverse export have been processed, by
+    'classification_id' (row numbers are not stable across regenerated exports). Every ID up to 'watermark' counts
+    as processed; processed IDs above it are kept in 'recent_ids', such that classifications arriving out of ID order
+    are still processed. Only the highest 'max_recent_ids' of these are kept, the watermark being raised past the
+    others when saved; a classification arriving after more than 'max_recent_ids' higher IDs is therefore skipped.
+    """
+    def __init__(self, path=ingestion_watermark_path, max_recent_ids=10000):
+        self.path = path
+        self.max_recent_ids = max_recent_ids
+        self.watermark = 0
+        self.recent_ids = set()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                state = json.load(f)
+            self.watermark = state['watermark']
+            self.recent_ids = set(state['recent_ids'])
+
+    @property
+    def max_classification_id(self):
+        return max(self.recent_ids, default=self.watermark)
+
+    def is_processed(self, classification_id):
+        return classification_id <= self.watermark or classification_id in self.recent_ids
+
+    def add(self, classification_id):
+        if classification_id > self.watermark:
+            self.recent_ids.add(classification_id)
+
+    def compact(self):
+        if len(self.recent_ids) > self.max_recent_ids:
+            recent_ids = sorted(self.recent_ids)
+            n_dropped = len(recent_ids) - self.max_recent_ids
+            self.watermark = recent_ids[n_dropped - 1]
+            self.recent_ids = set(recent_ids[n_dropped:])
+
+    def save(self):
+        self.compact()
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump({'max_classification_id': self.max_classification_id,
+                       'watermark': self.watermark,
+                       'recent_ids': sorted(self.recent_ids)}, f)
+        os.replace(temporary_path, self.path)
+
+
+class CleanedClassificationsStore:
+    """
+    The cleaned classifications (as in the cleaned classifications manifest) kept in an SQLite database, indexed by
+    'classification_id' and 'subject_znv_id', such that rows are looked up without scanning the manifest. Rows are
+    kept as JSON objects of their (string) cells, as they would be read from the manifest CSV. On first use, the
+    rows already in the manifest (in the manifest store, or else the manifest CSV) are imported.
+    """
+    def __init__(self, db_file=cleaned_classifications_db_path, csv_path=cleaned_classifications_manifest_csv_path,
+                 timeout=10):
+        self.db_file = db_file
+        self.csv_path = csv_path
+        self.timeout = timeout
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout)
+        self.create(conn)
+        return conn
+
+    def create(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS cleaned_classifications '
+                     '(classification_id INTEGER PRIMARY KEY, subject_znv_id INTEGER, row TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS cleaned_classifications_subject_znv_id '
+                     'ON cleaned_classifications (subject_znv_id)')
+        if conn.execute('SELECT 1 FROM cleaned_classifications LIMIT 1').fetchone() is None:
+            manifest_store = ManifestStore()
+            if manifest_store.get_manifest(self.csv_path) and manifest_store.get_fieldnames('cleaned_classifications'):
+                # (The manifest CSV being a view of the manifest store, which may be out of date)
+                self.add_rows(conn, CsvUtils(self.csv_path, store=manifest_store).iter_rows(dict_reader=True))
+            elif os.path.exists(self.csv_path):
+                with open(self.csv_path, 'r') as f:
+                    self.add_rows(conn, csv.DictReader(f))
+            conn.commit()
+
+    @staticmethod
+    def add_rows(conn, rows):
+        """
+        Adds cleaned classification rows (dictionaries), replacing those with the same classification ID.
+        """
+        conn.executemany('INSERT OR REPLACE INTO cleaned_classifications VALUES (?, ?, ?)',
+                         ((int(row['classification_id']), int(row['subject_znv_id']) if row['subject_znv_id'] else None,
+                           json.dumps(dict((key, '' if value is None else str(value)) for key, value in row.items())))
+                          for row in rows))
+
+    def write_rows(self, rows_list, dict_writer=True):
+        """
+        Adds rows like 'CsvUtils.write_rows' (with 'dict_writer'), such that the store can be written by a RowSink.
+        """
+        with self.connect() as conn:
+            self.add_rows(conn, [rows_list] if type(rows_list) is dict else rows_list)
+        conn.close()
+
+    def get_many(self, ids, column='classification_id'):
+        """
+        Returns a dictionary like 'ID': cleaned classification row (dictionary) of the rows whose 'column'
+        ('classification_id' or 'subject_znv_id') is in 'ids', in a single query. For 'subject_znv_id', the row is
+        that of the subject's first classification. IDs with no row are left out.
+        """
+        assert column in ['classification_id', 'subject_znv_id']
+        conn = self.connect()
+        try:
+            conn.execute('CREATE TEMP TABLE ids (id INTEGER PRIMARY KEY)')
+            conn.executemany('INSERT OR IGNORE INTO ids VALUES (?)', ((int(ID),) for ID in ids))
+            rows = conn.execute(f'SELECT {column}, row FROM cleaned_classifications JOIN ids ON {column} = ids.id '
+                                f'ORDER BY classification_id DESC').fetchall()
+        finally:
+            conn.close()
+        return dict((ID, json.loads(row)) for ID, row in rows)
+
+
+class ProcessClassificationsCSV:
     def __init__(self):
         """
         Creating 'CsvUtils' and 'ExcelUtils' for all relevant CSV data-files and manifests (excel & CSV record-files).
         """
+        # Store of the running manifests (see 'ManifestStore'); their excel files and CSVs are exported from it
+        self.manifest_store = ManifestStore()
         # Classifications CSV obtained from Zooniverse
         self.classifications_csv = CsvUtils(classifications_csv_path)
+        # Index of the byte offsets of its rows, such that processing resumes at the first unprocessed row directly
+        self.classifications_csv_index = CsvOffsetIndex(classifications_csv_path, classifications_csv_index_path)
+        self.export_fieldnames = self.classifications_csv.fieldnames_list
         # CSV of classifications not previously processed
         self.unprocessed_classifications_csv = CsvUtils(unprocessed_classifications_csv_path,
                                                         self.classifications_csv.fieldnames_list)
@@ -38,6 +244,11 @@ class ProcessClassificationsCSV:
         self.cleaned_classifications_fieldnames = self.get_cleaned_classifications_fieldnames()
         self.cleaned_classifications_csv = CsvUtils(cleaned_classifications_csv_path,
                                                     self.cleaned_classifications_fieldnames)
+        self.clean_row_template = self.get_clean_row_template(self.cleaned_classifications_fieldnames)
+        # Store of the cleaned classifications, indexed for lookups by classification and subject ID
+        self.cleaned_classifications_store = CleanedClassificationsStore()
+        # Binary log of the ingested classifications, for analyses that scan them without parsing CSVs
+        self.classification_event_log = ClassificationEventLog()
         # Classifications CSV wherein first-workflow annotations are converted into a form amenable to (k)SWAP
         self.swap_classifications_csv = CsvUtils(swap_classifications_csv_path,
                                                  self.classifications_csv.fieldnames_list)
@@ -47,68 +258,229 @@ class ProcessClassificationsCSV:
         # CSV used by 'consensus_analysis' for classifications made on the 'Inspect' workflow
         self.consensus_classifications_csv = CsvUtils(consensus_classifications_csv_path,
                                                       consensus_classification_fieldnames)
-        # Manifests (excel files) keeping running-records of the data written into the aforementioned CSVs
+        # Manifests (excel files) keeping running-records of the data written into the aforementioned CSVs;
+        # kept in the manifest store, such that rows are appended in one transaction
         self.cleaned_classifications_manifest = ExcelUtils(cleaned_classifications_manifest_path,
-                                                           self.cleaned_classifications_fieldnames)
+                                                           self.cleaned_classifications_fieldnames,
+                                                           store=self.manifest_store)
         self.swap_classifications_manifest = ExcelUtils(swap_classifications_manifest_path,
-                                                        self.classifications_csv.fieldnames_list)
-        self.golds_manifest = ExcelUtils(golds_manifest_path, golds_fieldnames)
+                                                        self.classifications_csv.fieldnames_list,
+                                                        store=self.manifest_store)
+        self.golds_manifest = ExcelUtils(golds_manifest_path, golds_fieldnames, store=self.manifest_store)
         self.consensus_classifications_manifest = ExcelUtils(consensus_classifications_manifest_path,
-                                                             consensus_classification_fieldnames)
+                                                             consensus_classification_fieldnames,
+                                                             store=self.manifest_store)
         # Manifest tracking which rows of classifications have been processed on which dates
         self.first_unprocessed_row_manifest = ExcelUtils(first_unprocessed_row_manifest_path,
-                                                         first_unprocessed_row_fieldnames)
-        # Manifest backups (CSVs), to protect against seemingly-random corruption
+                                                         first_unprocessed_row_fieldnames, store=self.manifest_store)
+        # Manifest backups (CSVs), to protect against seemingly-random corruption; views of the same tables of the
+        # manifest store as the manifests above, such that rows are only written to the latter
         self.cleaned_classifications_manifest_csv = CsvUtils(cleaned_classifications_manifest_csv_path,
-                                                             self.cleaned_classifications_manifest.fieldnames_list)
+                                                             self.cleaned_classifications_manifest.fieldnames_list,
+                                                             store=self.manifest_store)
         self.swap_classifications_manifest_csv = CsvUtils(swap_classifications_manifest_csv_path,
-                                                          self.swap_classifications_manifest.fieldnames_list)
-        self.golds_manifest_csv = CsvUtils(golds_manifest_csv_path, self.golds_manifest.fieldnames_list)
+                                                          self.swap_classifications_manifest.fieldnames_list,
+                                                          store=self.manifest_store)
+        self.golds_manifest_csv = CsvUtils(golds_manifest_csv_path, self.golds_manifest.fieldnames_list,
+                                           store=self.manifest_store)
         self.consensus_classifications_manifest_csv = CsvUtils(consensus_classifications_manifest_csv_path,
-                                                               consensus_classification_fieldnames)
+                                                               consensus_classification_fieldnames,
+                                                               store=self.manifest_store)
         self.first_unprocessed_row_manifest_csv = CsvUtils(first_unprocessed_row_manifest_csv_path,
-                                                           self.first_unprocessed_row_manifest.fieldnames_list)
+                                                           self.first_unprocessed_row_manifest.fieldnames_list,
+                                                           store=self.manifest_store)
 
     def process_classification_export(self, download_export=False, generate_new_export=False,
-                                      update_first_unprocessed_row=False, start_row=None, end_row=None):
+                                      update_first_unprocessed_row=False, start_row=None, end_row=None, chunk_size=1000,
+                                      skip_processed=True, n_workers=1):
         """
-        Performs all the necessary processing for a new Zooniverse classifications export.
+        Performs all the necessary processing for a new Zooniverse classifications export. The export is streamed:
+        each unprocessed row is read once and fanned out to the unprocessed, cleaned, SWAP, golds and consensus
+        CSVs / manifests in a single pass, such that memory use does not grow with the size of the export.
             download_export: 'True' if the classifications export need be downloaded, 'False' if it exists locally
             generate_new_export: 'True' if a new export need be generated (to include the most recent classifications);
                                  'False' to use the last generated. Only needed if 'generate' is True.
-            update_first_unprocessed_row: 'True' to update the manifest tracking which classifications have been processed
-            start_row: Zooniverse classifications CSV row number at which to start processing;
-                       overwrites the default 'first_unprocessed_row'
+            update_first_unprocessed_row: 'True' to update the records tracking which classifications have been
+                                          processed (the ingestion watermark and the 'first_unprocessed_row'
+                                          manifest)
+            start_row: Zooniverse classifications CSV row number at which to start processing; by default, the first
+                       row with a classification ID above the ingestion watermark
             end_row: Zooniverse classifications CSV row number at which to end processing;
-                     if None, process all classifications past 'first_unprocessed_row' (or 'start_row', if given)
+                     if None, process all classifications past 'start_row'
+            chunk_size: number of rows buffered for each CSV / manifest before they are written
+            skip_processed: 'True' to skip the classifications already processed (by ID), 'False' to (re)process
+                            every row from 'start_row'
+            n_workers: if greater than 1, rows are converted on a pool of this many processes, in chunks of
+                       'chunk_size' rows (see 'iter_converted_chunks'); None for the number of CPUs
         """
         if download_export is True:
             ZooniverseUtils().generate_classification_export(generate_new=generate_new_export)
-        rows_processed, new_first_unprocessed_row = self.write_unprocessed_classifications_csv(start_row, end_row)
+        watermark = self.get_ingestion_watermark()
+        if not start_row:
+            start_row = self.classifications_csv_index.first_row_after(watermark.watermark) + 1
+        skip_watermark = watermark if skip_processed is True else None
+        if n_workers == 1:
+            converted = self.iter_converted_rows(self.iter_unprocessed_rows(start_row, end_row), skip_watermark)
+        else:
+            converted = itertools.chain.from_iterable(
+                self.iter_converted_chunks(start_row, end_row, skip_watermark, chunk_size, n_workers))
+        sinks = self.get_sinks(chunk_size)
+        rows_read, rows_processed = 0, 0
+        for classification_id, converted_rows in converted:
+            rows_read += 1
+            if skip_processed is True and watermark.is_processed(classification_id):
+                continue
+            if converted_rows is not None:
+                for sink_name, converted_row in converted_rows:
+                    # (The event log skips classifications it already holds)
+                    sinks[sink_name].append(converted_row)
+                rows_processed += 1
+            watermark.add(classification_id)
+        for sink in sinks.values():
+            sink.flush()
         if update_first_unprocessed_row is True:
-            self.update_first_unprocessed_row_csv(rows_processed, new_first_unprocessed_row)
-        self.write_cleaned_classifications()
-        first_workflow_unprocessed_rows, second_workflow_unprocessed_rows = self.separate_unprocessed_rows()
-        self.write_swap_classifications(first_workflow_unprocessed_rows)
-        self.write_consensus_classifications(second_workflow_unprocessed_rows)
-
-    def write_unprocessed_classifications_csv(self, start_row=None, end_row=None):
-        """
-        Writes a CSV of unprocessed classifications using the rows of the 'classifications.csv'
-        Zooniverse export and the information in the 'first_unprocessed_row.xlsx' manifest.
-            start_row: Zooniverse classifications CSV row number at which to start processing;
-                       overwrites the default 'first_unprocessed_row' obtained from 'first_unprocessed_row.xlsx'
-            end_row: Zooniverse classifications CSV row number at which to end processing;
-                     if None, process all classifications past 'first_unprocessed_row' (or 'start_row', if given)
+            watermark.save()
+            self.update_first_unprocessed_row_csv(rows_processed, start_row + rows_read)
+
+    def get_sinks(self, chunk_size):
+        """
+        Clears the CSVs of converted classifications; returns a dictionary of the sinks (RowSink instances, and the
+        classification event log) that rows are written to, writing the CSVs and appending to the running manifests
+        (in the manifest store, which the manifest CSVs are views of) and to the event log.
+        """
+        for converted_csv in [self.unprocessed_classifications_csv, self.cleaned_classifications_csv,
+                              self.swap_classifications_csv, self.golds_csv, self.consensus_classifications_csv]:
+            converted_csv.clear()
+        return {'unprocessed': RowSink([self.unprocessed_classifications_csv], chunk_size, dict_writer=False),
+                'cleaned': RowSink([self.cleaned_classifications_csv, self.cleaned_classifications_manifest,
+                                    self.cleaned_classifications_store], chunk_size),
+                'swap': RowSink([self.swap_classifications_csv, self.swap_classifications_manifest], chunk_size),
+                'golds': RowSink([self.golds_csv, self.golds_manifest], chunk_size),
+                'consensus': RowSink([self.consensus_classifications_csv, self.consensus_classifications_manifest],
+                                     chunk_size),
+                'events': self.classification_event_log}
+
+    def iter_unprocessed_rows(self, start_row, end_row=None):
         """
-        self.unprocessed_classifications_csv.clear()
-        if not start_row:
-            start_row = self.get_first_unprocessed_row()
-        unprocessed_rows = self.classifications_csv.read_rows(start_row=start_row - 1, end_row=end_row)
-        self.unprocessed_classifications_csv.write_rows(unprocessed_rows)
-        rows_processed = len(unprocessed_rows)
-        new_first_unprocessed_row = start_row + rows_processed + 1
-        return rows_processed, new_first_unprocessed_row
+        Yields the rows (lists) of the 'classifications.csv' Zooniverse export from row number 'start_row' (the
+        header being row 1) to 'end_row', seeking to 'start_row' with the export's offset index.
+        """
+        for row in self.classifications_csv_index.iter_rows(start_row=max(start_row - 1, 1), end_row=end_row):
+            if row:
+                yield row
+
+    def iter_converted_chunks(self, start_row, end_row, watermark, chunk_size, n_workers):
+        """
+        Splits the rows from 'start_row' to 'end_row' (as in 'iter_unprocessed_rows') into chunks of 'chunk_size'
+        rows, starting at byte offsets found with the export's offset index, and converts them on a pool of
+        'n_workers' processes; yields the chunks' lists of converted rows (see 'iter_converted_rows') in their
+        original order. At most twice as many chunks as there are workers are converted ahead of the one yielded.
+            watermark: IngestionWatermark of the classifications to skip (None to skip none)
+        """
+        index = self.classifications_csv_index
+        index.update()
+        start_index = max(start_row - 1, 1)
+        n_indexed = len(index.offsets)
+        stop_index = min(end_row + 1, n_indexed) if end_row else n_indexed
+        chunks = [(index.offset(i), min(chunk_size, stop_index - i))
+                  for i in range(start_index, stop_index, chunk_size)]
+        if not end_row or end_row + 1 > n_indexed:
+            # Rows past the indexed part of the export (not yet ended by a newline)
+            chunks.append((index.offset(max(start_index, n_indexed)), end_row + 1 - max(start_index, n_indexed)
+                           if end_row else None))
+        stop_at_empty_row = not end_row
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_conversion_worker,
+                                 initargs=(index.csv_path, self.export_fieldnames, self.clean_row_template,
+                                           watermark)) as executor:
+            chunks = iter(chunks)
+            futures = deque(executor.submit(convert_chunk, *chunk, stop_at_empty_row)
+                            for chunk in itertools.islice(chunks, 2 * (n_workers or os.cpu_count())))
+            while futures:
+                converted, ended = futures.popleft().result()
+                yield converted
+                if ended:
+                    for future in futures:
+                        future.cancel()
+                    break
+                for chunk in itertools.islice(chunks, 1):
+                    futures.append(executor.submit(convert_chunk, *chunk, stop_at_empty_row))
+
+    def iter_converted_rows(self, rows, watermark=None):
+        """
+        Yields the classification ID and the converted rows (see 'convert_row') of each row of the Zooniverse export
+        in 'rows'; the converted rows are None for classifications already processed according to 'watermark'.
+        """
+        id_column = self.export_fieldnames.index('classification_id')
+        for row in rows:
+            classification_id = int(row[id_column])
+            if watermark is not None and watermark.is_processed(classification_id):
+                yield classification_id, None
+            else:
+                yield classification_id, self.convert_row(row)
+
+    def convert_row(self, row):
+        """
+        Converts a row of the Zooniverse export for every CSV it belongs in; returns a list of tuples like
+        (sink name (see 'get_sinks'), converted row), or None if the row is not valid (see
+        'ParsedClassification.is_valid').
+        """
+        cl = ParsedClassification(dict(zip(self.export_fieldnames, row)))
+        if not cl.is_valid:
+            return None
+        converted_rows = [('unprocessed', row), ('cleaned', self.get_clean_row(cl))]
+        workflow_id = int(cl['workflow_id'])
+        if workflow_id in [first_workflow_id, beta_group_2_first_workflow_id]:
+            swap_row, gold_row = self.get_swap_rows(cl)
+            converted_rows.append(('swap', swap_row))
+            if gold_row is not None:
+                converted_rows.append(('golds', gold_row))
+        elif workflow_id == second_workflow_id:
+            converted_rows.append(('consensus', self.get_consensus_row(cl)))
+        converted_rows.append(('events', self.get_event(cl)))
+        return converted_rows
+
+    def get_event(self, cl):
+        """
+        Returns the ClassificationEventLog event of a ParsedClassification.
+        """
+        workflow_id = int(cl['workflow_id'])
+        if workflow_id == second_workflow_id:
+            label = {'Yes': 1, 'No': 0}.get(cl.annotation['value'])
+        else:
+            label = self.get_swap_annotation_value(cl.subject_type,
+                                                   'positive' if cl.annotation['value'] else 'negative',
+                                                   cl.feedback_success)
+        # (Users not logged in are identified by their user names, as in (k)SWAP)
+        try:
+            user = int(cl['user_id'])
+        except ValueError:
+            user = cl['user_name']
+        return (int(cl['classification_id']), user, int(cl['subject_ids']), workflow_id,
+                -1 if label is None else label, parse_created_at(cl['created_at']), cl.subject_type)
+
+    @classmethod
+    def row_converter(cls, export_fieldnames, clean_row_template):
+        """
+        Returns an instance that only converts rows (see 'convert_row'), without opening any CSV or manifest; used
+        by worker processes.
+        """
+        converter = cls.__new__(cls)
+        converter.export_fieldnames = export_fieldnames
+        converter.clean_row_template = clean_row_template
+        return converter
+
+    def get_ingestion_watermark(self):
+        """
+        Returns the IngestionWatermark; if none was saved yet, it is started from the 'first_unprocessed_row.xlsx'
+        manifest (every classification before its first unprocessed row counting as processed).
+        """
+        watermark = IngestionWatermark()
+        if not os.path.exists(watermark.path):
+            first_unprocessed_row = self.get_first_unprocessed_row()
+            if first_unprocessed_row > 1:
+                self.classifications_csv_index.update()
+                watermark.watermark = int(self.classifications_csv_index.ids[:first_unprocessed_row - 1].max())
+        return watermark
 
     def get_first_unprocessed_row(self):
         """
@@ -116,54 +488,32 @@ class ProcessClassificationsCSV:
         'classifications.csv' Zooniverse export that has not yet been processed.
         """
         rows = self.first_unprocessed_row_manifest.read_rows(start_row=1)
-        if rows == first_unprocessed_row_fieldnames:
+        # (The first row being the column headers, of a manifest with no other rows yet)
+        if len(rows) < 2:
             return 0
         return int(rows[-1][-1])
 
     def update_first_unprocessed_row_csv(self, rows_processed, new_first_unprocessed_row):
         """
-        Updates the 'first_unprocessed_row.xlsx' manifest with information about the classifications just processed.
+        Updates the 'first_unprocessed_row.xlsx' manifest (and so its CSV, see 'ManifestStore') with information about
+        the classifications just processed.
         """
         self.first_unprocessed_row_manifest.write_rows([date.today().strftime("%m-%d-%Y"), rows_processed,
                                                         new_first_unprocessed_row])
-        self.first_unprocessed_row_manifest_csv.write_rows([date.today().strftime("%m-%d-%Y"), rows_processed,
-                                                            new_first_unprocessed_row])
-
-    def separate_unprocessed_rows(self):
-        """
-        Separates the unprocessed rows corresponding to classifications coming from the 'first' and 'second' workflows.
-        """
-        unprocessed_rows = self.unprocessed_classifications_csv.read_rows(dict_reader=True)
-        first_workflow_rows, second_workflow_rows = [], []
-        for unprocessed_row in unprocessed_rows:
-            workflow_id = int(unprocessed_row['workflow_id'])
-            if workflow_id in [first_workflow_id, beta_group_2_first_workflow_id]:
-                first_workflow_rows.append(unprocessed_row)
-            elif workflow_id == second_workflow_id:
-                second_workflow_rows.append(unprocessed_row)
-        return first_workflow_rows, second_workflow_rows
 
-    def write_cleaned_classifications(self):
-        """
-        Writes the CSV of 'cleaned' classifications (flattening embedded data structures, ignoring unnecessary
-        fields, and adding some custom fields), appends to the running CSV and manifest.
-        """
-        self.cleaned_classifications_csv.clear()
-        clean_row_template = self.get_clean_row_template(self.cleaned_classifications_fieldnames)
-        rows = self.parse_rows(self.unprocessed_classifications_csv)
-        clean_rows = []
-        for row in rows:
-            clean_row = clean_row_template.copy()
-            metadata = self.flatten_dict(row['metadata'])
-            annotations = self.flatten_dict(row['annotations'])
-            subject_data = self.flatten_dict(row['subject_data'])
-            custom_fields = self.get_custom_fields(metadata, subject_data, annotations)
-            for data_dict in [row, metadata, annotations, subject_data, custom_fields]:
-                clean_row = fill_dict_from_dict(clean_row, data_dict, convert_types_to_string=[bool])
-            clean_rows.append(clean_row)
-        self.cleaned_classifications_csv.write_rows(clean_rows, dict_writer=True)
-        self.cleaned_classifications_manifest.write_rows(clean_rows, dict_writer=True)
-        self.cleaned_classifications_manifest_csv.write_rows(clean_rows, dict_writer=True)
+    def get_clean_row(self, cl):
+        """
+        Returns the 'cleaned' row (flattening embedded data structures, ignoring unnecessary fields, and adding
+        some custom fields) of a ParsedClassification.
+        """
+        clean_row = self.clean_row_template.copy()
+        metadata = self.flatten_dict(cl.metadata)
+        annotations = self.flatten_dict(cl.annotation)
+        subject_data = self.flatten_dict(cl.subject_data)
+        custom_fields = self.get_custom_fields(cl, metadata, subject_data, annotations)
+        for data_dict in [cl.row, metadata, annotations, subject_data, custom_fields]:
+            clean_row = fill_dict_from_dict(clean_row, data_dict, convert_types_to_string=[bool])
+        return clean_row
 
     @staticmethod
     def get_clean_row_template(organized_fieldnames):
@@ -176,10 +526,14 @@ class ProcessClassificationsCSV:
         """
         Organizes all fieldnames to appear in the cleaned classifications CSV.
         """
-        experiment_fieldnames = (ExcelUtils(experiment_manifest_path)).fieldnames_list
-        simulation_fieldnames = (ExcelUtils(simulation_manifest_path)).fieldnames_list
-        negative_fieldnames = (ExcelUtils(negative_manifest_path)).fieldnames_list
-        marking_fieldnames = (ExcelUtils(marking_manifest_path)).fieldnames_list
+        # (Subject manifests kept in the manifest store are read from it, their excel files possibly being missing)
+        experiment_fieldnames = self.manifest_store.get_fieldnames('experiment') \
+            or read_excel_fieldnames(experiment_manifest_path)
+        simulation_fieldnames = self.manifest_store.get_fieldnames('simulation') \
+            or read_excel_fieldnames(simulation_manifest_path)
+        negative_fieldnames = self.manifest_store.get_fieldnames('negative') \
+            or read_excel_fieldnames(negative_manifest_path)
+        marking_fieldnames = read_excel_fieldnames(marking_manifest_path)
         custom_fieldnames = ['user_device', 'seconds_spent_classifying', 'subject_znv_id', '!subject_id',
                              'subject_type', 'classification', 'ellipse_adjusted', 'success']
         zooniverse_fieldnames = ['classification_id', 'workflow_id', 'workflow_name', 'user_name', 'user_id',
@@ -201,23 +555,12 @@ class ProcessClassificationsCSV:
             [organized_fieldnames.append(fn) for fn in fieldnames_list if fn not in organized_fieldnames]
         return organized_fieldnames
 
-    @staticmethod
-    def parse_rows(classifications_csv, start_row=None, end_row=None):
-        """
-        Using JSON to load the data structures of the classification CSV into python objects.
-        """
-        rows = classifications_csv.read_rows(start_row, end_row, dict_reader=True)
-        for row in rows:
-            row['metadata'] = json.loads(row['metadata'])
-            row['annotations'] = json.loads(row['annotations'])[0]
-            row['subject_data'] = json.loads(row['subject_data'].replace("null", "false"))
-        return rows
-
     @staticmethod
     def flatten_dict(dictionary):
         """
-        Appends key-value pairs from dictionaries inside 'dictionary' to 'dictionary'.
+        Returns a copy of 'dictionary' to which the key-value pairs from dictionaries inside 'dictionary' are appended.
         """
+        dictionary = dict(dictionary)
         sub_dict_keys = []
         for key in dictionary.keys():
             if type(dictionary[key]) == dict:
@@ -238,17 +581,15 @@ class ProcessClassificationsCSV:
             # dictionary.pop(sub_dict_key)
         return dictionary
 
-    def get_custom_fields(self, metadata, subject_data, annotations):
+    def get_custom_fields(self, cl, metadata, subject_data, annotations):
         """
         Uses information from the 'classifications.csv' Zooniverse export to create new, useful column data.
+            cl: ParsedClassification
+            metadata, subject_data, annotations: the classification's flattened JSON fields
         """
         custom_fields = {'user_device': metadata['user_agent'].split('(')[1].split(')')[0]}
-        y0, m0, d0, h0, mi0, s0, ms0 = [int(s) for s in re.split("[-T:Z.]", metadata['started_at']) if s != '']
-        y, m, d, h, mi, s, ms = [int(s) for s in re.split("[-T:Z.]", metadata['finished_at']) if s != '']
-        start_time = datetime(year=y0, month=m0, day=d0, hour=h0, minute=mi0, second=s0, microsecond=ms0)
-        end_time = datetime(year=y, month=m, day=d, hour=h, minute=mi, second=s, microsecond=ms)
-        custom_fields['seconds_spent_classifying'] = (end_time - start_time).total_seconds()
-        custom_fields['subject_znv_id'] = list(subject_data.keys())[0]
+        custom_fields['seconds_spent_classifying'] = cl.seconds_spent_classifying
+        custom_fields['subject_znv_id'] = cl.subject_znv_id
         if 'e' in subject_data['!subject_id']:
             custom_fields['subject_type'] = "experiment"
         elif 's' in subject_data['!subject_id']:
@@ -262,10 +603,8 @@ class ProcessClassificationsCSV:
             custom_fields['ellipse_adjusted'] = (float(annotations['rx']) / float(annotations['ry']) != 2.0)
         except KeyError:
             pass
-        try:
-            custom_fields['success'] = list(metadata['feedback'].values())[0][0]['success']
-        except KeyError:
-            pass
+        if 'feedback' in metadata:
+            custom_fields['success'] = cl.feedback_success
         return custom_fields
 
     @staticmethod
@@ -283,47 +622,30 @@ class ProcessClassificationsCSV:
             classification_type = value  # "Yes" or "No"
         return classification_type
 
-    def write_swap_classifications(self, first_workflow_unprocessed_rows):
-        """
-        Writes SWAP-converted annotations and 'golds' CSVs.
-        """
-        self.swap_classifications_csv.clear()
-        self.golds_csv.clear()
-        swap_classification_rows = []
-        gold_rows = []
-        for row in first_workflow_unprocessed_rows:
-            metadata, annotations, subject_data = \
-                json.loads(row['metadata']), json.loads(row['annotations'])[0], json.loads(row['subject_data'])
-            if annotations['value']:
-                label = 'positive'
-            else:
-                label = 'negative'
-            subject_type = list(subject_data.values())[0]['!subject_id'][0]
-            try:
-                success = list(metadata['feedback'].values())[0][0]['success']
-            except KeyError:
-                success = None  # (applies to experiment images)
-            annotations['value'] = self.get_swap_annotation_value(subject_type, label, success)
-            annotations.pop("task_label", None)
-            row['annotations'] = json.dumps([annotations])
-            swap_classification_rows.append(row)
-            gold_label = None
-            if subject_type == "e":
-                continue
-            elif subject_type == "s":
-                gold_label = 1
-            elif subject_type == "n":
-                gold_label = 0
-            subject_znv_id = list(subject_data.keys())[0]
-            gold_row = {'subject_id': subject_znv_id, 'gold': str(gold_label)}
-            gold_rows.append(gold_row)
-        self.swap_classifications_csv.write_rows(swap_classification_rows, dict_writer=True)
-        self.swap_classifications_manifest.write_rows(swap_classification_rows, dict_writer=True)
-        self.swap_classifications_manifest_csv.write_rows(swap_classification_rows, dict_writer=True)
-        if gold_rows:
-            self.golds_csv.write_rows(gold_rows, dict_writer=True)
-            self.golds_manifest.write_rows(gold_rows, dict_writer=True)
-            self.golds_manifest_csv.write_rows(gold_rows, dict_writer=True)
+    def get_swap_rows(self, cl):
+        """
+        Returns the SWAP-converted row of a first-workflow ParsedClassification, and its 'golds' row (None if the
+        subject is not a training subject).
+        """
+        annotation = dict(cl.annotation)
+        if annotation['value']:
+            label = 'positive'
+        else:
+            label = 'negative'
+        # ('feedback_success' is None for experiment images)
+        annotation['value'] = self.get_swap_annotation_value(cl.subject_type, label, cl.feedback_success)
+        annotation.pop("task_label", None)
+        swap_row = dict(cl.row)
+        swap_row['annotations'] = json.dumps([annotation])
+        gold_label = None
+        if cl.subject_type == "e":
+            return swap_row, None
+        elif cl.subject_type == "s":
+            gold_label = 1
+        elif cl.subject_type == "n":
+            gold_label = 0
+        gold_row = {'subject_id': cl.subject_znv_id, 'gold': str(gold_label)}
+        return swap_row, gold_row
 
     @staticmethod
     def get_swap_annotation_value(subject_type, label=None, success=None):
@@ -351,32 +673,53 @@ class ProcessClassificationsCSV:
                 swap_annotation_value = 0
         return swap_annotation_value
 
-    def write_consensus_classifications(self, second_workflow_unprocessed_rows):
-        """
-        Writes a CSV amenable to 'consensus_analysis'.
-        """
-        self.consensus_classifications_csv.clear()
-        consensus_classification_rows = []
-        for row in second_workflow_unprocessed_rows:
-            value = json.loads(row['annotations'])[0]['value']
-            label = None
-            if value == 'Yes':
-                label = 'tenebrite'
-            elif value == 'No':
-                label = 'negative'
-            # For non-logged in users, using 'user_ip' in place of 'user_id'
-            user_id = y if (y := row['user_id']) else row['user_ip']
-            consensus_classification_rows.append({
-                'classification_id': row['classification_id'],
-                'subject_id': row['subject_ids'],
+    @staticmethod
+    def get_consensus_row(cl):
+        """
+        Returns the row, amenable to 'consensus_analysis', of a second-workflow ParsedClassification.
+        """
+        value = cl.annotation['value']
+        label = None
+        if value == 'Yes':
+            label = 'tenebrite'
+        elif value == 'No':
+            label = 'negative'
+        # For non-logged in users, using 'user_ip' in place of 'user_id'
+        user_id = y if (y := cl['user_id']) else cl['user_ip']
+        return {'classification_id': cl['classification_id'],
+                'subject_id': cl['subject_ids'],
                 'user_id': user_id,
-                'label': label})
-        self.consensus_classifications_csv.write_rows(consensus_classification_rows, dict_writer=True)
-        self.consensus_classifications_manifest.write_rows(consensus_classification_rows, dict_writer=True)
-        self.consensus_classifications_manifest_csv.write_rows(consensus_classification_rows, dict_writer=True)
+                'label': label}
+
+
+# Export path, row converter and ingestion watermark of the workers of 'iter_converted_chunks'
+_conversion_worker = None
+
+
+def init_conversion_worker(csv_path, export_fieldnames, clean_row_template, watermark):
+    global _conversion_worker
+    _conversion_worker = (csv_path, ProcessClassificationsCSV.row_converter(export_fieldnames, clean_row_template),
+                          watermark)
+
+
+def convert_chunk(start_offset, n_rows, stop_at_empty_row):
+    """
+    Converts up to 'n_rows' rows (None for every row) of the export from the byte 'start_offset' on; returns their
+    list of converted rows (see 'iter_converted_rows') and whether an empty row (the end of the export) was reached,
+    if 'stop_at_empty_row'.
+    """
+    csv_path, converter, watermark = _conversion_worker
+    with open(csv_path, 'rb') as binary_file:
+        binary_file.seek(start_offset)
+        rows = []
+        for row in itertools.islice(csv.reader(io.TextIOWrapper(binary_file)), n_rows):
+            if row:
+                rows.append(row)
+            elif stop_at_empty_row:
+                return list(converter.iter_converted_rows(rows, watermark)), True
+        return list(converter.iter_converted_rows(rows, watermark)), False
 
 
 if __name__ == '__main__':
     pcc = ProcessClassificationsCSV()
-    pcc.process_classification_export(download_export=False, update_first_unprocessed_row=False,
-                                      start_row=pcc.first_valid_row, end_row=None)
+    pcc.process_classification_export(download_export=False, update_first_unprocessed_row=False)
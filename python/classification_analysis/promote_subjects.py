@@ -10,6 +10,7 @@ from python.google_drive_folder.google_drive import GoogleDriveUtils
 from python.utils.zooniverse_utils import ZooniverseUtils, upload_subjects_to_zooniverse
 from python.utils.ellipse_utils import ellipse_eq_lhs, ellipse_extrema, draw_dashed_ellipse
 from python.utils.csv_excel_utils import CsvUtils, ExcelUtils, fill_dict_from_dict, verify_dict
+from python.classification_analysis.process_classifications_csv import CleanedClassificationsStore
 
 from python.vars.fieldnames import marking_fieldnames
 from python.vars.project_info import marking_subject_set_id
@@ -17,8 +18,8 @@ from python.vars.subject_parameters import marking_edge_buffer_pixels, marking_i
     marking_border_gaps_angular_extent, marking_border_segments_angular_extent, marking_border_opacity, \
     marking_border_color, marking_border_thickness
 from python.vars.paths_and_ids import marking_subjects_folder, fetched_images_folder, marking_manifest_path, \
-    marking_manifest_csv_path, marking_csv_path, cleaned_classifications_manifest_csv_path, manifests_folder_drive_id, \
-    manifests_csv_folder_drive_id, marking_folder_drive_id
+    marking_manifest_csv_path, marking_csv_path, manifests_folder_drive_id, manifests_csv_folder_drive_id, \
+    marking_folder_drive_id
 
 # Ensuring that the current working directory is "CountertopDarkMatter"
 while os.getcwd()[-20:] != "CountertopDarkMatter":
@@ -26,15 +27,23 @@ while os.getcwd()[-20:] != "CountertopDarkMatter":
 
 """
 (kSWAP instance).users[(user ID)] is an instance of the 'User' class, having attributes:
-    user_id, classes, k = len(classes), gamma, user_default, user_score, confusion_matrix, and
-    history = [(subject ID), ('user_score')]
-        Example: [201, {"0": [0.6, 0.4], "1": [0.3, 0.7]}]
+    user_id, index, classes, k = len(classes), gamma, user_default, user_score, confusion_matrix,
+    score_versions = [every 'user_score' the user has held]
+        Example: [{"0": [0.5, 0.5], "1": [0.5, 0.5]}, {"0": [0.6, 0.4], "1": [0.3, 0.7]}]
                     (  {"0": [True Negative, False Positive],
                         "1": [False Negative, True Positive]  )
+    and history (a 'UserHistory'), with parallel arrays 'subject_id' and 'score_version'.
 (kSWAP instance).subjects[(subject ID)] is an instance of the 'Subject' class, having attributes:
     subject_id, score, classes, gold_label, epsilon, retired (boolean), retired_as, seen, and
-    history = [(classification ID), (user ID), ('user_score'), (submitted classification), (subject score)]
-        Example: [1001, 101, {"0": [0.6, 0.4], "1": [0.3, 0.7]}, 1, {"0": 0.35, "1": 0.65}]
+    history (a 'SubjectHistory'), with parallel arrays 'classification_id', 'user_index', 'score_version',
+    'label' (submitted classification), 'created_at' (classification time, UTC seconds since the epoch) and
+    'posterior' (subject score, per class).
+(kSWAP instance).posteriors_at(subject IDs, classification_id=..., time=...) returns the saved subject scores after
+    a given classification or at a given time, and (kSWAP instance).posterior_trajectories(subject IDs, since, until)
+    yields saved subject histories, without loading every history.
+(kSWAP instance).history_rows(subject) expands a subject's history into tuples like
+    ((classification ID), (user ID), ('user_score'), (submitted classification), (subject score), (posterior-to-prior))
+        Example: (1001, 101, {"0": [0.6, 0.4], "1": [0.3, 0.7]}, 1, {"0": 0.35, "1": 0.65}, 6.5)
 """
 
 
@@ -51,14 +60,16 @@ class PromoteSubjects:
             positive_prior: the prior probability for an image to contain a meltpatch (ie. to be `positive')
             promotion_threshold: the ratio of posterior and prior positive probabilities required for features' promotion
         """
+        self.swap = swap
         self.subjects = list(swap.subjects.values())
         self.positive_prior = positive_prior
         self.promotion_threshold = promotion_threshold * positive_prior
         if clear_folders is True:
             self.clear_folders()
-        self.cleaned_classifications_csv = CsvUtils(cleaned_classifications_manifest_csv_path)
+        self.cleaned_classifications_store = CleanedClassificationsStore()
         self.marking_csv = CsvUtils(marking_csv_path, fieldnames_list=marking_fieldnames)
-        self.marking_manifest = ExcelUtils(marking_manifest_path, fieldnames_list=marking_fieldnames)
+        # (Batched: rows written to the manifest are buffered until 'flush', which streams them after the existing ones)
+        self.marking_manifest = ExcelUtils(marking_manifest_path, fieldnames_list=marking_fieldnames, batched=True)
         self.marking_manifest_csv = CsvUtils(marking_manifest_csv_path, self.marking_manifest.fieldnames_list)
         self.gd = GoogleDriveUtils()
 
@@ -195,12 +206,7 @@ class PromoteSubjects:
         """
         subjects_marking_classification_ids = dict((subject, []) for subject in subjects)
         for subject in subjects:
-            subject_history = subject.history
-            classifications = np.array([sh[-2] for sh in subject_history][1:])  # ignore placeholder first entry
-            marking_indices = list(np.where(classifications == 1)[0] + 1)  # `+ 1' to account for ignoring placeholder
-            for marking_index in marking_indices:
-                classification_id = subject_history[marking_index][0]
-                subjects_marking_classification_ids[subject].append(classification_id)
+            subjects_marking_classification_ids[subject] = subject.history.classification_ids_labelled(1)
         return subjects_marking_classification_ids
 
     @staticmethod
@@ -221,14 +227,16 @@ class PromoteSubjects:
         return eligible_subjects_marking_classification_ids
 
     def get_subjects_markings_parameters(self, subjects_marking_classification_ids):
+        # Get the rows of the cleaned classifications corresponding with every marking classification
+        classification_rows = self.cleaned_classifications_store.get_many(
+            [ID for classification_ids in subjects_marking_classification_ids.values() for ID in classification_ids])
         # Iterate through subjects
         for subject in subjects_marking_classification_ids.keys():
             classification_ids = subjects_marking_classification_ids[subject]
             # Iterate through the markings that were made on the subject
             marking_dicts = []
             for ID in classification_ids:
-                # Get the row of the cleaned classification CSV corresponding with this classification
-                classification_row = self.cleaned_classifications_csv.find_row(ID, column_header='classification_id')
+                classification_row = classification_rows[int(ID)]
                 # Append dictionary containing the marking's classification ID and parameters to `marking_dicts'
                 marking_dicts.append({"classification_id": ID,
                                       "cx": float(classification_row['x']),
@@ -363,10 +371,12 @@ class PromoteSubjects:
                 subjects_features_past_positive_threshold.pop(key)
         return subjects_features_past_positive_threshold
 
-    @staticmethod
-    def get_classification_ids_subject_history(subject, classification_ids):
-        classification_ids = [int(ID) for ID in classification_ids]
-        return [sh for sh in subject.history[1:] if int(sh[0]) in classification_ids]
+    def get_classification_ids_subject_history(self, subject, classification_ids):
+        """
+        Returns the entries of the subject's history (as tuples, see `kSWAP.history_rows') made by the given
+        classifications.
+        """
+        return self.swap.history_rows(subject, classification_ids)
 
     def calculate_positive_probability(self, user_scores, prior_positive_probability, do_not_depreciate=True):
         positive_probability = [prior_positive_probability]
@@ -409,6 +419,9 @@ class PromoteSubjects:
         """
         # Getting a list of subject instances (the keys of the dictionary passed to the function)
         subjects = list(subjects_features_to_promote.keys())
+        # Getting the cleaned classification rows of the subjects (one per subject)
+        subjects_clean_rows = self.cleaned_classifications_store.get_many([s.subject_id for s in subjects],
+                                                                          column='subject_znv_id')
         # Initializing a list to contain to-be-promoted features' metadata dictionaries
         feature_to_promote_metadata_dicts = []
         # Initializing indexing variable used to assign marking subjects' unique IDs
@@ -428,8 +441,7 @@ class PromoteSubjects:
                 similar_markings_average_xdim = sum(similar_marking_xdims) / len(similar_marking_xdims)
                 similar_markings_average_ydim = sum(similar_marking_ydims) / len(similar_marking_ydims)
                 similar_markings_average_angle = sum(similar_marking_angles) / len(similar_marking_angles)
-                subject_clean_row = self.cleaned_classifications_csv.find_row(str(subject.subject_id),
-                                                                              column_header='subject_znv_id')
+                subject_clean_row = subjects_clean_rows[int(subject.subject_id)]
                 feature_to_promote_metadata = self.marking_metadata_row_template.copy()
                 feature_to_promote_metadata = fill_dict_from_dict(feature_to_promote_metadata, subject_clean_row)
                 marking_subject_id = 'm' + str(mrk_i)
@@ -533,6 +545,7 @@ class PromoteSubjects:
             verify_dict('marking', metadata_dict, marking_fieldnames)
         self.marking_csv.write_rows(feature_to_promote_metadata_dicts, dict_writer=True)
         self.marking_manifest.write_rows(feature_to_promote_metadata_dicts, dict_writer=True)
+        self.marking_manifest.flush()
         self.marking_manifest_csv.write_rows(feature_to_promote_metadata_dicts, dict_writer=True)
 
     def upload(self):
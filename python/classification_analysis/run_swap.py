@@ -9,19 +9,20 @@ while os.getcwd()[-20:] != "CountertopDarkMatter":
 
 
 def SWAP(classifications_csv_path, golds_csv_path, workflow_id, retirement_lower_threshold,
-         retirement_classification_limit):
+         retirement_classification_limit, n_workers=1, event_log=None):
     # Retrieve swap configuration from 'offline_swap_config.py'
     swap_config = Config(workflow_id, retirement_lower_threshold, retirement_classification_limit)
     # Create a kSWAP instance
     swap = kSWAP(config=swap_config)
-    # Load subjects, users from 'offline_swap.db'
-    swap = swap.load()
-    # Run kSWAP on CSV files
-    swap.run_offline(golds_csv_path, classifications_csv_path)
-    # Save new subjects, users to 'offline_swap.db'
-    swap.save()
-    # Retrieve updated 'subjects', 'users' dictionaries from 'offline_swap.db'
+    # Load subjects, users from the 'offline_swap.db' snapshot (histories are read from the database on demand)
+    swap = swap.load_snapshot()
+    # Run kSWAP on CSV files, or on the classifications of the event log not yet seen (scoring subjects on
+    # 'n_workers' processes)
+    swap.run_offline(golds_csv_path, classifications_csv_path, n_workers=n_workers, event_log=event_log)
+    # Save new subjects, users to 'offline_swap.db' and its snapshot
+    swap.save_snapshot()
+    # Retrieve updated 'subjects', 'users' dictionaries from the snapshot
     del swap
     swap = kSWAP(config=swap_config)
-    swap = swap.load()
+    swap = swap.load_snapshot()
     return swap, swap_config
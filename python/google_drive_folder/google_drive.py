@@ -151,7 +151,10 @@ class GoogleDriveUtils:
         """
         gfile_name_id_dict = self.get_gfile_name_id_dict(staging_ground_folder_drive_id)
         gfile_name_id_list = list(zip(gfile_name_id_dict.keys(), gfile_name_id_dict.values()))
-        ExcelUtils(name_id_manifest_path).write_rows(gfile_name_id_list)
+        # (Batched: the rows are streamed after the existing ones, without loading the whole workbook)
+        name_id_manifest = ExcelUtils(name_id_manifest_path, batched=True)
+        name_id_manifest.write_rows(gfile_name_id_list)
+        name_id_manifest.flush()
         CsvUtils(name_id_manifest_csv_path).write_rows(gfile_name_id_list)
 
     def get_gfile_name_id_dict(self, gfolder_id, gfile_name_id_dict=None):
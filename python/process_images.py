@@ -8,6 +8,7 @@ from shutil import copyfile
 from python.utils.exif_utils import ImageExif
 from python.utils.git_utils import push_files_to_GitHub
 from python.utils.misc_utils import get_numerical_class_vars
+from python.utils.manifest_store import ManifestStore
 from python.utils.cv_utils import get_grain_stats, get_glare_area
 from python.google_drive_folder.google_drive import GoogleDriveUtils
 from python.utils.zooniverse_utils import upload_subjects_to_zooniverse
@@ -29,7 +30,7 @@ from python.vars.paths_and_ids import unprocessed_images_zeroth_folder, experime
     simulation_subjects_folder, simulation_csv_path, experiment_manifest_path, experiment_manifest_csv_path, \
     simulation_manifest_path, simulation_manifest_csv_path, name_id_manifest_path, name_id_manifest_csv_path, \
     processed_folders_manifest_path, processed_folders_manifest_csv_path, processed_slabs_manifest_path, \
-    processed_slabs_manifest_csv_path
+    processed_slabs_manifest_csv_path, manifest_db_path, databases_folder_drive_id
 
 # Ensuring that the current working directory is "CountertopDarkMatter"
 while os.getcwd()[-20:] != "CountertopDarkMatter":
@@ -711,17 +712,26 @@ class ProcessImages:
             # Initializing a class used to interact with Google Drive
             self.gd = GoogleDriveUtils()
         # Initializing...
+        # ... Store of the running manifests, of which the excel files and backup CSVs below are views
+        self.manifest_store = ManifestStore()
         # ... Manifests
-        self.experiment_manifest = ExcelUtils(experiment_manifest_path, experiment_fieldnames)
-        self.simulation_manifest = ExcelUtils(simulation_manifest_path, simulation_fieldnames)
-        self.processed_slabs_manifest = ExcelUtils(processed_slabs_manifest_path, processed_slabs_fieldnames)
-        self.processed_folders_manifest = ExcelUtils(processed_folders_manifest_path, processed_folders_fieldnames)
-        # ... Backup (CSV) manifests
-        self.experiment_manifest_csv = CsvUtils(experiment_manifest_csv_path, experiment_fieldnames)
-        self.simulation_manifest_csv = CsvUtils(simulation_manifest_csv_path, simulation_fieldnames)
-        self.processed_slabs_manifest_csv = CsvUtils(processed_slabs_manifest_csv_path, processed_slabs_fieldnames)
+        self.experiment_manifest = ExcelUtils(experiment_manifest_path, experiment_fieldnames,
+                                              store=self.manifest_store)
+        self.simulation_manifest = ExcelUtils(simulation_manifest_path, simulation_fieldnames,
+                                              store=self.manifest_store)
+        self.processed_slabs_manifest = ExcelUtils(processed_slabs_manifest_path, processed_slabs_fieldnames,
+                                                   store=self.manifest_store)
+        self.processed_folders_manifest = ExcelUtils(processed_folders_manifest_path, processed_folders_fieldnames,
+                                                     store=self.manifest_store)
+        # ... Backup (CSV) manifests (written with the manifests, being views of the same tables)
+        self.experiment_manifest_csv = CsvUtils(experiment_manifest_csv_path, experiment_fieldnames,
+                                                store=self.manifest_store)
+        self.simulation_manifest_csv = CsvUtils(simulation_manifest_csv_path, simulation_fieldnames,
+                                                store=self.manifest_store)
+        self.processed_slabs_manifest_csv = CsvUtils(processed_slabs_manifest_csv_path, processed_slabs_fieldnames,
+                                                     store=self.manifest_store)
         self.processed_folders_manifest_csv = CsvUtils(processed_folders_manifest_csv_path,
-                                                       processed_folders_fieldnames)
+                                                       processed_folders_fieldnames, store=self.manifest_store)
         # ... Zooniverse CSV manifests
         self.experiment_csv = CsvUtils(experiment_csv_path, experiment_fieldnames)
         self.simulation_csv = CsvUtils(simulation_csv_path, simulation_fieldnames)
@@ -821,7 +831,6 @@ class ProcessImages:
                     'image_dimensions': first_folder.uncropped_image_dimensions_in})
         if slabs_metadata:
             self.processed_slabs_manifest.write_rows(slabs_metadata, dict_writer=True)
-            self.processed_slabs_manifest_csv.write_rows(slabs_metadata, dict_writer=True)
 
     def create_experiment_subjects(self):
         """
@@ -865,10 +874,9 @@ class ProcessImages:
                 # Updating 'second_folder_experiment_id0' such that it equals the starting experiment ID of the next
                 # second folder; eg. if 2 images were created, the next starting ID is (previous starting ID) + 2 + 1
                 second_folder_experiment_id0 = second_folder_final_id + 1
-        # Writing experiment subjects' metadata into the Zooniverse manifest, running manifest and CSV copy
+        # Writing experiment subjects' metadata into the Zooniverse manifest and running manifest (and so CSV copy)
         self.experiment_csv.write_rows(experiment_subjects_metadata, dict_writer=True)
         self.experiment_manifest.write_rows(experiment_subjects_metadata, dict_writer=True)
-        self.experiment_manifest_csv.write_rows(experiment_subjects_metadata, dict_writer=True)
 
     def create_simulation_subjects(self):
         """
@@ -908,10 +916,9 @@ class ProcessImages:
                 # Updating 'second_folder_simulation_id0' such that it equals the starting simulation ID of the next
                 # second folder; eg. if 2 images were created, the next starting ID is (previous starting ID) + 2 + 1
                 second_folder_simulation_id0 = second_folder_final_id + 1
-            # Writing simulation subjects' metadata into the Zooniverse manifest, running manifest and CSV copy
+            # Writing simulation subjects' metadata into the Zooniverse manifest and running manifest (and so CSV copy)
             self.simulation_csv.write_rows(simulation_subjects_metadata, dict_writer=True)
             self.simulation_manifest.write_rows(simulation_subjects_metadata, dict_writer=True)
-            self.simulation_manifest_csv.write_rows(simulation_subjects_metadata, dict_writer=True)
 
     def sample_experiment_subjects(self, second_folder):
         """
@@ -949,7 +956,6 @@ class ProcessImages:
                 'simulation_id_endpoints': simulation_id_endpoints})
         if folders_metadata:
             self.processed_folders_manifest.write_rows(folders_metadata, dict_writer=True)
-            self.processed_folders_manifest_csv.write_rows(folders_metadata, dict_writer=True)
 
     def upload_subjects(self):
         # Uploading subjects to...
@@ -961,7 +967,11 @@ class ProcessImages:
         self.gd.upload_folder(simulation_subjects_folder, self.gd.simulation_folder_id, replace_existing=True)
 
     def upload_records(self):
+        # Bringing every manifest's excel file and CSV copy up to date with the manifest store
+        self.manifest_store.export()
         # Uploading to Google Drive...
+        # ... The manifest store
+        self.gd.upload_file(manifest_db_path, databases_folder_drive_id, replace_existing=True)
         # ... Running manifests
         self.gd.upload_file(experiment_manifest_path, self.gd.manifests_folder_id, replace_existing=True)
         self.gd.upload_file(simulation_manifest_path, self.gd.manifests_folder_id, replace_existing=True)
@@ -975,24 +985,18 @@ class ProcessImages:
         self.gd.upload_file(processed_folders_manifest_csv_path, self.gd.manifests_folder_id, replace_existing=True)
         self.gd.upload_file(name_id_manifest_csv_path, self.gd.manifests_csv_folder_id, replace_existing=True)
         # Pushing all of the above to GitHub
-        files_to_push = [experiment_manifest_path, simulation_manifest_path, processed_slabs_manifest_path,
-                         processed_folders_manifest_path, name_id_manifest_path, experiment_manifest_csv_path,
-                         simulation_manifest_csv_path, processed_slabs_manifest_csv_path,
+        files_to_push = [manifest_db_path, experiment_manifest_path, simulation_manifest_path,
+                         processed_slabs_manifest_path, processed_folders_manifest_path, name_id_manifest_path,
+                         experiment_manifest_csv_path, simulation_manifest_csv_path, processed_slabs_manifest_csv_path,
                          processed_folders_manifest_csv_path, name_id_manifest_csv_path]
         push_files_to_GitHub(files_to_push, f"update records, {date.today()}")
 
 
 if __name__ == '__main__':
-    # TODO: delete all 'remove_file'
-    from python.utils.file_utils import remove_file
-    remove_file(processed_slabs_manifest_path)
-    remove_file(processed_slabs_manifest_csv_path)
-    remove_file(experiment_manifest_path)
-    remove_file(experiment_manifest_csv_path)
-    remove_file(simulation_manifest_path)
-    remove_file(simulation_manifest_csv_path)
-    remove_file(processed_folders_manifest_path)
-    remove_file(processed_folders_manifest_csv_path)
+    # TODO: delete all 'drop'
+    manifest_store = ManifestStore()
+    for manifest in ['processed_slabs', 'experiment', 'simulation', 'processed_folders']:
+        manifest_store.drop(manifest)
     clear_folder(experiment_subjects_folder)
     clear_folder(simulation_subjects_folder)
     t = time.time()
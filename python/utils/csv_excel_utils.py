@@ -1,6 +1,10 @@
+import io
 import os
 import csv
+import zlib
+import numpy as np
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
 
 from python.vars.paths_and_ids import name_id_manifest_path
 
@@ -60,6 +64,20 @@ def verify_dict(dictionary, dict_name, correct_fieldnames, ignore_keys=None):
             print(f'In the {dict_name} dictionary, the value of the key {key} is None.')
 
 
+def read_excel_fieldnames(excel_file_path):
+    """
+    Returns the column headers (first row) of an excel file, reading only that row (in openpyxl's read-only mode)
+    rather than loading the whole workbook; an empty list if the file does not exist.
+    """
+    if not os.path.exists(excel_file_path):
+        return []
+    wb = openpyxl.load_workbook(filename=excel_file_path, read_only=True)
+    try:
+        return list(next(wb.active.iter_rows(min_row=1, max_row=1, values_only=True), []))
+    finally:
+        wb.close()
+
+
 def get_rows_dimension(rows_list):
     """
     Get the number of rows and columns in 'rows_list.' Used in 'write_rows' class methods.
@@ -80,27 +98,44 @@ def get_rows_dimension(rows_list):
     return rows_list, rows, cols
 
 
+def get_row_lists(rows_list, rows_list_rows, fieldnames_list, dict_writer=False):
+    """
+    Returns the rows of 'rows_list' (as returned by 'get_rows_dimension') as a list of lists of cells, ordered as
+    'fieldnames_list' if the rows are dictionaries ('dict_writer' True).
+    """
+    if rows_list_rows == 0:
+        return []
+    if rows_list_rows == 1:
+        rows_list = [rows_list]
+    if dict_writer is True:
+        return [[row.get(fieldname) for fieldname in fieldnames_list] for row in rows_list]
+    return [list(row) for row in rows_list]
+
+
 class CsvUtils:
-    def __init__(self, csv_path, fieldnames_list=None):
+    def __init__(self, csv_path, fieldnames_list=None, store=None):
         """
         If the CSV does not exist, it is created with 'fieldnames_list' as its columns headers.
         If the CSV does exist and fieldnames_list is not given, it is read from the existing CSV.
             csv_path: file path to the CSV file, existing or to-be-created
             fieldnames_list: list of column headers
+            store: ManifestStore instance; if the CSV is that of a manifest kept in the store, rows are read from and
+                   written to the store instead, the CSV only being written by the store's 'export'
         """
         self.csv_path = csv_path
+        self.store = store
+        self.manifest = store.get_manifest(csv_path) if store is not None else None
+        if self.manifest is not None:
+            store.create(self.manifest, fieldnames_list)
         if fieldnames_list:
             self.fieldnames_list = fieldnames_list
-        elif os.path.exists(csv_path):
-            self.fieldnames_list = self.read_rows(0, 0)[0]
+        elif self.manifest is not None or os.path.exists(csv_path):
+            self.fieldnames_list = self.read_fieldnames()
         else:
             self.fieldnames_list = []
-        if not os.path.exists(self.csv_path):
+        if self.manifest is None and not os.path.exists(self.csv_path):
             self.create_csv()
-        try:
-            existing_fieldnames = self.read_rows(0, 0)[0]
-        except IndexError:
-            existing_fieldnames = []
+        existing_fieldnames = self.read_fieldnames()
         try:
             assert self.fieldnames_list == existing_fieldnames
         except AssertionError:
@@ -111,6 +146,15 @@ class CsvUtils:
             if need_new == 'y':
                 self.fieldnames_list = eval(input('Enter a new list of fieldnames: '))
 
+    def read_fieldnames(self):
+        """
+        Returns the column headers (first row) of self.csv_path, reading only that row; an empty list if it has none.
+        """
+        if self.manifest is not None:
+            return self.store.get_fieldnames(self.manifest)
+        with open(self.csv_path, 'r') as f:
+            return next(csv.reader(f), [])
+
     def create_csv(self):
         """
         Create a CSV at self.csv_path with the given columns headers.
@@ -127,6 +171,10 @@ class CsvUtils:
             rows_list: Single- or multi-dimensional list of csv rows to write.
         """
         rows_list, rows_list_rows, rows_list_cols = get_rows_dimension(rows_list)
+        if self.manifest is not None:
+            self.store.append(self.manifest,
+                              get_row_lists(rows_list, rows_list_rows, self.fieldnames_list, dict_writer))
+            return
         with open(self.csv_path, 'a', newline='') as f:
             if dict_writer is False:
                 csv_writer = csv.writer(f)
@@ -151,9 +199,17 @@ class CsvUtils:
             end_row: number of the last CSV row to be read
             dict_reader: 'False' to return a list of lists, 'True' to return a list of dicts
         """
+        return list(self.iter_rows(start_row, end_row, dict_reader))
+
+    def iter_rows(self, start_row=None, end_row=None, dict_reader=False):
+        """
+        Generator version of 'read_rows', yielding the rows one at a time, such that only one is held in memory.
+        """
         if start_row is None:
             start_row = 0
-        rows = []
+        if self.manifest is not None:
+            yield from self.iter_store_rows(start_row, end_row, dict_reader)
+            return
         with open(self.csv_path, 'r') as f:
             if dict_reader is False:
                 reader = csv.reader(f)
@@ -161,16 +217,40 @@ class CsvUtils:
                 reader = csv.DictReader(f)
             for i, row in enumerate(reader):
                 if end_row:
-                    if start_row <= i <= end_row:
-                        rows.append(row)
+                    if i > end_row:
+                        break
+                    if start_row <= i:
+                        yield row
                 else:
                     if start_row <= i and row:
-                        rows.append(row)
+                        yield row
                     elif not row:
                         break
-        return rows
+
+    def iter_store_rows(self, start_row, end_row=None, dict_reader=False):
+        """
+        'iter_rows' for a CSV kept in the manifest store: rows are numbered as in the CSV (the column headers being
+        row 0, unless 'dict_reader' is True), and their cells are strings, as they would be read from the CSV.
+        """
+        header_rows = 0 if dict_reader else 1
+        if not dict_reader and start_row == 0:
+            yield list(self.fieldnames_list)
+        offset = max(start_row - header_rows, 0)
+        limit = None if not end_row else max(end_row - header_rows - offset + 1, 0)
+        for row in self.store.iter_rows(self.manifest, offset, limit):
+            row = ['' if value is None else str(value) for value in row]
+            yield dict(zip(self.fieldnames_list, row)) if dict_reader else row
 
     def find_row(self, identifier, column_number=None, column_header=None):
+        if self.manifest is not None:
+            for row in self.iter_rows(dict_reader=column_number is None):
+                if column_number and type(identifier)(row[column_number]) == identifier:
+                    return row
+                if column_header and type(identifier)(row[column_header]) == identifier:
+                    return row
+            if not column_number and not column_header:
+                print('Either column_number or column_header must be passed.')
+            return None
         with open(self.csv_path, 'r') as f:
             if column_number:
                 csv_reader = csv.reader(f)
@@ -190,12 +270,231 @@ class CsvUtils:
         """
         Clear all content in self.csv_path, while keeping its columns headers.
         """
+        if self.manifest is not None:
+            self.store.clear(self.manifest)
+            return
         os.remove(self.csv_path)
         self.create_csv()
 
 
+class CsvOffsetIndex:
+    """
+    Sidecar index of the byte offset at which each record (row) of a CSV starts, and of each record's ID (eg. its
+    'classification_id'), such that reading can resume at any row by seeking to it, rather than by parsing every
+    row before it. Records are found by counting quotes, so newlines inside quoted fields do not end records.
+    Row numbers are those of 'CsvUtils.read_rows' (0 being the header).
+    The index is saved next to the CSV and checked against the CSV's size and modification time on 'update'. When
+    rows were appended to the CSV (and the last indexed record is unchanged), only the new rows are indexed;
+    otherwise the index is rebuilt.
+    """
+    def __init__(self, csv_path, index_path=None, id_fieldname='classification_id'):
+        """
+            csv_path: path to the indexed CSV
+            index_path: path to the index (default: the CSV's path with the suffix '.idx.npz')
+            id_fieldname: fieldname of the column of integer IDs to index (IDs that are not integers are indexed
+                          as -1, as are the header and blank rows)
+        """
+        self.csv_path = csv_path
+        self.index_path = index_path if index_path is not None else csv_path + '.idx.npz'
+        self.id_fieldname = id_fieldname
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        # Number of bytes indexed (up to the end of the last complete record), and the CSV's size and modification
+        # time when last indexed
+        self.indexed_size, self.size, self.mtime_ns = 0, -1, -1
+        self.tail_crc = 0
+        self.id_column = None
+        self.id_order = None
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.index_path):
+            return
+        with np.load(self.index_path) as index:
+            self.offsets, self.ids = index['offsets'], index['ids']
+            self.indexed_size, self.size, self.mtime_ns, self.tail_crc, self.id_column = \
+                [int(value) for value in index['state']]
+        if self.id_column < 0:
+            self.id_column = None
+
+    def save(self):
+        temporary_path = self.index_path + '.tmp.npz'
+        np.savez(temporary_path, offsets=self.offsets, ids=self.ids,
+                 state=np.array([self.indexed_size, self.size, self.mtime_ns, self.tail_crc,
+                                 -1 if self.id_column is None else self.id_column], dtype=np.int64))
+        os.replace(temporary_path, self.index_path)
+
+    def clear(self):
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.indexed_size, self.tail_crc, self.id_column = 0, 0, None
+
+    def is_current(self):
+        stat = os.stat(self.csv_path)
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+    def update(self):
+        """
+        Brings the index up to date with the CSV (see the class docstring); returns the number of rows indexed.
+        """
+        if self.is_current():
+            return len(self.offsets)
+        stat = os.stat(self.csv_path)
+        with open(self.csv_path, 'rb') as f:
+            if stat.st_size < self.indexed_size or not self.tail_matches(f):
+                self.clear()
+            f.seek(self.indexed_size)
+            offsets, ids = self.scan(f, self.indexed_size)
+        if offsets:
+            self.offsets = np.concatenate([self.offsets, np.array(offsets, dtype=np.int64)])
+            self.ids = np.concatenate([self.ids, np.array(ids, dtype=np.int64)])
+        self.size, self.mtime_ns = stat.st_size, stat.st_mtime_ns
+        self.id_order = None
+        self.save()
+        return len(self.offsets)
+
+    def tail_matches(self, f):
+        """
+        Whether the last indexed record of the CSV is unchanged.
+        """
+        if not len(self.offsets):
+            return True
+        f.seek(int(self.offsets[-1]))
+        return zlib.crc32(f.read(self.indexed_size - int(self.offsets[-1]))) == self.tail_crc
+
+    def scan(self, f, position, chunk_size=1 << 20):
+        """
+        Indexes the complete records from the byte 'position' of the (binary) file 'f' on; returns their offsets and
+        IDs. A last record not yet ended by a newline is left to be indexed by the next update.
+        """
+        offsets, ids = [], []
+        record_start, record, in_quotes = position, b'', False
+        leftover = b''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            lines = (leftover + chunk).split(b'\n')
+            leftover = lines.pop()
+            for line in lines:
+                line += b'\n'
+                record += line
+                # (Escaped quotes come in pairs, so only unpaired quotes open or close quoted fields)
+                if line.count(b'"') % 2:
+                    in_quotes = not in_quotes
+                if in_quotes:
+                    continue
+                offsets.append(record_start)
+                ids.append(self.parse_id(record, len(self.offsets) + len(offsets) - 1))
+                self.tail_crc = zlib.crc32(record)
+                record_start += len(record)
+                record = b''
+        self.indexed_size = record_start
+        return offsets, ids
+
+    def parse_id(self, record, row_number):
+        if row_number == 0:
+            header = next(csv.reader([record.decode()]), [])
+            self.id_column = header.index(self.id_fieldname) if self.id_fieldname in header else None
+            return -1
+        if self.id_column is None:
+            return -1
+        if self.id_column == 0:
+            field = record.split(b',', 1)[0]
+        else:
+            field = next(csv.reader([record.decode()]), [None] * (self.id_column + 1))[self.id_column]
+        try:
+            return int(field)
+        except (TypeError, ValueError):
+            return -1
+
+    def offset(self, row_number):
+        """
+        Returns the byte offset of the start of the row (the size of the indexed part of the CSV if the row is past
+        its end).
+        """
+        if row_number < len(self.offsets):
+            return int(self.offsets[row_number])
+        return self.indexed_size
+
+    def first_row_after(self, record_id):
+        """
+        Returns the number of the first row with an ID greater than 'record_id' (the number of indexed rows if there
+        is none).
+        """
+        self.update()
+        rows = np.flatnonzero(self.ids > record_id)
+        return int(rows[0]) if len(rows) else len(self.ids)
+
+    def find(self, record_id):
+        """
+        Returns the number of the row with the given ID, or None if there is none.
+        """
+        if self.id_order is None:
+            self.id_order = np.argsort(self.ids, kind='stable')
+        i = np.searchsorted(self.ids, record_id, sorter=self.id_order)
+        if i < len(self.ids) and self.ids[self.id_order[i]] == record_id:
+            return int(self.id_order[i])
+        return None
+
+    def iter_rows(self, start_row=None, end_row=None):
+        """
+        Like 'CsvUtils.iter_rows' (returning rows as lists), but seeking directly to 'start_row'. Rows past the
+        indexed part of the CSV are read too, by parsing on from its end.
+        """
+        self.update()
+        if start_row is None:
+            start_row = 0
+        with open(self.csv_path, 'rb') as binary_file:
+            start_row = min(start_row, len(self.offsets))
+            binary_file.seek(self.offset(start_row))
+            reader = csv.reader(io.TextIOWrapper(binary_file))
+            for i, row in enumerate(reader, start=start_row):
+                if end_row:
+                    if i > end_row:
+                        break
+                    yield row
+                else:
+                    if row:
+                        yield row
+                    else:
+                        break
+
+
+class RowSink:
+    def __init__(self, writers, chunk_size=1000, dict_writer=True):
+        """
+        Buffers rows to be written to one or more CSVs / excel files, writing them in chunks, such that rows can be
+        streamed into files without holding them all in memory nor writing (and saving) them one at a time.
+            writers: list of CsvUtils and/or ExcelUtils instances that every row is written to
+            chunk_size: number of rows buffered before they are written
+            dict_writer: 'True' if rows are dicts, 'False' if they are lists
+        """
+        self.writers = writers
+        self.chunk_size = chunk_size
+        self.dict_writer = dict_writer
+        self.buffer = []
+        self.n_rows = 0
+
+    def append(self, row):
+        self.buffer.append(row)
+        self.n_rows += 1
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered rows.
+        """
+        if not self.buffer:
+            return
+        for writer in self.writers:
+            writer.write_rows(self.buffer, dict_writer=self.dict_writer)
+        self.buffer = []
+
+
 class ExcelUtils:
-    def __init__(self, excel_file_path, fieldnames_list=None):
+    def __init__(self, excel_file_path, fieldnames_list=None, batched=False, store=None):
         """
         If the excel file does not exist, it is created with 'fieldnames_list' as its columns headers.
         If the excel file does exist and fieldnames_list is not given, it is read from the existing excel file;
@@ -203,30 +502,70 @@ class ExcelUtils:
         The first empty row in the excel file is found; its row number is stored in self.first_empty_row.
             csv_path: file path to the CSV file, existing or to-be-created
             fieldnames_list: list of column headers
+            batched: 'True' to buffer the rows appended by 'write_rows' until 'flush' is called, which writes them
+                     all at once. The workbook is then only loaded if it is read (or written at a given row), and
+                     self.first_empty_row is None.
+            store: ManifestStore instance; if the excel file is that of a manifest kept in the store, rows are read
+                   from and appended to the store instead, the excel file only being written by the store's 'export'
+                   (which self.wb and self.ws are loaded after)
         """
         self.excel_file_path = excel_file_path
         self.fieldnames_list = fieldnames_list
-        if not os.path.exists(excel_file_path):
-            self.create_excel()
-        self.wb, self.ws = self.configure_excel()
-        self.first_empty_row = self.get_first_empty_row()
-        if self.first_empty_row == 1:
-            self.write_fieldnames()
+        self.batched = batched
+        self.pending_rows = []
+        self._wb, self._ws = None, None
+        self.store = store
+        self.manifest = store.get_manifest(excel_file_path) if store is not None else None
+        if self.manifest is not None:
+            existing_fieldnames = store.create(self.manifest, fieldnames_list)
+            self.first_empty_row = self.get_first_empty_row()
+        else:
+            if not os.path.exists(excel_file_path):
+                self.create_excel()
+            existing_fieldnames = read_excel_fieldnames(excel_file_path) if batched else None
+            if batched and existing_fieldnames:
+                self.first_empty_row = None
+            else:
+                self.wb, self.ws = self.configure_excel()
+                self.first_empty_row = self.get_first_empty_row()
+                if self.first_empty_row == 1:
+                    self.write_fieldnames()
+                existing_fieldnames = self.read_rows(1, 1)
         if fieldnames_list:
             self.fieldnames_list = fieldnames_list
             try:
-                assert self.fieldnames_list == self.read_rows(1, 1)
+                assert self.fieldnames_list == existing_fieldnames
             except AssertionError:
                 need_new = input(f'Existing and passed fieldnames for {excel_file_path} do not match.'
-                                 f'\n\t The existing fieldnames were {self.read_rows(1, 1)}.'
+                                 f'\n\t The existing fieldnames were {existing_fieldnames}.'
                                  f'\n\t The fieldnames passed were: {self.fieldnames_list}.'
                                  f'\n\t Would you like to enter new fieldnames? [y/n]: ')
                 if need_new == 'y':
                     self.fieldnames_list = eval(input('Enter a new list of fieldnames: '))
         else:
-            self.fieldnames_list = self.read_rows(1, 1)
+            self.fieldnames_list = existing_fieldnames
         self.fieldname_columns_dict = self.get_fieldname_columns_dict()
 
+    @property
+    def wb(self):
+        if self._wb is None:
+            self._wb, self._ws = self.configure_excel()
+        return self._wb
+
+    @wb.setter
+    def wb(self, wb):
+        self._wb = wb
+
+    @property
+    def ws(self):
+        if self._ws is None:
+            self._wb, self._ws = self.configure_excel()
+        return self._ws
+
+    @ws.setter
+    def ws(self, ws):
+        self._ws = ws
+
     def create_excel(self):
         """
         Create an excel file at self.excel_file_path with the given column headers.
@@ -253,6 +592,8 @@ class ExcelUtils:
         If the name of a worksheet is not passed, the active (first)
         worksheet is used.
         """
+        if self.manifest is not None:
+            self.store.export(self.manifest)
         wb = openpyxl.load_workbook(filename=self.excel_file_path)
         if ws is None:
             ws = wb.active
@@ -262,6 +603,9 @@ class ExcelUtils:
         """
         Getting the first empty row of self.ws.
         """
+        if self.manifest is not None:
+            # Accounting for the fieldname row
+            return self.store.count(self.manifest) + 2
         # Accounting for known bug in ws.max_row
         if not self.ws.cell(self.ws.max_row, 1).value:
             for row in range(self.ws.max_row, 0, -1):
@@ -287,6 +631,8 @@ class ExcelUtils:
             start_row = 0
         if end_row is None:
             end_row = self.get_first_empty_row()
+        if self.manifest is not None:
+            return self.read_store_rows(start_row, end_row)
         rows = []
         if type(self.ws[start_row:end_row][0]) != tuple:
             return [c.value for c in self.ws[start_row:end_row]]
@@ -296,6 +642,18 @@ class ExcelUtils:
                 rows.append(row_values)
         return rows
 
+    def read_store_rows(self, start_row, end_row):
+        """
+        'read_rows' for an excel file kept in the manifest store, rows being numbered as in the excel file (the
+        column headers being row 1).
+        """
+        start_row = max(start_row, 1)
+        rows = [list(self.fieldnames_list)] if start_row == 1 else []
+        rows += self.store.iter_rows(self.manifest, max(start_row - 2, 0), max(end_row - max(start_row, 2) + 1, 0))
+        if start_row == end_row:
+            return rows[0] if rows else []
+        return rows
+
     def write_rows(self, rows_list, starting_row=None, dict_writer=False):
         """
         Write rows into self.ws, starting on row 'starting_row'.
@@ -308,36 +666,78 @@ class ExcelUtils:
             assert (len(self.fieldnames_list) == rows_list_cols)
         except AssertionError:
             print(f"ExcelUtils {self.excel_file_path}, write_rows: fieldname # columns and row # columns do not match.")
+        if self.manifest is not None:
+            if starting_row is not None:
+                print(f"ExcelUtils {self.excel_file_path}, write_rows: rows of manifests kept in the manifest store "
+                      f"can only be appended.")
+                return
+            self.store.append(self.manifest, get_row_lists(rows_list, rows_list_rows, self.fieldnames_list,
+                                                           dict_writer))
+            # (The workbook, if loaded, is no longer an up-to-date view)
+            self._wb, self._ws = None, None
+            return
+        # (Rows are lists of cells, ordered as 'fieldnames_list' if they were dictionaries; missing keys are empty)
+        rows = get_row_lists(rows_list, rows_list_rows, self.fieldnames_list, dict_writer)
+        if self.batched is True:
+            if starting_row is None:
+                self.pending_rows.extend(rows)
+                return
+            self.flush()
         if starting_row is None:
             sRow = self.get_first_empty_row()
         else:
             sRow = starting_row
-        for row in range(rows_list_rows):
-            if dict_writer is True:
-                for fieldname in self.fieldname_columns_dict.keys():
-                    col = self.fieldname_columns_dict[fieldname]
-                    try:
-                        cell_value = rows_list[row][fieldname]
-                    except KeyError:
-                        # Entered if `rows_list' only a dict (not a list of dicts)
-                        cell_value = rows_list[fieldname]
-                    try:
-                        self.ws.cell(row=(sRow + row), column=(col + 1)).value = cell_value
-                    except ValueError:
-                        self.ws.cell(row=(sRow + row), column=(col + 1)).value = str(cell_value)
-            else:
-                for col in range(rows_list_cols):
-                    if rows_list_rows == 1:
-                        cell_value = rows_list[col]
-                    else:
-                        cell_value = rows_list[row][col]
-                    try:
-                        self.ws.cell(row=(sRow + row), column=(col + 1)).value = cell_value
-                    except ValueError:
-                        self.ws.cell(row=(sRow + row), column=(col + 1)).value = str(cell_value)
+        for row, row_values in enumerate(rows):
+            for col, cell_value in enumerate(row_values):
+                try:
+                    self.ws.cell(row=(sRow + row), column=(col + 1)).value = cell_value
+                except ValueError:
+                    self.ws.cell(row=(sRow + row), column=(col + 1)).value = str(cell_value)
         self.wb.save(self.excel_file_path)
 
+    def flush(self):
+        """
+        Writes the rows buffered in batched mode after the existing rows, in a single pass: the existing rows are
+        streamed from the excel file (in openpyxl's read-only mode) into a new one written in write-only mode, which
+        then replaces it.
+        """
+        if not self.pending_rows:
+            return
+        existing_wb = openpyxl.load_workbook(filename=self.excel_file_path, read_only=True)
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet(title=existing_wb.active.title)
+        empty_rows = []
+        for row in existing_wb.active.iter_rows(values_only=True):
+            # (Empty rows are only kept if followed by a non-empty row, like in 'get_first_empty_row')
+            if all(value is None for value in row):
+                empty_rows.append(row)
+                continue
+            for empty_row in empty_rows:
+                ws.append(empty_row)
+            empty_rows = []
+            ws.append(row)
+        existing_wb.close()
+        for row in self.pending_rows:
+            ws.append([self.write_only_cell(ws, value) for value in row])
+        temporary_path = self.excel_file_path + '.tmp.xlsx'
+        wb.save(temporary_path)
+        os.replace(temporary_path, self.excel_file_path)
+        self.pending_rows = []
+        self._wb, self._ws = None, None
+
+    @staticmethod
+    def write_only_cell(ws, value):
+        try:
+            return WriteOnlyCell(ws, value=value)
+        except ValueError:
+            return WriteOnlyCell(ws, value=str(value))
+
     def clear(self):
+        self.pending_rows = []
+        if self.manifest is not None:
+            self.store.clear(self.manifest)
+            self._wb, self._ws = None, None
+            return
         self.wb.remove(self.ws)
         self.create_excel()
         self.wb, self.ws = self.configure_excel()
@@ -0,0 +1,395 @@
+import os
+import csv
+import sqlite3
+import difflib
+import datetime
+import openpyxl
+from collections import Counter
+from openpyxl.cell import WriteOnlyCell
+
+from python.vars.fieldnames import experiment_fieldnames, simulation_fieldnames, negative_fieldnames, \
+    classifications_fieldnames, golds_fieldnames, consensus_classification_fieldnames, \
+    first_unprocessed_row_fieldnames, processed_folders_fieldnames, processed_slabs_fieldnames
+from python.vars.paths_and_ids import manifest_db_path, experiment_manifest_path, experiment_manifest_csv_path, \
+    simulation_manifest_path, simulation_manifest_csv_path, negative_manifest_path, negative_manifest_csv_path, \
+    cleaned_classifications_manifest_path, cleaned_classifications_manifest_csv_path, \
+    swap_classifications_manifest_path, swap_classifications_manifest_csv_path, golds_manifest_path, \
+    golds_manifest_csv_path, consensus_classifications_manifest_path, consensus_classifications_manifest_csv_path, \
+    first_unprocessed_row_manifest_path, first_unprocessed_row_manifest_csv_path, processed_folders_manifest_path, \
+    processed_folders_manifest_csv_path, processed_slabs_manifest_path, processed_slabs_manifest_csv_path
+
+# Ensuring that the current working directory is "CountertopDarkMatter"
+while os.getcwd()[-20:] != "CountertopDarkMatter":
+    os.chdir(os.path.join(".."))
+
+# Manifests kept in the store, with key-value pairs:
+#   '(manifest / table name)': (fieldnames, excel manifest path, CSV manifest path)
+# The fieldnames of the cleaned classifications manifest depend on those of the subject manifests; they are taken from
+# the existing manifest, or the ExcelUtils / CsvUtils that first opens it.
+manifest_types = {
+    'experiment': (experiment_fieldnames, experiment_manifest_path, experiment_manifest_csv_path),
+    'simulation': (simulation_fieldnames, simulation_manifest_path, simulation_manifest_csv_path),
+    'negative': (negative_fieldnames, negative_manifest_path, negative_manifest_csv_path),
+    'processed_slabs': (processed_slabs_fieldnames, processed_slabs_manifest_path, processed_slabs_manifest_csv_path),
+    'processed_folders': (processed_folders_fieldnames, processed_folders_manifest_path,
+                          processed_folders_manifest_csv_path),
+    'cleaned_classifications': (None, cleaned_classifications_manifest_path,
+                                cleaned_classifications_manifest_csv_path),
+    'swap_classifications': (classifications_fieldnames, swap_classifications_manifest_path,
+                             swap_classifications_manifest_csv_path),
+    'golds': (golds_fieldnames, golds_manifest_path, golds_manifest_csv_path),
+    'consensus_classifications': (consensus_classification_fieldnames, consensus_classifications_manifest_path,
+                                  consensus_classifications_manifest_csv_path),
+    'first_unprocessed_row': (first_unprocessed_row_fieldnames, first_unprocessed_row_manifest_path,
+                              first_unprocessed_row_manifest_csv_path),
+}
+
+
+class ManifestStore:
+    """
+    The running manifests kept in a single SQLite database, with a table per manifest (see 'manifest_types') whose
+    columns are the manifest's fieldnames, such that appending rows is a single transaction however long the manifest
+    is. The excel manifests and their CSV backups are views of the tables, only (re)written by 'export' when they are
+    needed (eg. before being uploaded) and out of date. The database is in WAL mode, such that it can be read while
+    it is written to.
+    On first use of a manifest, the rows of its existing excel file and CSV are imported; if they disagree (eg. the
+    CSV backup holds rows that the excel file lost), they are merged, such that no row of either is lost. A view
+    changed since the store last wrote it is only overwritten if the table holds all of its rows.
+    Cells keep their type if it is a string, integer or float (or None, for empty cells); other values are kept as
+    strings, as they would be written to a CSV.
+    """
+    def __init__(self, db_file=manifest_db_path, timeout=10):
+        self.db_file = db_file
+        self.timeout = timeout
+
+    def connect(self):
+        db_folder = os.path.dirname(self.db_file)
+        if db_folder:
+            os.makedirs(db_folder, exist_ok=True)
+        conn = sqlite3.connect(self.db_file, timeout=self.timeout)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # Version of each manifest (incremented whenever it is written) and of its views when they were exported,
+        # with the size and modification time of the files then written
+        conn.execute('CREATE TABLE IF NOT EXISTS manifest_versions (manifest TEXT PRIMARY KEY, version INTEGER)')
+        conn.execute('CREATE TABLE IF NOT EXISTS view_versions (path TEXT PRIMARY KEY, version INTEGER, size INTEGER, '
+                     'mtime_ns INTEGER)')
+        if 'size' not in [column[1] for column in conn.execute('PRAGMA table_info(view_versions)')]:
+            conn.execute('ALTER TABLE view_versions ADD COLUMN size INTEGER')
+            conn.execute('ALTER TABLE view_versions ADD COLUMN mtime_ns INTEGER')
+        return conn
+
+    @staticmethod
+    def get_manifest(path):
+        """
+        Returns the name of the manifest of which 'path' is the excel file or CSV; None if it is not kept in the store.
+        """
+        for manifest, (fieldnames, excel_path, csv_path) in manifest_types.items():
+            if os.path.normpath(path) in [os.path.normpath(excel_path), os.path.normpath(csv_path)]:
+                return manifest
+        return None
+
+    @staticmethod
+    def get_views(manifest):
+        return manifest_types[manifest][1:]
+
+    @staticmethod
+    def quote(name):
+        return '"' + name.replace('"', '""') + '"'
+
+    @staticmethod
+    def to_cell(value):
+        if value is None or type(value) in [str, int, float]:
+            return value
+        return str(value)
+
+    @staticmethod
+    def table_fieldnames(conn, manifest):
+        return [column[1] for column in conn.execute(f'PRAGMA table_info({ManifestStore.quote(manifest)})')][1:]
+
+    def create(self, manifest, fieldnames_list=None):
+        """
+        Creates the table of 'manifest' if it does not exist, importing the rows of its existing excel file and CSV
+        (see 'merge_rows'); returns the manifest's fieldnames. The columns are those of the existing files if they
+        have any, else 'fieldnames_list' if it is given, else those of 'manifest_types'.
+        """
+        conn = self.connect()
+        try:
+            fieldnames = self.table_fieldnames(conn, manifest)
+            if fieldnames:
+                return fieldnames
+            views = [(path, *self.read_view(path)) for path in self.get_views(manifest) if os.path.exists(path)]
+            views = [view for view in views if view[1]]
+            if len(set(tuple(view[1]) for view in views)) > 1:
+                raise ValueError(f'ManifestStore, create: the fieldnames of the views of the {manifest} manifest do '
+                                 f'not match ({", ".join(f"{path}: {names}" for path, names, rows in views)}).')
+            if views:
+                fieldnames = views[0][1]
+            else:
+                fieldnames = fieldnames_list or manifest_types[manifest][0] or []
+            if not fieldnames:
+                print(f'ManifestStore, create: no fieldnames were found or given for the {manifest} manifest.')
+                return []
+            rows = self.merge_rows([view[2] for view in views])
+            if any(len(view[2]) != len(rows) for view in views):
+                print(f'ManifestStore, create: the views of the {manifest} manifest disagree; their rows were merged '
+                      f'({", ".join(f"{path}: {len(view_rows)} rows" for path, names, view_rows in views)}, '
+                      f'{len(rows)} merged rows).')
+            with conn:
+                columns = ', '.join(self.quote(fieldname) for fieldname in fieldnames)
+                conn.execute(f'CREATE TABLE {self.quote(manifest)} (row_number INTEGER PRIMARY KEY, {columns})')
+                conn.execute('INSERT OR REPLACE INTO manifest_versions VALUES (?, 0)', (manifest,))
+                self.insert_rows(conn, manifest, fieldnames, rows)
+                # The files imported from that hold every merged row are, as they stand, up-to-date views
+                version = conn.execute('SELECT version FROM manifest_versions WHERE manifest = ?',
+                                       (manifest,)).fetchone()[0]
+                for path, view_fieldnames, view_rows in views:
+                    if len(view_rows) == len(rows):
+                        self.set_view_version(conn, path, version)
+            return fieldnames
+        finally:
+            conn.close()
+
+    @staticmethod
+    def read_view(path):
+        """
+        Returns the fieldnames and rows (lists of cells, None for empty cells) of an excel file or CSV, without its
+        empty rows.
+        """
+        if path.endswith('.xlsx'):
+            wb = openpyxl.load_workbook(filename=path, read_only=True)
+            rows = [list(row) for row in wb.active.iter_rows(values_only=True)]
+            wb.close()
+        else:
+            with open(path, 'r') as f:
+                rows = [[value if value != '' else None for value in row] for row in csv.reader(f)]
+        rows = [row for row in rows if any(value is not None for value in row)]
+        if not rows:
+            return [], []
+        fieldnames = [fieldname for fieldname in rows.pop(0) if fieldname is not None]
+        return fieldnames, rows
+
+    @staticmethod
+    def cell_key(value):
+        """
+        Returns a cell's value as it compares between excel files and CSVs: numbers to 12 significant digits (excel
+        files keep floats to about 15, and integers as they are), dates and times as written to CSVs, and
+        strings without their non-ASCII characters (which CSVs opened in excel may have had re-encoded).
+        """
+        if value is None:
+            return ''
+        if isinstance(value, datetime.datetime):
+            return str(value.date() if value.time() == datetime.time() else value)
+        if type(value) is not bool:
+            try:
+                return format(float(value), '.12g')
+            except (TypeError, ValueError):
+                pass
+        return str(value).encode('ascii', 'ignore').decode()
+
+    @staticmethod
+    def row_key(row):
+        """
+        Returns the keys of a row's cells (see 'cell_key'), such that the rows of excel files and CSVs compare equal
+        (trailing empty cells, which excel files do not keep, are ignored).
+        """
+        cells = [ManifestStore.cell_key(value) for value in row]
+        while cells and cells[-1] == '':
+            cells.pop()
+        return tuple(cells)
+
+    def merge_rows(self, views_rows):
+        """
+        Merges the rows of a manifest's views (the excel file first): rows found in both views are kept once (with the
+        cells of the first), and rows found in only one are inserted where they are found in it.
+        """
+        rows = []
+        for view_rows in views_rows:
+            keys, view_keys = [self.row_key(row) for row in rows], [self.row_key(row) for row in view_rows]
+            if keys[:len(view_keys)] == view_keys:
+                continue
+            if view_keys[:len(keys)] == keys:
+                rows += view_rows[len(keys):]
+                continue
+            matcher = difflib.SequenceMatcher(None, keys, view_keys, autojunk=False)
+            merged_rows = []
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                merged_rows += rows[i1:i2]
+                if tag != 'equal':
+                    merged_rows += view_rows[j1:j2]
+            rows = merged_rows
+        return rows
+
+    def insert_rows(self, conn, manifest, fieldnames, rows_list):
+        placeholders = ', '.join('?' * len(fieldnames))
+        conn.executemany(f'INSERT INTO {self.quote(manifest)} '
+                         f'({", ".join(self.quote(fieldname) for fieldname in fieldnames)}) VALUES ({placeholders})',
+                         ([self.to_cell(value) for value in (list(row) + [None] * len(fieldnames))[:len(fieldnames)]]
+                          for row in rows_list))
+        conn.execute('UPDATE manifest_versions SET version = version + 1 WHERE manifest = ?', (manifest,))
+
+    def append(self, manifest, rows_list):
+        """
+        Appends rows (lists of cells, in the order of the manifest's fieldnames) to 'manifest', in one transaction.
+        """
+        conn = self.connect()
+        try:
+            with conn:
+                self.insert_rows(conn, manifest, self.table_fieldnames(conn, manifest), rows_list)
+        finally:
+            conn.close()
+
+    def iter_rows(self, manifest, offset=0, limit=None):
+        """
+        Yields the rows (lists of cells) of 'manifest' in the order they were appended, skipping the first 'offset'
+        rows and stopping after 'limit' rows (if given).
+        """
+        conn = self.connect()
+        try:
+            for row in conn.execute(f'SELECT * FROM {self.quote(manifest)} ORDER BY row_number LIMIT ? OFFSET ?',
+                                    (-1 if limit is None else limit, offset)):
+                yield list(row[1:])
+        finally:
+            conn.close()
+
+    def count(self, manifest):
+        conn = self.connect()
+        try:
+            return conn.execute(f'SELECT COUNT(*) FROM {self.quote(manifest)}').fetchone()[0]
+        finally:
+            conn.close()
+
+    def get_fieldnames(self, manifest):
+        """
+        Returns the fieldnames of 'manifest'; an empty list if it has not been created.
+        """
+        conn = self.connect()
+        try:
+            return self.table_fieldnames(conn, manifest)
+        finally:
+            conn.close()
+
+    def clear(self, manifest):
+        """
+        Deletes all rows of 'manifest', while keeping its fieldnames.
+        """
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(f'DELETE FROM {self.quote(manifest)}')
+                conn.execute('UPDATE manifest_versions SET version = version + 1 WHERE manifest = ?', (manifest,))
+        finally:
+            conn.close()
+
+    def drop(self, manifest):
+        """
+        Deletes 'manifest' altogether: its table and its excel file and CSV.
+        """
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(f'DROP TABLE IF EXISTS {self.quote(manifest)}')
+                conn.execute('DELETE FROM manifest_versions WHERE manifest = ?', (manifest,))
+                for path in self.get_views(manifest):
+                    conn.execute('DELETE FROM view_versions WHERE path = ?', (path,))
+        finally:
+            conn.close()
+        for path in self.get_views(manifest):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def set_view_version(conn, path, version):
+        stat = os.stat(path)
+        conn.execute('INSERT OR REPLACE INTO view_versions VALUES (?, ?, ?, ?)',
+                     (path, version, stat.st_size, stat.st_mtime_ns))
+
+    def count_missing_rows(self, path, fieldnames, rows):
+        """
+        Returns the number of rows of the view at 'path' that are not in 'rows' (all of them if its fieldnames are
+        not 'fieldnames').
+        """
+        view_fieldnames, view_rows = self.read_view(path)
+        if view_rows and view_fieldnames != fieldnames:
+            return len(view_rows)
+        missing_rows = Counter(self.row_key(row) for row in view_rows)
+        missing_rows.subtract(self.row_key(row) for row in rows)
+        return sum(count for count in missing_rows.values() if count > 0)
+
+    def export(self, *manifests):
+        """
+        Writes the excel files and CSVs of 'manifests' (all of them if none are given) that are missing or out of
+        date; returns the paths of the files written. Each file is written to a temporary file that then replaces it,
+        such that it is never left partially written. A file changed since the store last wrote it (or imported it)
+        is not overwritten if it holds rows that the manifest's table lacks, which are printed to be merged by hand.
+        The database is then checkpointed, such that its file alone holds every row (eg. to be backed up).
+        """
+        if not manifests:
+            manifests = list(manifest_types)
+        written_paths = []
+        conn = self.connect()
+        try:
+            for manifest in manifests:
+                fieldnames = self.table_fieldnames(conn, manifest)
+                if not fieldnames:
+                    continue
+                # Reading the version and rows in one transaction, such that they match
+                conn.execute('BEGIN')
+                version = conn.execute('SELECT version FROM manifest_versions WHERE manifest = ?',
+                                       (manifest,)).fetchone()[0]
+                view_states = dict((path, conn.execute('SELECT version, size, mtime_ns FROM view_versions '
+                                                       'WHERE path = ?', (path,)).fetchone())
+                                   for path in self.get_views(manifest))
+                outdated_paths = [path for path, state in view_states.items()
+                                  if not os.path.exists(path) or state is None or state[0] != version]
+                if outdated_paths:
+                    rows = [row[1:] for row in
+                            conn.execute(f'SELECT * FROM {self.quote(manifest)} ORDER BY row_number')]
+                conn.commit()
+                for path in outdated_paths:
+                    state = view_states[path]
+                    # (Views exported before their size and modification time were recorded are not checked)
+                    if os.path.exists(path) and (state is None or state[1] is not None and
+                                                 (os.stat(path).st_size, os.stat(path).st_mtime_ns) != state[1:]):
+                        n_missing_rows = self.count_missing_rows(path, fieldnames, rows)
+                        if n_missing_rows:
+                            print(f'ManifestStore, export: {path} was changed outside the manifest store and holds '
+                                  f'{n_missing_rows} rows that the {manifest} manifest lacks; it was not '
+                                  f'overwritten.')
+                            continue
+                    if path.endswith('.xlsx'):
+                        self.write_excel(path, fieldnames, rows)
+                    else:
+                        self.write_csv(path, fieldnames, rows)
+                    with conn:
+                        self.set_view_version(conn, path, version)
+                    written_paths.append(path)
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            conn.close()
+        return written_paths
+
+    @staticmethod
+    def write_excel(excel_file_path, fieldnames, rows):
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet()
+        ws.append(fieldnames)
+        for row in rows:
+            ws.append([WriteOnlyCell(ws, value=value) for value in row])
+        temporary_path = excel_file_path + '.tmp.xlsx'
+        wb.save(temporary_path)
+        os.replace(temporary_path, excel_file_path)
+
+    @staticmethod
+    def write_csv(csv_path, fieldnames, rows):
+        temporary_path = csv_path + '.tmp'
+        with open(temporary_path, 'w', newline='') as f:
+            csv_writer = csv.writer(f)
+            csv_writer.writerow(fieldnames)
+            csv_writer.writerows(rows)
+        os.replace(temporary_path, csv_path)
+
+
+if __name__ == '__main__':
+    # Bringing every manifest's excel file and CSV up to date
+    for written_path in ManifestStore().export():
+        print(f'Exported {written_path}')
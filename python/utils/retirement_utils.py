@@ -0,0 +1,243 @@
+import os
+import re
+import csv
+import json
+import time
+import random
+import threading
+from datetime import date
+from urllib import request, error
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from python.vars.fieldnames import retired_subjects_fieldnames
+
+# Ensuring that the current working directory is "CountertopDarkMatter"
+while os.getcwd()[-20:] != "CountertopDarkMatter":
+    os.chdir(os.path.join(".."))
+
+
+class RetirementClient:
+    """
+    Retires subjects from a Zooniverse workflow in batches, posting subject IDs directly to the Panoptes
+    'retired_subjects' endpoint (no per-subject lookups), in chunks sent with bounded concurrency. Failed requests
+    are retried with exponential backoff. If a journal path is given, retired subject IDs are recorded there as
+    each chunk succeeds, such that an interrupted retirement can be resumed without re-sending them.
+    """
+    retryable_status_codes = (429, 500, 502, 503, 504)
+
+    def __init__(self, workflow_id, endpoint='https://www.zooniverse.org', token=None, chunk_size=100,
+                 max_workers=4, max_retries=5, backoff_seconds=0.5, timeout=30, reason='other', journal_path=None):
+        """
+            workflow_id: ID of the workflow from which subjects are retired
+            endpoint: Panoptes (or stand-in) server URL
+            token: Panoptes bearer token (eg. 'Panoptes.client().get_bearer_token()')
+            chunk_size: number of subject IDs sent per request
+            max_workers: maximum number of concurrent requests
+            max_retries: number of times a failed request is retried before its chunk is given up on
+            backoff_seconds: delay before the first retry; doubled (with jitter) for every retry after
+            reason: Panoptes retirement reason
+            journal_path: path to a CSV (fieldnames: 'retired_subjects_fieldnames') recording retired subjects
+        """
+        self.workflow_id = int(workflow_id)
+        self.url = f"{endpoint.rstrip('/')}/api/workflows/{self.workflow_id}/retired_subjects"
+        self.token = token
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout = timeout
+        self.reason = reason
+        self.journal_path = journal_path
+        self.journal_lock = threading.Lock()
+        self.retired = self.read_journal()
+
+    def read_journal(self):
+        """
+        Returns the set of subject IDs that the journal records as retired from this workflow.
+        """
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return set()
+        with open(self.journal_path, 'r', newline='') as f:
+            return set(int(row['subject_id']) for row in csv.DictReader(f)
+                       if int(row['workflow_id']) == self.workflow_id)
+
+    def write_journal(self, subject_ids):
+        """
+        Records the given subject IDs as retired, both in memory and (if configured) in the journal.
+        """
+        with self.journal_lock:
+            self.retired.update(subject_ids)
+            if not self.journal_path:
+                return
+            new_journal = not os.path.exists(self.journal_path)
+            with open(self.journal_path, 'a', newline='') as f:
+                csv_writer = csv.DictWriter(f, fieldnames=retired_subjects_fieldnames)
+                if new_journal:
+                    csv_writer.writeheader()
+                today = date.today().strftime("%m-%d-%Y")
+                csv_writer.writerows({'workflow_id': self.workflow_id, 'subject_id': subject_id,
+                                      'date_retired': today} for subject_id in subject_ids)
+
+    def retire_subjects(self, subject_ids):
+        """
+        Retires the given subjects, skipping those already retired. Returns a tuple of the lists of subject IDs
+        retired by this call and of those whose chunks failed after all retries.
+            subject_ids: list of Zooniverse subject IDs (ints)
+        """
+        to_retire = list(dict.fromkeys(int(subject_id) for subject_id in subject_ids
+                                       if int(subject_id) not in self.retired))
+        chunks = [to_retire[i:i + self.chunk_size] for i in range(0, len(to_retire), self.chunk_size)]
+        retired, failed = [], []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for chunk, succeeded in zip(chunks, executor.map(self.retire_chunk, chunks)):
+                (retired if succeeded else failed).extend(chunk)
+        if failed:
+            print(f'Failed to retire {len(failed)} subjects from workflow {self.workflow_id}; '
+                  f'rerun to retry them.')
+        return retired, failed
+
+    def retire_chunk(self, chunk):
+        """
+        Posts one chunk of subject IDs, retrying failed requests; returns whether the chunk was retired.
+        """
+        body = json.dumps({'subject_ids': chunk, 'retirement_reason': self.reason}).encode()
+        headers = {'Accept': 'application/vnd.api+json; version=1', 'Content-Type': 'application/json'}
+        if self.token:
+            headers['Authorization'] = f'Bearer {self.token}'
+        for attempt in range(self.max_retries + 1):
+            try:
+                with request.urlopen(request.Request(self.url, data=body, headers=headers, method='POST'),
+                                     timeout=self.timeout):
+                    pass
+                self.write_journal(chunk)
+                return True
+            except error.HTTPError as e:
+                if e.code not in self.retryable_status_codes:
+                    print(f'Retirement request rejected ({e.code}): {e.read()[:200]}')
+                    return False
+            except (error.URLError, TimeoutError, ConnectionError):
+                pass
+            if attempt < self.max_retries:
+                time.sleep(self.backoff_seconds * (2 ** attempt) * random.uniform(0.5, 1.5))
+        return False
+
+
+class PanoptesStandIn:
+    """
+    Local HTTP stand-in for the Panoptes endpoints used to retire subjects, for measuring and testing
+    retirement offline:
+        POST /api/workflows/(workflow ID)/retired_subjects    records the posted 'subject_ids' as retired
+        GET  /api/subjects/(subject ID)                       returns a minimal subject resource
+    Requests can be slowed ('latency_seconds') and made to fail with a 503, at random ('failure_rate') or for the
+    next 'n_failures' requests (eg. to test retries deterministically).
+    """
+    retire_path = re.compile(r'^/api/workflows/(\d+)/retired_subjects$')
+    subject_path = re.compile(r'^/api/subjects/(\d+)$')
+
+    def __init__(self, latency_seconds=0.0, failure_rate=0.0, n_failures=0, port=0):
+        self.latency_seconds = latency_seconds
+        self.failure_rate = failure_rate
+        self.n_failures = n_failures
+        # Dictionary with key-value pairs, '(workflow ID)': set of retired subject IDs
+        self.retired = {}
+        self.n_requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.get_handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def respond(self, code, body=None):
+                payload = json.dumps(body if body is not None else {}).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/vnd.api+json; version=1')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def simulate_server(self):
+                with stand_in.lock:
+                    stand_in.n_requests += 1
+                    fail = stand_in.n_failures > 0
+                    stand_in.n_failures -= fail
+                time.sleep(stand_in.latency_seconds)
+                if fail or random.random() < stand_in.failure_rate:
+                    self.respond(503, {'errors': [{'message': 'stand-in failure'}]})
+                    return False
+                return True
+
+            def do_POST(self):
+                match = stand_in.retire_path.match(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not match:
+                    self.respond(404)
+                    return
+                if not self.simulate_server():
+                    return
+                subject_ids = [int(s) for s in json.loads(body)['subject_ids']]
+                with stand_in.lock:
+                    stand_in.retired.setdefault(int(match.group(1)), set()).update(subject_ids)
+                self.respond(204)
+
+            def do_GET(self):
+                match = stand_in.subject_path.match(self.path)
+                if not match:
+                    self.respond(404)
+                    return
+                if not self.simulate_server():
+                    return
+                self.respond(200, {'subjects': [{'id': match.group(1), 'metadata': {}, 'locations': []}]})
+
+        return Handler
+
+
+def measure_retirement_throughput(n_subjects=5000, chunk_size=100, max_workers=8, latency_seconds=0.05,
+                                  failure_rate=0.05):
+    """
+    Retires 'n_subjects' subjects against a local stand-in server; prints and returns subjects retired per second.
+    """
+    with PanoptesStandIn(latency_seconds=latency_seconds, failure_rate=failure_rate) as stand_in:
+        client = RetirementClient(workflow_id=1, endpoint=stand_in.url, chunk_size=chunk_size,
+                                  max_workers=max_workers, backoff_seconds=0.01)
+        subject_ids = list(range(1, n_subjects + 1))
+        start = time.perf_counter()
+        retired, failed = client.retire_subjects(subject_ids)
+        seconds = time.perf_counter() - start
+        if not stand_in.retired.get(1, set()) >= set(retired):
+            raise RuntimeError('Subjects reported as retired were not retired by the stand-in server.')
+        # Resuming only re-sends the subjects that failed
+        resumed, still_failed = client.retire_subjects(subject_ids)
+        if set(resumed + still_failed) != set(failed):
+            raise RuntimeError('Resuming the retirement did not re-send exactly the subjects that failed.')
+    print(f'Retired {len(retired)} subjects ({len(failed)} failed) in {seconds:.2f} s '
+          f'({len(retired) / seconds:.0f} subjects/s; {stand_in.n_requests} requests)')
+    return len(retired) / seconds
+
+
+if __name__ == '__main__':
+    measure_retirement_throughput()
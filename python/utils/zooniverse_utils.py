@@ -5,7 +5,8 @@ from panoptes_client import \
     Panoptes, Project, SubjectSet, Workflow
 from panoptes_client import Subject as PanoptesSubject
     
-from python.vars.paths_and_ids import classifications_csv_path
+from python.utils.retirement_utils import RetirementClient
+from python.vars.paths_and_ids import classifications_csv_path, retired_subjects_journal_path
 from python.vars.zooniverse_login import zooniverse_username, zooniverse_password
 from python.vars.project_info import project_id, \
     simulation_subject_set_id, negative_subject_set_id, \
@@ -71,16 +72,18 @@ class ZooniverseUtils:
         """
         return PanoptesSubject().find(zooniverse_subject_id)
     
-    def retire_subjects(self, zooniverse_subject_ids):
+    def retire_subjects(self, zooniverse_subject_ids, chunk_size=100, max_workers=4):
         """
-        Retires subjects on Zooniverse given their Zooniverse subject IDs.
+        Retires subjects on Zooniverse given their Zooniverse subject IDs, in concurrent batches
+        (see 'RetirementClient'); subjects recorded in the retired subjects journal are skipped.
             zooniverse_subject_ids = list of Zooniverse subject IDs (ints)
+        Returns lists of the subject IDs retired and of those that failed to be.
         """
-        panoptes_subjects = []
-        for zooniverse_subject_id in zooniverse_subject_ids:
-            panoptes_subject = self.get_panoptes_subject(zooniverse_subject_id)
-            panoptes_subjects.append(panoptes_subject)
-        self.panoptes_workflow.retire_subjects(panoptes_subjects)
+        client = Panoptes.client()
+        retirement_client = RetirementClient(self.workflow_id, endpoint=client.endpoint,
+                                             token=client.get_bearer_token(), chunk_size=chunk_size,
+                                             max_workers=max_workers, journal_path=retired_subjects_journal_path)
+        return retirement_client.retire_subjects(zooniverse_subject_ids)
 
     def configure_designator(self):
         """
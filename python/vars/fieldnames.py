@@ -1,13 +1,23 @@
 # CLASSIFICATION ANALYSIS
 
-consensus_subjects_fieldnames = ['subject_id', 'score', 'user_weight_sum', 'n_users',
-                                 'classifications', 'score_history']
-consensus_users_fieldnames = ['user_id', 'weight', 'n_subjects', 'classifications', 'weight_history']
+consensus_subjects_fieldnames = ['subject_id', 'score', 'user_weight_sum', 'n_users', 'classifications']
+consensus_users_fieldnames = ['user_id', 'weight', 'n_subjects', 'classifications']
+# Side tables of consensus subjects' and users' histories, one row per subject/user per run of consensus analysis
+consensus_subject_history_fieldnames = ['subject_id', 'position', 'score_negative', 'score_tenebrite', 'user_weight_sum',
+                                        'n_users_negative', 'n_users_tenebrite']
+consensus_user_history_fieldnames = ['user_id', 'position', 'weight', 'n_subjects']
+retired_subjects_fieldnames = ['workflow_id', 'subject_id', 'date_retired']
+kswap_sweep_fieldnames = ['gamma', 'p0', 'threshold', 'limit', 'n_subjects', 'n_retired', 'n_retired_as_0',
+                          'n_retired_as_1', 'classifications_spent', 'classifications_saved', 'n_gold_subjects',
+                          'n_gold_retired', 'gold_accuracy', 'n_gold_missed']
 
 # CLASSIFICATIONS
 # Note: the SWAP classifications manifest's fieldnames are the same as the ones in the Zooniverse-generated
 # 'classifications.csv'. The cleaned classifications manifests' fieldnames are the combined fieldnames of all
 # subject types, along with some of the fieldnames in 'classifications.csv', and some custom fieldnames
+classifications_fieldnames = ["classification_id", "user_name", "user_id", "user_ip", "workflow_id", "workflow_name",
+                              "workflow_version", "created_at", "gold_standard", "expert", "metadata", "annotations",
+                              "subject_data", "subject_ids"]
 golds_fieldnames = ["subject_id", "gold"]
 consensus_classification_fieldnames = ['classification_id', 'subject_id', 'user_id', 'label']
 
@@ -4,6 +4,8 @@ import os
 unprocessed_images_zeroth_folder = os.path.join("data", "images")
 fetched_images_folder = os.path.join("data", "fetched_images")
 classifications_csv_path = os.path.join("data", "classifications.csv")
+classifications_csv_index_path = os.path.join("data", "classifications.csv.idx.npz")
+classification_events_path = os.path.join("data", "classification_events.jsonl")
 
 # `PROCESSED_DATA' FOLDER
 # -> IMAGES AND CSVs
@@ -25,21 +27,32 @@ consensus_classifications_csv_path = os.path.join(converted_classifications_fold
 
 # `RECORDS' FOLDER
 records_folder = "records"
+# Database keeping the manifests below (of which the excel files and CSVs are exported views)
+manifest_db_path = os.path.join(records_folder, "manifests.db")
 # -> CLASSIFICATION_ANALYSIS
 classification_analysis_records = os.path.join(records_folder, "classification_analysis")
 offline_swap_db_path = os.path.join(classification_analysis_records, "offline_swap.db")
+offline_swap_snapshot_path = os.path.join(classification_analysis_records, "offline_swap_snapshot.npz")
+retired_subjects_journal_path = os.path.join(classification_analysis_records, "retired_subjects.csv")
+kswap_benchmark_results_path = os.path.join(classification_analysis_records, "kswap_benchmark.json")
 consensus_subjects_manifest_path = os.path.join(classification_analysis_records, "Consensus_Subjects.xlsx")
 consensus_users_manifest_path = os.path.join(classification_analysis_records, "Consensus_Users.xlsx")
+consensus_db_path = os.path.join(classification_analysis_records, "consensus.db")
 # -> -> CSV
 classification_analysis_records_csv = os.path.join(classification_analysis_records, "csv")
+kswap_sweep_results_csv_path = os.path.join(classification_analysis_records_csv, "kswap_sweep.csv")
 consensus_subjects_manifest_csv_path = os.path.join(classification_analysis_records_csv, "consensus_subjects.csv")
 consensus_users_manifest_csv_path = os.path.join(classification_analysis_records_csv, "consensus_users.csv")
+consensus_subject_history_csv_path = os.path.join(classification_analysis_records_csv, "consensus_subject_history.csv")
+consensus_user_history_csv_path = os.path.join(classification_analysis_records_csv, "consensus_user_history.csv")
 # -> CLASSIFICATIONS
 classification_records = os.path.join(records_folder, "classifications")
 cleaned_classifications_manifest_path = os.path.join(classification_records, "Cleaned_Classifications.xlsx")
 swap_classifications_manifest_path = os.path.join(classification_records, "Swap_Classifications.xlsx")
 golds_manifest_path = os.path.join(classification_records, "Golds.xlsx")
 consensus_classifications_manifest_path = os.path.join(classification_records, "Consensus_Classifications.xlsx")
+cleaned_classifications_db_path = os.path.join(classification_records, "cleaned_classifications.db")
+classification_event_log_folder = os.path.join(classification_records, "event_log")
 # -> -> CSV
 classification_records_csv = os.path.join(classification_records, "csv")
 cleaned_classifications_manifest_csv_path = os.path.join(classification_records_csv, "cleaned_classifications.csv")
@@ -52,6 +65,7 @@ name_id_manifest_path = os.path.join(processing_records, "Name_ID.xlsx")
 first_unprocessed_row_manifest_path = os.path.join(processing_records, "First_Unprocessed_Row.xlsx")
 processed_folders_manifest_path = os.path.join(processing_records, "Processed_Folders.xlsx")
 processed_slabs_manifest_path = os.path.join(processing_records, "Processed_Slabs.xlsx")
+ingestion_watermark_path = os.path.join(processing_records, "ingestion_watermark.json")
 # -> -> CSV
 processing_records_csv = os.path.join(processing_records, "csv")
 name_id_manifest_csv_path = os.path.join(processing_records_csv, "nameID_manifest.csv")
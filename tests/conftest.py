@@ -0,0 +1,47 @@
+import os
+import sys
+import types
+import tempfile
+
+import pytest
+
+# The repository's modules change directory up to "CountertopDarkMatter" on import and resolve their data paths
+# from there; they are imported from an empty one, such that tests never read or write the tracked records
+repository_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_folder)
+import_folder = os.path.join(tempfile.mkdtemp(), "CountertopDarkMatter")
+os.makedirs(import_folder)
+os.chdir(import_folder)
+
+# Zooniverse credentials are not tracked; no test logs in to Zooniverse
+try:
+    import python.vars.zooniverse_login
+except ImportError:
+    zooniverse_login = types.ModuleType('python.vars.zooniverse_login')
+    zooniverse_login.zooniverse_username, zooniverse_login.zooniverse_password = '', ''
+    sys.modules['python.vars.zooniverse_login'] = zooniverse_login
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    """
+    An empty "CountertopDarkMatter" folder, made the working directory, such that the repository's default paths
+    ('paths_and_ids') point into it.
+    """
+    folder = tmp_path / "CountertopDarkMatter"
+    folder.mkdir()
+    monkeypatch.chdir(folder)
+    return folder
+
+
+@pytest.fixture
+def dump(tmp_path):
+    """
+    Paths to a generated kSWAP classification dump and its golds CSV.
+    """
+    from python.classification_analysis.kswap_benchmark import generate_classification_dump
+    classifications_csv_path = str(tmp_path / 'classifications.csv')
+    golds_csv_path = str(tmp_path / 'golds.csv')
+    generate_classification_dump(classifications_csv_path, golds_csv_path, n_classifications=600, n_users=25,
+                                 n_subjects=80, gold_fraction=0.25, tenebrite_fraction=0.2)
+    return classifications_csv_path, golds_csv_path
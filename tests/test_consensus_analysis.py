@@ -0,0 +1,137 @@
+import csv
+import random
+
+import pytest
+
+from python.classification_analysis.consensus_analysis import ConsensusAnalysis
+from python.vars.fieldnames import consensus_classification_fieldnames
+
+
+def make_analysis(folder):
+    return ConsensusAnalysis(str(folder / 'consensus_classifications.csv'), str(folder / 'consensus_subjects.csv'),
+                             str(folder / 'consensus_users.csv'), str(folder / 'Consensus_Subjects.xlsx'),
+                             str(folder / 'Consensus_Users.xlsx'),
+                             subject_history_csv_path=str(folder / 'consensus_subject_history.csv'),
+                             user_history_csv_path=str(folder / 'consensus_user_history.csv'),
+                             db_path=str(folder / 'consensus.db'))
+
+
+def write_classifications(path, cls):
+    """
+    (Re)writes the classifications CSV, as 'ProcessClassificationsCSV' does whenever classifications are processed.
+    """
+    with open(path, 'w', newline='') as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(consensus_classification_fieldnames)
+        csv_writer.writerows(cls)
+
+
+def get_classifications(n_classifications, n_users, n_subjects, seed=0):
+    rng = random.Random(seed)
+    return [[str(i), rng.randrange(n_subjects), rng.randrange(n_users), rng.choice(['negative', 'tenebrite'])]
+            for i in range(n_classifications)]
+
+
+def get_grouped_classifications(n_groups=4):
+    """
+    Classifications by disjoint groups of users of disjoint groups of subjects, such that the user-subject graph
+    has (at least) 'n_groups' connected components.
+    """
+    cls = [[cl[1] + 10 * group, cl[2] + 10 * group, cl[3]]
+           for group in range(n_groups) for cl in get_classifications(60, 5, 10, seed=group)]
+    return [[str(i)] + cl for i, cl in enumerate(cls)]
+
+
+def get_results(analysis):
+    return (dict((subject_id, subject.score) for subject_id, subject in analysis.subjects.items()),
+            dict((user_id, user.weight) for user_id, user in analysis.users.items()))
+
+
+def get_stored_results(folder):
+    analysis = make_analysis(folder)
+    conn = analysis.store.connect()
+    analysis.load_store(conn, histories=False)
+    n_classifications = conn.execute('SELECT COUNT(*) FROM classifications').fetchone()[0]
+    conn.close()
+    return get_results(analysis), n_classifications
+
+
+def assert_results_close(results, expected_results):
+    for values, expected_values in zip(results, expected_results):
+        assert values.keys() == expected_values.keys()
+        for key, expected_value in expected_values.items():
+            assert values[key] == pytest.approx(expected_value, abs=1e-6)
+
+
+@pytest.fixture
+def cls():
+    return get_classifications(n_classifications=300, n_users=12, n_subjects=40)
+
+
+def test_incremental_matches_full(tmp_path, cls):
+    cl_csv_path = str(tmp_path / 'consensus_classifications.csv')
+    write_classifications(cl_csv_path, cls)
+    full = make_analysis(tmp_path)
+    full.run(tolerance=1e-10, max_iterations=1000)
+    full_results = get_results(full)
+
+    incremental_folder = tmp_path / 'incremental'
+    incremental_folder.mkdir()
+    cl_csv_path = str(incremental_folder / 'consensus_classifications.csv')
+    write_classifications(cl_csv_path, cls[:200])
+    make_analysis(incremental_folder).run(tolerance=1e-10, max_iterations=1000)
+    write_classifications(cl_csv_path, cls[200:])
+    # With enough hops, the neighborhood of the new classifications is the whole user-subject graph
+    make_analysis(incremental_folder).run_incremental(tolerance=1e-10, max_iterations=1000, hops=10)
+    results, n_classifications = get_stored_results(incremental_folder)
+    assert n_classifications == len(cls)
+    assert_results_close(results, full_results)
+
+
+def test_incremental_reads_rewritten_csv(tmp_path, cls):
+    cl_csv_path = str(tmp_path / 'consensus_classifications.csv')
+    # The CSV is rewritten with only the classifications processed since, which may be more or fewer than before
+    for run_cls in [cls[:2], cls[2:5], cls[5:6], cls[5:40]]:
+        write_classifications(cl_csv_path, run_cls)
+        make_analysis(tmp_path).run_incremental()
+    analysis = make_analysis(tmp_path)
+    conn = analysis.store.connect()
+    analysis.load_store(conn, histories=False)
+    conn.close()
+    assert sorted(cl['classification_id'] for subject in analysis.subjects.values()
+                  for cl in subject.classifications) == sorted(cl[0] for cl in cls[:40])
+    assert sum(sum(subject.n_users.values()) for subject in analysis.subjects.values()) == 40
+
+
+def test_batched_components_match_iterate(tmp_path):
+    analysis = make_analysis(tmp_path)
+    write_classifications(analysis.cl_csv_path, get_grouped_classifications())
+    analysis.parse_classifications()
+    analysis.build_matrices()
+    serial = analysis.matrices
+    batch_size = 40
+    component_sizes = [sum(matrix[subject_index].nnz for matrix in serial.label_matrices)
+                       for subject_index, user_index in serial.components()]
+    # Every component reaches 'batch_size', so each is a batch of its own
+    assert len(component_sizes) == 4 and min(component_sizes) >= batch_size
+    serial.iterate(20)
+
+    analysis.build_matrices()
+    batched = analysis.matrices
+    residuals = batched.iterate_components(20, n_workers=2, batch_size=batch_size)
+    assert len(residuals) == 20
+    assert batched.scores == pytest.approx(serial.scores, abs=1e-9)
+    assert batched.weights == pytest.approx(serial.weights, abs=1e-9)
+
+
+def test_run_batch_size(tmp_path):
+    cls = get_grouped_classifications()
+    write_classifications(str(tmp_path / 'consensus_classifications.csv'), cls)
+    serial = make_analysis(tmp_path)
+    serial.run(n_iterations=5)
+    batched_folder = tmp_path / 'batched'
+    batched_folder.mkdir()
+    write_classifications(str(batched_folder / 'consensus_classifications.csv'), cls)
+    batched = make_analysis(batched_folder)
+    batched.run(n_iterations=5, n_workers=2, batch_size=1)
+    assert_results_close(get_results(batched), get_results(serial))
@@ -0,0 +1,76 @@
+import csv
+
+import openpyxl
+
+from python.utils.csv_excel_utils import CsvOffsetIndex, ExcelUtils
+
+
+def read_excel(excel_file_path, n_columns=3):
+    wb = openpyxl.load_workbook(filename=excel_file_path, read_only=True)
+    try:
+        # (Trailing empty cells are not stored)
+        return [(list(row) + [None] * n_columns)[:n_columns] for row in wb.active.iter_rows(values_only=True)]
+    finally:
+        wb.close()
+
+
+def write_csv(csv_path, rows, mode='w'):
+    with open(csv_path, mode, newline='') as f:
+        csv.writer(f, lineterminator='\n').writerows(rows)
+
+
+def get_rows(first_id, n_rows):
+    # (Quoted fields holding newlines and quotes, which do not end records)
+    return [[str(i), f'note {i}\nline "{i}"' if i % 3 else f'note {i}'] for i in range(first_id, first_id + n_rows)]
+
+
+def test_batched_writes_match_unbatched(tmp_path):
+    fieldnames = ['name', 'id', 'note']
+    # A dictionary missing a key, a single dictionary and a single list, each written as by the non-batched path
+    writes = [([{'name': 'a', 'id': 1, 'note': 'x'}, {'name': 'b', 'id': 2}], True),
+              ({'name': 'c', 'id': 3, 'note': 'z'}, True),
+              (['d', 4, None], False)]
+    rows = {}
+    for batched in [False, True]:
+        excel_file_path = str(tmp_path / f'manifest_{batched}.xlsx')
+        ExcelUtils(excel_file_path, fieldnames_list=fieldnames)
+        manifest = ExcelUtils(excel_file_path, fieldnames_list=fieldnames, batched=batched)
+        for rows_list, dict_writer in writes:
+            manifest.write_rows(rows_list, dict_writer=dict_writer)
+        if batched:
+            assert read_excel(excel_file_path) == [fieldnames]
+            manifest.flush()
+        rows[batched] = read_excel(excel_file_path)
+    assert rows[True] == rows[False] == [fieldnames, ['a', 1, 'x'], ['b', 2, None], ['c', 3, 'z'], ['d', 4, None]]
+
+
+def test_offset_index_resumes(tmp_path):
+    csv_path = str(tmp_path / 'classifications.csv')
+    rows = [['classification_id', 'note']] + get_rows(10, 20)
+    write_csv(csv_path, rows)
+    index = CsvOffsetIndex(csv_path)
+    assert index.update() == len(rows)
+    for start_row in [1, 7, len(rows) - 1]:
+        assert list(index.iter_rows(start_row=start_row)) == rows[start_row:]
+    assert list(index.iter_rows(start_row=3, end_row=5)) == rows[3:6]
+    assert index.first_row_after(14) == 6 and index.find(14) == 5 and index.find(100) is None
+
+    # Rows appended to the CSV, the last of them not yet ended by a newline, are indexed on resuming
+    offsets = index.offsets.copy()
+    new_rows = get_rows(30, 5)
+    write_csv(csv_path, new_rows, mode='a')
+    with open(csv_path, 'a') as f:
+        f.write('35,last')
+    index = CsvOffsetIndex(csv_path)
+    assert not index.is_current()
+    assert index.update() == len(rows) + len(new_rows)
+    assert (index.offsets[:len(offsets)] == offsets).all()
+    assert list(index.iter_rows(start_row=len(rows))) == new_rows + [['35', 'last']]
+    assert index.first_row_after(29) == len(rows)
+
+    # A rewritten CSV is indexed anew
+    rows = [['classification_id', 'note']] + get_rows(50, 4)
+    write_csv(csv_path, rows)
+    assert index.update() == len(rows)
+    assert list(index.iter_rows(start_row=2)) == rows[2:]
+    assert index.ids.tolist() == [-1, 50, 51, 52, 53]
@@ -0,0 +1,374 @@
+import os
+import csv
+import sys
+import json
+import sqlite3
+
+import pytest
+
+from python.classification_analysis.event_log import ClassificationEventLog
+from python.classification_analysis.kswap import kSWAP, Classification, parse_created_at
+from python.classification_analysis.offline_swap_config import Config
+from python.vars.project_info import first_workflow_id
+
+
+def make_swap(folder, retirement_lower_threshold=1e-2, retirement_limit=8):
+    config = Config(first_workflow_id, retirement_lower_threshold, retirement_limit)
+    config.db_path = str(folder) + os.path.sep
+    return kSWAP(config=config)
+
+
+def get_history(subject):
+    history = subject.history
+    return (history.classification_id.tolist(), history.user_index.tolist(), history.label.tolist(),
+            dict((c, posterior.tolist()) for c, posterior in history.posterior.items()))
+
+
+def get_state(swap):
+    """
+    Returns the scores and retirement states of a kSWAP's users and subjects, for comparison.
+    """
+    users = dict((user_id, (user.user_score, user.confusion_matrix)) for user_id, user in swap.users.items())
+    subjects = dict((subject_id, (subject.score, subject.retired, subject.retired_as, subject.seen,
+                                  subject.posterior_to_prior))
+                    for subject_id, subject in swap.subjects.items())
+    return users, subjects
+
+
+def get_histories(swap):
+    """
+    Returns the histories of a kSWAP's users and subjects, with user scores resolved from their versions.
+    """
+    users = dict((user_id, [(subject_id, user.score_versions[score_version]) for subject_id, score_version
+                            in zip(user.history.subject_id, user.history.score_version)])
+                 for user_id, user in swap.users.items())
+    subjects = dict((subject_id, swap.history_rows(subject)) for subject_id, subject in swap.subjects.items())
+    return users, subjects
+
+
+def write_legacy_db(swap, db_file):
+    """
+    Saves a kSWAP's state in the database format used before columnar histories, in which every history entry
+    holds a copy of the user score (with a placeholder first entry).
+    """
+    users, subjects = get_histories(swap)
+    conn = sqlite3.connect(db_file)
+    conn.execute('CREATE TABLE users (user_id PRIMARY KEY, user_score, confusion_matrix, history)')
+    conn.execute('CREATE TABLE subjects (subject_id PRIMARY KEY, gold_label, score, retired, retired_as, seen, '
+                 'posterior_to_prior, history)')
+    conn.execute('CREATE TABLE thresholds (thresholds)')
+    conn.execute('CREATE TABLE config (id PRIMARY KEY, user_default, workflow, p0, gamma, retirement_limit, '
+                 'db_path, db_name, timeout, last_id, seen)')
+    conn.executemany('INSERT INTO users VALUES (?,?,?,?)',
+                     [(user_id, json.dumps(user.user_score), json.dumps(user.confusion_matrix),
+                       json.dumps([('_', user.score_versions[0])] + users[user_id]))
+                      for user_id, user in ((user_id, swap.users[user_id]) for user_id in swap.user_ids)])
+    conn.executemany('INSERT INTO subjects VALUES (?,?,?,?,?,?,?,?)',
+                     [(subject_id, subject.gold_label, json.dumps(subject.score), subject.retired,
+                       subject.retired_as, subject.seen, subject.posterior_to_prior,
+                       json.dumps([('_', '_', '_', '_', subject.p0, 1)] + subjects[subject_id]))
+                      for subject_id, subject in swap.subjects.items()])
+    conn.execute('INSERT INTO config VALUES (?,?,?,?,?,?,?,?,?,?,?)', swap.dump_config())
+    conn.commit()
+    conn.close()
+
+
+def write_event_log(folder, classifications_csv_path, n_classifications=None):
+    """
+    Logs the classifications of a dump, as 'ProcessClassificationsCSV' does when ingesting them.
+    """
+    event_log = ClassificationEventLog(str(folder))
+    with open(classifications_csv_path, 'r') as f:
+        for row in list(csv.DictReader(f))[:n_classifications]:
+            user = int(row['user_id']) if row['user_id'] else row['user_name']
+            event_log.append((int(row['classification_id']), user, int(row['subject_ids']), int(row['workflow_id']),
+                              json.loads(row['annotations'])[0]['value'], parse_created_at(row['created_at']), 'e'))
+    event_log.flush()
+    return event_log
+
+
+def classify_subject(swap, subject_id, labels):
+    """
+    Classifies a subject with 'labels', in order, by the first user (with classification IDs of its own).
+    """
+    user_id = swap.user_ids[0]
+    for label in labels:
+        n_seen = swap.subjects[subject_id].seen if subject_id in swap.subjects else 0
+        swap.process_classification(Classification(10 ** 9 + subject_id * 100 + n_seen, user_id, subject_id,
+                                                   label=label))
+
+
+def test_snapshot_round_trip(tmp_path, dump):
+    classifications_csv_path, golds_csv_path = dump
+    swap = make_swap(tmp_path)
+    swap.run_offline(golds_csv_path, classifications_csv_path)
+    # Subjects with as many of each label, which received label 1 first: one below the retirement limit, and one
+    # that reaches it only once restored
+    classify_subject(swap, 900001, [1, 0, 1, 0])
+    classify_subject(swap, 900002, [1, 0, 0, 1, 1, 0])
+    swap.retire()
+    swap.save_snapshot()
+
+    restored = make_swap(tmp_path).load_snapshot()
+    assert get_state(restored) == get_state(swap)
+    assert [restored.subjects[subject_id].majority_label() for subject_id in [900001, 900002]] == [1, 1]
+    for subject_id, subject in swap.subjects.items():
+        assert list(restored.subjects[subject_id].label_counts.items()) == list(subject.label_counts.items())
+    assert get_state(restored) == get_state(make_swap(tmp_path).load())
+    assert restored.last_id == swap.last_id and restored.seen == swap.seen
+    # Histories are read from the database on first access
+    for subject_id in swap.subjects:
+        assert get_history(restored.subjects[subject_id]) == get_history(swap.subjects[subject_id])
+    # Reaching the retirement limit, the tied subject retires as the label it received first either way
+    loaded = make_swap(tmp_path).load()
+    for resumed in [restored, loaded]:
+        classify_subject(resumed, 900002, [0, 1])
+        resumed.retire()
+    assert restored.subjects[900002].retired_as == loaded.subjects[900002].retired_as == 1
+
+
+def test_offline_needs_no_panoptes(tmp_path, dump, monkeypatch):
+    classifications_csv_path, golds_csv_path = dump
+    # (Importing 'panoptes_client' raising an ImportError)
+    monkeypatch.setitem(sys.modules, 'panoptes_client', None)
+
+    def connect_panoptes(swap):
+        raise AssertionError('Connected to Panoptes')
+
+    monkeypatch.setattr(kSWAP, 'connect_panoptes', connect_panoptes)
+    swap = make_swap(tmp_path)
+    swap.run_offline(golds_csv_path, classifications_csv_path)
+    assert swap.retire()
+    swap.save_snapshot()
+    loaded = make_swap(tmp_path).load()
+    restored = make_swap(tmp_path).load_snapshot()
+    assert get_state(loaded) == get_state(restored) == get_state(swap)
+    assert swap._workflow is loaded._workflow is restored._workflow is None
+    with pytest.raises(AssertionError):
+        swap.workflow
+    with pytest.raises(ImportError):
+        kSWAP.login_panoptes()
+
+
+def test_snapshot_is_not_loaded_after_save(tmp_path, dump):
+    classifications_csv_path, golds_csv_path = dump
+    swap = make_swap(tmp_path)
+    swap.run_offline(golds_csv_path, classifications_csv_path)
+    swap.save_snapshot()
+    # Retiring changes the state without any new classification (ie. with the same last ID)
+    assert swap.retire()
+    swap.save()
+
+    loaded = make_swap(tmp_path).load()
+    restored = make_swap(tmp_path).load_snapshot()
+    assert get_state(restored) == get_state(loaded) == get_state(swap)
+
+
+def test_sweep_opens_no_database(workspace, dump):
+    from python.classification_analysis.kswap_sweep import SWAPSweep
+    classifications_csv_path, golds_csv_path = dump
+    with SWAPSweep(classifications_csv_path, golds_csv_path) as sweep:
+        results = sweep.run(SWAPSweep.grid([1], [0.05], [1e-3], [8]), n_workers=1, results_csv_path=None)
+    assert results[0]['n_subjects'] > 0
+    assert not [name for _, _, names in os.walk(workspace) for name in names if name.endswith('.db')]
+
+
+def test_sweep_workers_close_the_shared_table(workspace, dump, monkeypatch):
+    from python.classification_analysis import kswap_sweep
+    classifications_csv_path, golds_csv_path = dump
+    settings = kswap_sweep.SWAPSweep.grid([1], [0.05], [1e-3, 1e-5], [8, 30])
+    with kswap_sweep.SWAPSweep(classifications_csv_path, golds_csv_path) as sweep:
+        assert sweep.run(settings, n_workers=2, results_csv_path=None) == \
+            sweep.run(settings, n_workers=1, results_csv_path=None)
+        # Evaluating a setting as a worker does, the table attached to is closed once it is evaluated
+        closed = []
+        close = kswap_sweep.SharedClassificationTable.close
+
+        def record_close(table):
+            closed.append(table)
+            close(table)
+
+        monkeypatch.setattr(kswap_sweep.SharedClassificationTable, 'close', record_close)
+        kswap_sweep.init_sweep_worker(sweep.table.spec)
+        assert kswap_sweep.evaluate_setting(settings[0], None, sweep.user_default) == \
+            kswap_sweep.evaluate_setting(settings[0], sweep.table, sweep.user_default)
+        assert len(closed) == 1 and closed[0] is not sweep.table and closed[0].user is None
+
+
+def test_event_log_is_deduplicated(tmp_path, dump):
+    classifications_csv_path, golds_csv_path = dump
+    event_log = write_event_log(tmp_path / 'event_log', classifications_csv_path, 400)
+    # Ingesting the same classifications again (with the ingestion records not updated)
+    event_log = write_event_log(tmp_path / 'event_log', classifications_csv_path)
+    assert len(event_log) == 600
+    assert len(set(event_log.column('classification_id').tolist())) == 600
+
+
+def test_run_offline_from_event_log(tmp_path, dump):
+    classifications_csv_path, golds_csv_path = dump
+    from_csv = make_swap(tmp_path / 'csv')
+    from_csv.run_offline(golds_csv_path, classifications_csv_path)
+
+    event_log = write_event_log(tmp_path / 'full_event_log', classifications_csv_path)
+    from_full_log = make_swap(tmp_path / 'full_log')
+    from_full_log.run_offline(golds_csv_path, None, event_log=event_log)
+    assert get_state(from_full_log) == get_state(from_csv)
+
+    from_log = make_swap(tmp_path / 'log')
+    event_log = write_event_log(tmp_path / 'event_log', classifications_csv_path, 400)
+    from_log.run_offline(golds_csv_path, None, event_log=event_log)
+    assert len(from_log.seen) == 400
+    # The classifications already seen are left out of the next run
+    event_log = write_event_log(tmp_path / 'event_log', classifications_csv_path)
+    from_log.run_offline(golds_csv_path, None, event_log=event_log)
+    assert from_log.seen == from_csv.seen
+
+
+def test_sharded_matches_serial(tmp_path, dump):
+    classifications_csv_path, golds_csv_path = dump
+    serial = make_swap(tmp_path / 'serial')
+    serial.run_offline(golds_csv_path, classifications_csv_path)
+    sharded = make_swap(tmp_path / 'sharded')
+    sharded.run_offline(golds_csv_path, classifications_csv_path, n_workers=2)
+    assert get_state(sharded) == get_state(serial)
+    assert get_histories(sharded) == get_histories(serial)
+    assert dict((subject_id, list(subject.label_counts.items())) for subject_id, subject in sharded.subjects.items()) \
+        == dict((subject_id, list(subject.label_counts.items())) for subject_id, subject in serial.subjects.items())
+    assert sharded.last_id == serial.last_id and sharded.seen == serial.seen
+    assert serial.retire() == sharded.retire()
+
+
+def test_load_legacy_db(tmp_path, dump):
+    classifications_csv_path, golds_csv_path = dump
+    swap = make_swap(tmp_path)
+    swap.run_offline(golds_csv_path, classifications_csv_path)
+    swap.retire()
+    legacy_folder = tmp_path / 'legacy'
+    legacy_folder.mkdir()
+    write_legacy_db(swap, str(legacy_folder / swap.config.db_name))
+
+    loaded = make_swap(legacy_folder).load()
+    assert get_state(loaded) == get_state(swap)
+    assert get_histories(loaded) == get_histories(swap)
+    assert loaded.user_ids == swap.user_ids
+    # Saving moves the histories to the columnar format, which loads the same
+    loaded.save()
+    assert get_histories(make_swap(legacy_folder).load()) == get_histories(swap)
+
+
+def get_full_scan_retirements(swap, subject_ids=None):
+    """
+    The retirements of a scan of every subject (as 'retire' made them before the retirement index): a dictionary
+    like 'subject_id': retired_as.
+    """
+    retirements = {}
+    for subject_id, subject in swap.subjects.items():
+        if subject.retired or subject.gold_label in swap.config.label_map.values() \
+                or (subject_ids is not None and subject_id not in subject_ids):
+            continue
+        if subject.posterior_to_prior < swap.config.thresholds[0]:
+            retirements[subject_id] = 0
+        if subject.seen >= swap.config.retirement_limit:
+            retirements[subject_id] = subject.majority_label()
+    return retirements
+
+
+def test_retire_matches_full_scan(tmp_path, dump):
+    classifications_csv_path, golds_csv_path = dump
+    swap = make_swap(tmp_path)
+    table = swap.read_classifications(classifications_csv_path)
+    swap.get_golds(golds_csv_path)
+    swap.apply_golds(table)
+    cls = list(table)
+    # (Every classification pushes new index entries, leaving those of the subject's previous scores stale)
+    for cl in cls[:300]:
+        swap.process_classification(cl)
+    gold_subjects = [subject for subject in swap.subjects.values()
+                     if subject.gold_label in swap.config.label_map.values()]
+    assert [subject for subject in gold_subjects if subject.seen >= swap.config.retirement_limit
+            or subject.posterior_to_prior < swap.config.thresholds[0]]
+    # A subject whose ratio fell below the threshold, then rose back above it: its earlier entry is stale
+    classify_subject(swap, 900003, [0, 0, 0])
+    assert swap.subjects[900003].posterior_to_prior < swap.config.thresholds[0]
+    classify_subject(swap, 900003, [1, 1, 1, 1])
+    assert swap.subjects[900003].posterior_to_prior >= swap.config.thresholds[0]
+    expected = get_full_scan_retirements(swap)
+    assert 900003 not in expected
+    assert [subject_id for subject_id in expected if swap.subjects[subject_id].seen >= swap.config.retirement_limit
+            and swap.subjects[subject_id].posterior_to_prior < swap.config.thresholds[0]]
+    assert sorted(swap.retire()) == sorted(expected)
+    assert dict((subject_id, swap.subjects[subject_id].retired_as) for subject_id in expected) == expected
+    assert not any(subject.retired for subject in gold_subjects)
+
+    # Scores changed after the first retirements (of subjects retired, or not, then)
+    for cl in cls[300:]:
+        swap.process_classification(cl)
+    subject_batch = list(swap.subjects)[::2]
+    expected = get_full_scan_retirements(swap, set(subject_batch))
+    assert sorted(swap.retire(subject_batch)) == sorted(expected)
+    expected = get_full_scan_retirements(swap)
+    assert expected and sorted(swap.retire()) == sorted(expected)
+    assert dict((subject_id, swap.subjects[subject_id].retired_as) for subject_id in expected) == expected
+    assert get_full_scan_retirements(swap) == {} and swap.retire() == []
+    assert not any(subject.retired for subject in gold_subjects)
+
+
+def get_posterior_at(history, classification_id=None, time=None):
+    """
+    Returns the posterior of a subject's history after the last of its classifications with an ID up to
+    'classification_id', or made up to 'time' (the last in the history among those made at the same time); None if
+    there is none.
+    """
+    if classification_id is not None:
+        entries = [(cl_id, i) for i, cl_id in enumerate(history.classification_id) if cl_id <= classification_id]
+    else:
+        entries = [(created_at, i) for i, created_at in enumerate(history.created_at) if created_at <= time]
+    return history.score(max(entries)[1]) if entries else None
+
+
+def test_posteriors_at_match_histories(tmp_path, dump):
+    classifications_csv_path, golds_csv_path = dump
+    swap = make_swap(tmp_path)
+    swap.run_offline(golds_csv_path, classifications_csv_path)
+    swap.save()
+    store = swap.history_store()
+    subject_ids = sorted(swap.subjects)
+    histories = dict((subject_id, swap.subjects[subject_id].history) for subject_id in subject_ids)
+    assert all(min(history.created_at) >= 0 for history in histories.values())
+
+    first_ids = [history.classification_id[0] for history in histories.values()]
+    classification_ids = [min(first_ids) - 1] + [cl_id for history in histories.values()
+                                                 for cl_id in history.classification_id[:2]]
+    times = [min(history.created_at[0] for history in histories.values()) - 1] + \
+        [created_at for history in histories.values() for created_at in history.created_at[:2]]
+    # Before the first classification of every subject, before that of some, exactly at a classification (the
+    # first and second of each subject) and after the last of every subject
+    bounds = [dict(classification_id=cl_id) for cl_id in classification_ids + [swap.last_id]] + \
+        [dict(time=created_at) for created_at in times + [max(max(history.created_at) for history in
+                                                             histories.values())]]
+    for bound in bounds:
+        expected = dict((subject_id, get_posterior_at(history, **bound)) for subject_id, history in histories.items())
+        expected = dict((subject_id, posterior) for subject_id, posterior in expected.items() if posterior is not None)
+        assert store.posteriors_at(subject_ids, **bound) == expected
+        # Subjects not yet classified have their prior
+        assert swap.posteriors_at(subject_ids, **bound) == \
+            dict((subject_id, expected.get(subject_id, swap.config.p0)) for subject_id in subject_ids)
+    assert store.posteriors_at(subject_ids, classification_id=classification_ids[0]) == {}
+    assert len(store.posteriors_at(subject_ids, time=times[-1])) < len(subject_ids)
+    assert store.posteriors_at(subject_ids, classification_id=swap.last_id) == \
+        dict((subject_id, swap.subjects[subject_id].score) for subject_id in subject_ids)
+
+    # Windows bounded on either side, or both, by the times of classifications (bounds being inclusive)
+    all_times = sorted(set(created_at for history in histories.values() for created_at in history.created_at))
+    since, until = all_times[len(all_times) // 3], all_times[2 * len(all_times) // 3]
+    for window in [dict(since=since), dict(until=until), dict(since=since, until=until)]:
+        trajectories = dict(swap.posterior_trajectories(subject_ids, **window))
+        assert sorted(trajectories) == subject_ids
+        for subject_id, history in histories.items():
+            indices = [i for i, created_at in enumerate(history.created_at)
+                       if window.get('since', created_at) <= created_at <= window.get('until', created_at)]
+            trajectory = trajectories[subject_id]
+            assert trajectory.classification_id.tolist() == [history.classification_id[i] for i in indices]
+            assert trajectory.created_at.tolist() == [history.created_at[i] for i in indices]
+            assert [trajectory.score(i) for i in range(len(trajectory))] == [history.score(i) for i in indices]
+        assert any(0 < len(trajectories[subject_id]) < len(history) for subject_id, history in histories.items())
@@ -0,0 +1,82 @@
+import os
+import csv
+import datetime
+
+import openpyxl
+
+from python.utils.manifest_store import ManifestStore
+from python.vars.paths_and_ids import first_unprocessed_row_manifest_path, first_unprocessed_row_manifest_csv_path
+
+fieldnames = ['date', 'rows_processed', 'first_unprocessed_row']
+
+
+def write_views(excel_rows, csv_rows):
+    os.makedirs(os.path.dirname(first_unprocessed_row_manifest_csv_path), exist_ok=True)
+    ManifestStore.write_excel(first_unprocessed_row_manifest_path, fieldnames, excel_rows)
+    ManifestStore.write_csv(first_unprocessed_row_manifest_csv_path, fieldnames, csv_rows)
+
+
+def read_views():
+    wb = openpyxl.load_workbook(filename=first_unprocessed_row_manifest_path, read_only=True)
+    excel_rows = [list(row) for row in wb.active.iter_rows(values_only=True)]
+    wb.close()
+    with open(first_unprocessed_row_manifest_csv_path, 'r') as f:
+        csv_rows = list(csv.reader(f))
+    return excel_rows, csv_rows
+
+
+def test_create_merges_disagreeing_views(workspace):
+    # The excel file and CSV backup each hold rows that the other lost
+    write_views([['07-29-2021', 900, 900], ['08-31-2021', 12, 915], ['08-31-2021', 12, 928]],
+                [['08-31-2021', 0, 914], ['08-31-2021', 12, 928], ['09-08-2021', 10, 939]])
+    store = ManifestStore()
+    assert store.create('first_unprocessed_row') == fieldnames
+    merged_rows = [['07-29-2021', 900, 900], ['08-31-2021', 12, 915], ['08-31-2021', '0', '914'],
+                   ['08-31-2021', 12, 928], ['09-08-2021', '10', '939']]
+    assert list(store.iter_rows('first_unprocessed_row')) == merged_rows
+    # Neither view held every row, so both are rewritten
+    assert sorted(store.export()) == sorted([first_unprocessed_row_manifest_path,
+                                             first_unprocessed_row_manifest_csv_path])
+    excel_rows, csv_rows = read_views()
+    assert excel_rows[1:] == merged_rows
+    assert csv_rows[1:] == [[str(value) for value in row] for row in merged_rows]
+
+
+def test_create_imports_longer_view(workspace):
+    rows = [['07-29-2021', 900, 900], ['08-31-2021', 12, 915]]
+    write_views(rows[:1], rows)
+    store = ManifestStore()
+    store.create('first_unprocessed_row')
+    assert [[str(value) for value in row] for row in store.iter_rows('first_unprocessed_row')] == \
+        [[str(value) for value in row] for row in rows]
+    # The CSV held every row, so only the excel file is out of date
+    assert store.export() == [first_unprocessed_row_manifest_path]
+
+
+def test_export_keeps_view_changed_outside_store(workspace):
+    write_views([['07-29-2021', 900, 900]], [['07-29-2021', 900, 900]])
+    store = ManifestStore()
+    store.create('first_unprocessed_row')
+    store.append('first_unprocessed_row', [['08-31-2021', 12, 912]])
+    # A row added to the CSV by hand, which the store does not hold
+    with open(first_unprocessed_row_manifest_csv_path, 'a', newline='') as f:
+        csv.writer(f).writerow(['08-31-2021', 12, 915])
+    assert store.export() == [first_unprocessed_row_manifest_path]
+    excel_rows, csv_rows = read_views()
+    assert csv_rows[-1] == ['08-31-2021', '12', '915']
+    assert excel_rows[-1] == ['08-31-2021', 12, 912]
+
+    # Views the store wrote itself are overwritten, even with fewer rows
+    store.clear('first_unprocessed_row')
+    assert store.export() == [first_unprocessed_row_manifest_path]
+    assert read_views()[0] == [fieldnames]
+
+
+def test_create_matches_rows_across_formats(workspace):
+    # Excel files keep dates as such and floats to about 15 significant digits, unlike CSVs
+    write_views([[datetime.datetime(2022, 6, 27), 1, 30876.0011166835]],
+                [['2022-06-27', '1', '30876.001116683503']])
+    store = ManifestStore()
+    store.create('first_unprocessed_row')
+    assert store.count('first_unprocessed_row') == 1
+    assert store.export() == []
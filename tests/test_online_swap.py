@@ -0,0 +1,84 @@
+import csv
+import json
+import time
+import threading
+
+from python.classification_analysis.online_swap import OnlineSWAP, QueueSource, TailingFileSource
+from test_kswap import make_swap, get_state
+
+
+def split_dump(tmp_path, classifications_csv_path, n_offline):
+    """
+    Writes the first 'n_offline' classifications of a dump to a CSV of their own; returns its path, and the other
+    classifications as events.
+    """
+    with open(classifications_csv_path, 'r') as f:
+        reader = csv.DictReader(f)
+        rows = list(reader)
+    offline_csv_path = str(tmp_path / 'offline_classifications.csv')
+    with open(offline_csv_path, 'w', newline='') as f:
+        csv_writer = csv.DictWriter(f, fieldnames=reader.fieldnames)
+        csv_writer.writeheader()
+        csv_writer.writerows(rows[:n_offline])
+    return offline_csv_path, rows[n_offline:]
+
+
+def test_online_swap_retires_and_checkpoints(tmp_path, dump):
+    classifications_csv_path, golds_csv_path = dump
+    offline_csv_path, events = split_dump(tmp_path, classifications_csv_path, 400)
+    swap = make_swap(tmp_path)
+    swap.run_offline(golds_csv_path, offline_csv_path)
+    swap.retire()
+    swap.save_snapshot()
+
+    saves = []
+    save = swap.save
+
+    def record_save(user_ids=None, subject_ids=None):
+        saves.append(set(subject_ids))
+        save(user_ids, subject_ids)
+    swap.save = record_save
+    retired = []
+
+    def retire_subjects(subject_ids):
+        retired.extend(subject_ids)
+        return list(subject_ids), []
+    source = QueueSource()
+
+    def post_events():
+        # (In batches, as a webhook receiver would, such that the service checkpoints between them)
+        for i in range(0, len(events), 25):
+            for event in events[i:i + 25]:
+                source.queue.put(event)
+            while not source.queue.empty():
+                time.sleep(0.001)
+        source.queue.put(None)
+    receiver = threading.Thread(target=post_events)
+    receiver.start()
+    service = OnlineSWAP(swap, source, retire_subjects=retire_subjects, checkpoint_classifications=50,
+                         poll_seconds=0.01)
+    service.run()
+    receiver.join()
+
+    assert service.n_processed == len(events)
+    assert service.decisions and retired == [decision[0] for decision in service.decisions]
+    assert all(swap.subjects[subject_id].retired for subject_id in retired)
+    # Periodic checkpoints save only the subjects changed since the last, the last checkpoint writes the snapshot
+    assert len(saves) >= 3
+    assert all(len(subject_ids) < len(swap.subjects) for subject_ids in saves)
+    assert get_state(make_swap(tmp_path).load()) == get_state(swap)
+    restored = make_swap(tmp_path).load_snapshot()
+    assert get_state(restored) == get_state(swap) and restored.seen == swap.seen
+
+
+def test_tailing_source_skips_malformed_lines(tmp_path):
+    path = str(tmp_path / 'classification_events.jsonl')
+    source = TailingFileSource(path)
+    with open(path, 'w') as f:
+        f.write(json.dumps({'classification_id': 1}) + '\n{"classification_id": 2, "ann\n' +
+                json.dumps({'classification_id': 3}) + '\n{"classification_id": 4')
+    assert source.read_new_events() == [{'classification_id': 1}, {'classification_id': 3}]
+    # The last line is read once it is completed
+    with open(path, 'a') as f:
+        f.write('}\n')
+    assert source.read_new_events() == [{'classification_id': 4}]
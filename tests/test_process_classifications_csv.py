@@ -0,0 +1,224 @@
+import os
+import csv
+import json
+import random
+
+import pytest
+
+from python.classification_analysis.process_classifications_csv import ProcessClassificationsCSV, IngestionWatermark, \
+    CleanedClassificationsStore
+from python.vars.project_info import first_workflow_id, second_workflow_id
+from python.vars.paths_and_ids import classifications_csv_path, unprocessed_classifications_csv_path, \
+    cleaned_classifications_csv_path, swap_classifications_csv_path, golds_csv_path, \
+    consensus_classifications_csv_path, cleaned_classifications_manifest_csv_path, ingestion_watermark_path, \
+    first_unprocessed_row_manifest_csv_path, cleaned_classifications_db_path
+
+export_fieldnames = ['classification_id', 'user_name', 'user_id', 'user_ip', 'workflow_id', 'workflow_name',
+                     'workflow_version', 'created_at', 'gold_standard', 'expert', 'metadata', 'annotations',
+                     'subject_data', 'subject_ids']
+converted_csv_paths = [unprocessed_classifications_csv_path, cleaned_classifications_csv_path,
+                       swap_classifications_csv_path, golds_csv_path, consensus_classifications_csv_path]
+
+
+def get_export_row(classification_id, rng):
+    """
+    A row of the 'classifications.csv' Zooniverse export, of either workflow, on an experiment, simulation or negative
+    subject (or, rarely, a prototype subject without a '!subject_id', which is not processed).
+    """
+    workflow_id = rng.choice([first_workflow_id, first_workflow_id, second_workflow_id])
+    subject_type = rng.choice('esn')
+    subject_znv_id = 60000000 + rng.randrange(40)
+    user_id = rng.randrange(10)
+    metadata = {'started_at': '2021-08-31T15:42:12.744Z', 'finished_at': f'2021-08-31T15:43:{rng.randrange(60):02}Z',
+                'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+                'subject_dimensions': [{'naturalWidth': 1955, 'naturalHeight': 1466}],
+                'subject_selection_state': {'retired': False, 'already_seen': False}}
+    if workflow_id == second_workflow_id:
+        annotations = [{'task': 'T0', 'value': rng.choice(['Yes', 'No'])}]
+    else:
+        annotations = [{'task': 'T3', 'task_label': 'Mark', 'value': rng.choice(
+            [[], [{'x': 10.5, 'y': 20, 'rx': 20, 'ry': rng.choice([10, 8]), 'angle': 0, 'tool_label': 'Ellipse'}]])}]
+        if subject_type == 's':
+            metadata['feedback'] = {'T3': [{'id': 'meltpatch', 'success': bool(annotations[0]['value'])}]}
+    subject_data = {'retired': None, '#slab_id': '24019-32'}
+    if rng.random() > 0.05:
+        subject_data['!subject_id'] = f'{subject_type}{rng.randrange(100)}'
+    return [str(classification_id), f'user{user_id}' if user_id else 'not-logged-in-1', str(user_id or ''),
+            f'ip{user_id}', str(workflow_id), 'Classify', '72.96', '2021-08-31 15:43:05 UTC', '', '',
+            json.dumps(metadata), json.dumps(annotations), json.dumps({str(subject_znv_id): subject_data}),
+            str(subject_znv_id)]
+
+
+def get_export_rows(classification_ids, seed=0):
+    rng = random.Random(seed)
+    return [get_export_row(classification_id, rng) for classification_id in classification_ids]
+
+
+def write_export(rows):
+    """
+    (Re)writes the Zooniverse export, as a downloaded export would be.
+    """
+    for path in [classifications_csv_path, unprocessed_classifications_csv_path,
+                 cleaned_classifications_manifest_csv_path, first_unprocessed_row_manifest_csv_path]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(classifications_csv_path, 'w', newline='') as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(export_fieldnames)
+        csv_writer.writerows(rows)
+
+
+def read_csv(path):
+    with open(path, 'r') as f:
+        return list(csv.reader(f))
+
+
+def get_outputs(pcc):
+    """
+    Returns the converted CSVs of the last processing, and the running manifests and event log of every processing.
+    """
+    manifests = ['cleaned_classifications', 'swap_classifications', 'golds', 'consensus_classifications',
+                 'first_unprocessed_row']
+    return ([read_csv(path) for path in converted_csv_paths],
+            [list(pcc.manifest_store.iter_rows(manifest)) for manifest in manifests],
+            dict((name, pcc.classification_event_log.column(name).tolist())
+                 for name in ['classification_id', 'user', 'subject', 'label']))
+
+
+def get_processed_ids():
+    """
+    Returns the IDs of the classifications converted by the last processing.
+    """
+    return [int(row[0]) for row in read_csv(unprocessed_classifications_csv_path)[1:]]
+
+
+def get_logged_ids(pcc):
+    return pcc.classification_event_log.column('classification_id').tolist()
+
+
+@pytest.fixture
+def export_rows():
+    return get_export_rows(range(1000, 1090))
+
+
+def test_parallel_conversion_matches_serial(tmp_path, monkeypatch, export_rows):
+    outputs = {}
+    for n_workers in [1, 2]:
+        folder = tmp_path / str(n_workers) / 'CountertopDarkMatter'
+        folder.mkdir(parents=True)
+        monkeypatch.chdir(folder)
+        write_export(export_rows)
+        pcc = ProcessClassificationsCSV()
+        # Processing a first part of the export, then the rest (chunks not being aligned with either)
+        pcc.process_classification_export(update_first_unprocessed_row=True, end_row=31, chunk_size=7,
+                                          n_workers=n_workers)
+        pcc.process_classification_export(update_first_unprocessed_row=True, chunk_size=7, n_workers=n_workers)
+        outputs[n_workers] = get_outputs(pcc)
+    assert outputs[2] == outputs[1]
+    converted_csvs, manifests, events = outputs[1]
+    # (Rows of the export being numbered from its header, as 1, on, and 'end_row' from the header as 0)
+    assert [row[2] for row in manifests[-1]] == [33, len(export_rows) + 2]
+    assert len(converted_csvs[0]) - 1 == manifests[-1][1][1] > 0
+    assert len(manifests[0]) == len(events['classification_id']) == sum(row[1] for row in manifests[-1])
+
+
+def test_watermark_skips_processed(workspace, export_rows):
+    write_export(export_rows[:60])
+    pcc = ProcessClassificationsCSV()
+    pcc.process_classification_export(update_first_unprocessed_row=True)
+    first_ids = get_processed_ids()
+    # A regenerated export, holding the same classifications in another order, with classifications that arrived late
+    # (with IDs below those already processed) among the new ones
+    late_rows = get_export_rows(range(1500, 1510), seed=1)
+    late_rows = [[str(1000 + 60 + i)] + row[1:] for i, row in enumerate(late_rows[:5])] + \
+        [[str(990 + i)] + row[1:] for i, row in enumerate(late_rows[5:])]
+    rows = export_rows[30:60] + late_rows[:3] + export_rows[:30] + late_rows[3:]
+    write_export(rows)
+    pcc = ProcessClassificationsCSV()
+    pcc.process_classification_export(update_first_unprocessed_row=True)
+    new_ids = get_processed_ids()
+    # (Classifications of subjects without a '!subject_id' are never converted)
+    assert new_ids and set(new_ids) == set(int(row[0]) for row in late_rows) & set(get_logged_ids(pcc))
+    # Nothing is processed again
+    pcc = ProcessClassificationsCSV()
+    pcc.process_classification_export(update_first_unprocessed_row=True)
+    assert get_processed_ids() == []
+    assert sorted(get_logged_ids(pcc)) == sorted(first_ids + new_ids)
+    with open(ingestion_watermark_path, 'r') as f:
+        assert json.load(f)['max_classification_id'] == max(int(row[0]) for row in rows)
+
+
+def test_watermark_compaction(workspace):
+    os.makedirs(os.path.dirname(ingestion_watermark_path))
+    watermark = IngestionWatermark(max_recent_ids=3)
+    for classification_id in [5, 3, 9, 7, 8]:
+        watermark.add(classification_id)
+    watermark.save()
+    watermark = IngestionWatermark(max_recent_ids=3)
+    assert watermark.watermark == 5 and watermark.recent_ids == {7, 8, 9}
+    # IDs up to the watermark count as processed, those between it and the recent IDs do not
+    assert [watermark.is_processed(classification_id) for classification_id in [4, 6, 7, 10]] == \
+        [True, False, True, False]
+
+
+def get_cleaned_rows(pcc):
+    """
+    Returns the rows of the cleaned classifications manifest, as dictionaries of their (string) cells.
+    """
+    fieldnames = pcc.manifest_store.get_fieldnames('cleaned_classifications')
+    return [dict(zip(fieldnames, ('' if cell is None else str(cell) for cell in row)))
+            for row in pcc.manifest_store.iter_rows('cleaned_classifications')]
+
+
+def get_first_rows(rows):
+    """
+    Returns a dictionary like 'subject_znv_id': row of the subject's first classification (that of lowest ID).
+    """
+    first_rows = {}
+    for row in sorted(rows, key=lambda row: int(row['classification_id'])):
+        first_rows.setdefault(int(row['subject_znv_id']), row)
+    return first_rows
+
+
+def test_cleaned_classifications_store(workspace, export_rows):
+    write_export(export_rows)
+    pcc = ProcessClassificationsCSV()
+    pcc.process_classification_export(update_first_unprocessed_row=True)
+    rows = get_cleaned_rows(pcc)
+    first_rows = get_first_rows(rows)
+    assert len(first_rows) < len(rows)
+    # Classifications of a new subject, added out of order, and of a subject already in the store, added before its
+    # first classification
+    late_rows = [dict(rows[0], classification_id=str(classification_id), subject_znv_id='70000000')
+                 for classification_id in [5003, 5001, 5002]] + [dict(rows[0], classification_id='900')]
+    store = CleanedClassificationsStore()
+    store.write_rows(late_rows)
+    first_rows[70000000], first_rows[int(rows[0]['subject_znv_id'])] = late_rows[1], late_rows[3]
+
+    # IDs with no row (including the ID of an unknown subject, and a subject ID as a classification ID) are left out
+    classification_ids = [int(row['classification_id']) for row in rows + late_rows]
+    assert store.get_many(classification_ids + [1, 70000000]) == \
+        dict((int(row['classification_id']), row) for row in rows + late_rows)
+    assert store.get_many(list(first_rows) + [1, 900], column='subject_znv_id') == first_rows
+    assert store.get_many([]) == {}
+    # Rebuilt from the manifest store, which does not hold the rows added to the store only
+    os.remove(cleaned_classifications_db_path)
+    assert CleanedClassificationsStore().get_many(list(first_rows), column='subject_znv_id') == get_first_rows(rows)
+
+
+def test_cleaned_classifications_store_imports_csv(workspace, export_rows):
+    # A cleaned classifications manifest CSV, kept before the manifest store (which has no cleaned classifications)
+    os.makedirs(os.path.dirname(cleaned_classifications_manifest_csv_path))
+    os.makedirs(os.path.dirname(cleaned_classifications_db_path), exist_ok=True)
+    fieldnames = ['classification_id', 'subject_znv_id', 'user_name', 'subject_type']
+    rows = [dict(zip(fieldnames, [str(1100 - i), str(60000000 + i % 3), f'user{i}', 'e'])) for i in range(9)]
+    with open(cleaned_classifications_manifest_csv_path, 'w', newline='') as f:
+        csv_writer = csv.DictWriter(f, fieldnames)
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+    store = CleanedClassificationsStore()
+    assert store.get_many([int(row['classification_id']) for row in rows]) == \
+        dict((int(row['classification_id']), row) for row in rows)
+    assert store.get_many([60000000, 60000001, 60000002, 60000003], column='subject_znv_id') == get_first_rows(rows)
+    # The CSV is only imported into an empty store
+    os.remove(cleaned_classifications_manifest_csv_path)
+    assert len(CleanedClassificationsStore().get_many([int(row['classification_id']) for row in rows])) == len(rows)
@@ -0,0 +1,63 @@
+import csv
+
+import pytest
+
+from python.utils.retirement_utils import RetirementClient, PanoptesStandIn
+
+
+def read_journal(journal_path):
+    with open(journal_path, 'r', newline='') as f:
+        return [(int(row['workflow_id']), int(row['subject_id'])) for row in csv.DictReader(f)]
+
+
+@pytest.fixture
+def stand_in():
+    with PanoptesStandIn() as stand_in:
+        yield stand_in
+
+
+def make_client(stand_in, journal_path, **kwargs):
+    return RetirementClient(workflow_id=7, endpoint=stand_in.url, journal_path=journal_path, backoff_seconds=0.001,
+                            **kwargs)
+
+
+def test_retires_in_chunks(tmp_path, stand_in):
+    journal_path = str(tmp_path / 'retired_subjects.csv')
+    client = make_client(stand_in, journal_path, chunk_size=7, max_workers=3)
+    subject_ids = list(range(100, 150))
+    # (Duplicate subject IDs are sent once)
+    retired, failed = client.retire_subjects(subject_ids + subject_ids[:5])
+    assert sorted(retired) == subject_ids and failed == []
+    assert stand_in.retired == {7: set(subject_ids)}
+    assert stand_in.n_requests == 8
+    assert sorted(read_journal(journal_path)) == [(7, subject_id) for subject_id in subject_ids]
+
+
+def test_retries_failed_requests(tmp_path, stand_in):
+    stand_in.n_failures = 3
+    client = make_client(stand_in, str(tmp_path / 'retired_subjects.csv'), chunk_size=10, max_workers=2)
+    retired, failed = client.retire_subjects(range(30))
+    assert sorted(retired) == list(range(30)) and failed == []
+    assert stand_in.n_requests == 3 + 3
+
+
+def test_resumes_from_journal(tmp_path, stand_in):
+    journal_path = str(tmp_path / 'retired_subjects.csv')
+    subject_ids = list(range(30))
+    # The first two chunks fail every attempt, and are given up on
+    stand_in.n_failures = 4
+    client = make_client(stand_in, journal_path, chunk_size=10, max_workers=1, max_retries=1)
+    retired, failed = client.retire_subjects(subject_ids)
+    assert retired == subject_ids[20:] and failed == subject_ids[:20]
+    assert read_journal(journal_path) == [(7, subject_id) for subject_id in subject_ids[20:]]
+
+    # A new client resumes from the journal, only sending the subjects that failed
+    n_requests = stand_in.n_requests
+    client = make_client(stand_in, journal_path, chunk_size=10, max_workers=1, max_retries=1)
+    retired, failed = client.retire_subjects(subject_ids)
+    assert retired == subject_ids[:20] and failed == []
+    assert stand_in.n_requests - n_requests == 2
+    assert stand_in.retired == {7: set(subject_ids)}
+    assert sorted(read_journal(journal_path)) == [(7, subject_id) for subject_id in subject_ids]
+    # Journals of other workflows are not read
+    assert RetirementClient(workflow_id=8, journal_path=journal_path).retired == set()